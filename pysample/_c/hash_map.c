@@ -303,6 +303,30 @@ void HashMap_Clear(HashMap *map) {
     map->used = 0;
 }
 
+/**
+ * Delete all the entries, but keep the allocated bucket array, so the map can be
+ * reused without growing it again.
+ */
+void HashMap_Reset(HashMap *map) {
+    size_t i;
+    HashMapEntry *entry, *next;
+
+    if (map->used > 0) {
+        for (i = 0; i < map->size; i++) {
+            entry = map->entries[i];
+            while (entry != NULL) {
+                next = entry->next;
+                del_key_from_entry(map, entry);
+                del_val_from_entry(map, entry);
+                free(entry);
+                entry = next;
+            }
+            map->entries[i] = NULL;
+        }
+    }
+    map->used = 0;
+}
+
 void HashMap_Free(HashMap *map) {
     HashMap_Clear(map);
     free(map);
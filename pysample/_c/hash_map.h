@@ -72,6 +72,8 @@ HashMap *HashMap_Create(HashMapType *type);
 
 void HashMap_Clear(HashMap *map);
 
+void HashMap_Reset(HashMap *map);
+
 void HashMap_Free(HashMap *map);
 
 int HashMap_Set(HashMap *map, void *key, void *val);
@@ -100,6 +100,20 @@ SampleCounter *SampleCounter_Create(int delta, PyObject *sys_path) {
 }
 
 
+static void free_points(SampleCounter *counter) {
+    HashMapEntry *entry;
+    HashMapIterator iterator;
+
+    HASH_MAP_ITERATOR_INIT(&iterator, counter->points);
+
+    while ((entry = HashMap_Next(&iterator)) != NULL) {
+        SampleTraceback_Free(entry->key);
+        // free SamplePoint
+        PyMem_Free(entry->val);
+    }
+}
+
+
 void SampleCounter_Free(SampleCounter *counter) {
     HashMapEntry *entry;
     HashMapIterator iterator;
@@ -126,19 +140,27 @@ void SampleCounter_Free(SampleCounter *counter) {
     }
     HashMap_Free(counter->short_filenames);
 
-    HASH_MAP_ITERATOR_INIT(&iterator, counter->points);
-
-    while ((entry = HashMap_Next(&iterator)) != NULL) {
-        SampleTraceback_Free(entry->key);
-        // free SamplePoint
-        PyMem_Free(entry->val);
-    }
+    free_points(counter);
     HashMap_Free(counter->points);
 
     PyMem_Free(counter);
 }
 
 
+/**
+ * Discard the collected points so the counter can be reused by another context.
+ * The filename caches are kept, they only depend on "sys_path".
+ *
+ * @param counter
+ * @param delta
+ */
+void SampleCounter_Reset(SampleCounter *counter, int delta) {
+    free_points(counter);
+    HashMap_Reset(counter->points);
+    counter->delta = delta;
+}
+
+
 int SampleCounter_AddTraceback(SampleCounter *counter, SampleTraceback *traceback) {
     int res;
     SamplePoint *point;
@@ -182,6 +204,90 @@ int SampleCounter_AddFrame(SampleCounter *counter, PyObject *frame) {
 }
 
 
+/**
+ * Capture the traceback of the frame once, so it can be added to the counters of
+ * all the contexts on the same thread (see "SampleCounter_AddSharedTraceback").
+ * The filenames are deduplicated with a map shared by all the captured tracebacks,
+ * and the hash value is computed only once.
+ *
+ * @param frame
+ * @return
+ */
+SampleTraceback *SampleCounter_CaptureTraceback(PyObject *frame) {
+    static HashMap *filenames = NULL;
+    SampleTraceback *traceback;
+
+    if (filenames == NULL) {
+        filenames = HashMap_Create(&filenames_hash_t);
+        if (filenames == NULL) {
+            return NULL;
+        }
+    }
+
+    traceback = SampleTraceback_Create((PyFrameObject *) frame, filenames);
+    if (traceback == NULL) {
+        return NULL;
+    }
+    traceback_hash(traceback);
+    return traceback;
+}
+
+
+/**
+ * Add a traceback which is shared with other counters, the counter never takes the
+ * ownership of the traceback, it is copied only the first time it is seen.
+ *
+ * If "root_depth" is greater than 0, only the frames above the root frame (the frame
+ * at the depth "root_depth" of the stack) are recorded.
+ *
+ * @param counter
+ * @param traceback
+ * @param root_depth
+ * @return
+ */
+int SampleCounter_AddSharedTraceback(SampleCounter *counter, SampleTraceback *traceback, int root_depth) {
+    int i, nframe;
+    SampleTraceback *copy;
+    SamplePoint *point;
+
+    nframe = traceback->depth - root_depth;
+    // The stack is not below the root frame (e.g. another coroutine is running),
+    // record the whole stack.
+    if (root_depth <= 0 || nframe <= 0 || nframe >= traceback->nframe) {
+        point = HashMap_Get(counter->points, traceback);
+        if (point != NULL) {
+            point->count += counter->delta;
+            return 0;
+        }
+
+        copy = SampleTraceback_Copy(traceback);
+        if (copy == NULL) {
+            return -1;
+        }
+        return SampleCounter_AddTraceback(counter, copy);
+    }
+
+    copy = SampleTraceback_Truncate(traceback, nframe);
+    if (copy == NULL) {
+        return -1;
+    }
+
+    point = HashMap_Get(counter->points, copy);
+    if (point != NULL) {
+        // The frames of the truncated copy hold no references.
+        PyMem_Free(copy);
+        point->count += counter->delta;
+        return 0;
+    }
+
+    for (i = 0; i < nframe; i++) {
+        Py_XINCREF(copy->frames[i].filename);
+        Py_XINCREF(copy->frames[i].co_name);
+    }
+    return SampleCounter_AddTraceback(counter, copy);
+}
+
+
 typedef struct {
     int length;
     int max_length;
@@ -428,12 +534,26 @@ static int write_eof_to_output(OutputBuffer *buffer) {
  * @param buffer
  * @return
  */
-int dump_traceback(SampleCounter *counter, SampleTraceback *traceback, OutputBuffer *buffer) {
+int dump_traceback(SampleCounter *counter, SampleTraceback *traceback, PyObject *root_label, OutputBuffer *buffer) {
     int i, res, n = traceback->nframe;
     const char *utf8_str;
     SampleFrame *frame;
     PyObject *filename;
 
+    // The frames below the root frame are replaced with the root label.
+    if (traceback->truncated && root_label != NULL && root_label != Py_None) {
+        utf8_str = PyUnicode_AsUTF8(root_label);
+        if (utf8_str == NULL) {
+            return -1;
+        }
+        if (write_string_to_output(buffer, utf8_str) == -1) {
+            return -1;
+        }
+        if (write_string_to_output(buffer, ";") == -1) {
+            return -1;
+        }
+    }
+
     for (i = 0; i < n; i++) {
         frame = &traceback->frames[n - i - 1];
 
@@ -495,9 +615,11 @@ int dump_traceback(SampleCounter *counter, SampleTraceback *traceback, OutputBuf
  * See: https://github.com/brendangregg/FlameGraph
  *
  * @param counter
+ * @param root_label
+ *      The label of the frames below the root frame of the truncated stacks.
  * @return
  */
-PyObject *SampleCounter_FlameOutput(SampleCounter *counter) {
+PyObject *SampleCounter_FlameOutput(SampleCounter *counter, PyObject *root_label) {
     int i, res;
     SamplePoint *point;
     HashMapEntry *entry;
@@ -528,7 +650,7 @@ PyObject *SampleCounter_FlameOutput(SampleCounter *counter) {
     i = 0;
     while ((entry = HashMap_Next(&iterator)) != NULL) {
         point = entry->val;
-        res = dump_traceback(counter, point->traceback, buffer);
+        res = dump_traceback(counter, point->traceback, root_label, buffer);
         if (res == -1) {
             goto error;
         }
@@ -31,11 +31,17 @@ SampleCounter *SampleCounter_Create(int delta, PyObject *sys_path);
 
 void SampleCounter_Free(SampleCounter *counter);
 
+void SampleCounter_Reset(SampleCounter *counter, int delta);
+
 int SampleCounter_AddFrame(SampleCounter *counter, PyObject *frame);
 
 int SampleCounter_AddTraceback(SampleCounter *counter, SampleTraceback *traceback);
 
-PyObject *SampleCounter_FlameOutput(SampleCounter *counter);
+SampleTraceback *SampleCounter_CaptureTraceback(PyObject *frame);
+
+int SampleCounter_AddSharedTraceback(SampleCounter *counter, SampleTraceback *traceback, int root_depth);
+
+PyObject *SampleCounter_FlameOutput(SampleCounter *counter, PyObject *root_label);
 
 
 #endif //PYSAMPLE_SAMPLE_COUNTER_H
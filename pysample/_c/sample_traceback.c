@@ -84,6 +84,8 @@ SampleTraceback *SampleTraceback_Create(PyFrameObject *frame, HashMap *filenames
         return NULL;
 
     traceback->nframe = 0;
+    traceback->depth = 0;
+    traceback->truncated = 0;
     traceback->hash_value = 0;
 
     for (;frame != NULL; frame = frame->f_back) {
@@ -110,10 +112,75 @@ SampleTraceback *SampleTraceback_Create(PyFrameObject *frame, HashMap *filenames
         }
     }
 
+    traceback->depth = traceback->nframe;
+    for (; frame != NULL; frame = frame->f_back) {
+        traceback->depth++;
+    }
     return traceback;
 }
 
 
+/**
+ * Copy the traceback, the frames of the copy hold their own references.
+ *
+ * @param traceback
+ * @return
+ */
+SampleTraceback *SampleTraceback_Copy(SampleTraceback *traceback) {
+    int n;
+    size_t size = sizeof(SampleTraceback);
+    SampleTraceback *copy;
+
+    if (traceback->nframe > DEFAULT_MAX_FRAME_NUM) {
+        size += (traceback->nframe - DEFAULT_MAX_FRAME_NUM) * sizeof(SampleFrame);
+    }
+
+    copy = PyMem_Malloc(size);
+    if (copy == NULL) {
+        return NULL;
+    }
+
+    memcpy(copy, traceback, size);
+    for (n = 0; n < copy->nframe; n++) {
+        Py_XINCREF(copy->frames[n].filename);
+        Py_XINCREF(copy->frames[n].co_name);
+    }
+    return copy;
+}
+
+
+/**
+ * Copy the innermost "nframe" frames of the traceback, the frames of the copy
+ * do not hold references until it is kept (see "SampleTraceback_Copy").
+ * The hash value of the copy is not computed.
+ *
+ * @param traceback
+ * @param nframe
+ * @return
+ */
+SampleTraceback *SampleTraceback_Truncate(SampleTraceback *traceback, int nframe) {
+    size_t size = sizeof(SampleTraceback);
+    SampleTraceback *copy;
+
+    assert(nframe <= traceback->nframe);
+    if (nframe > DEFAULT_MAX_FRAME_NUM) {
+        size += (nframe - DEFAULT_MAX_FRAME_NUM) * sizeof(SampleFrame);
+    }
+
+    copy = PyMem_Malloc(size);
+    if (copy == NULL) {
+        return NULL;
+    }
+
+    memcpy(copy->frames, traceback->frames, nframe * sizeof(SampleFrame));
+    copy->nframe = nframe;
+    copy->depth = traceback->depth;
+    copy->truncated = 1;
+    copy->hash_value = 0;
+    return copy;
+}
+
+
 void SampleTraceback_Free(SampleTraceback *traceback) {
     int n = traceback->nframe;
     SampleFrame *sframe;
@@ -163,7 +230,7 @@ int SampleTraceback_Compare(SampleTraceback *tb1, SampleTraceback *tb2) {
     assert(tb1);
     assert(tb2);
 
-    if (tb1->nframe != tb2->nframe) {
+    if (tb1->nframe != tb2->nframe || tb1->truncated != tb2->truncated) {
         return 1;
     }
 
@@ -23,6 +23,8 @@ typedef struct {
 
 typedef struct {
     int nframe;
+    int depth;          // the depth of the whole stack, including the frames not recorded
+    int truncated;      // the frames below the root frame of the context are not recorded
     size_t hash_value;
     SampleFrame frames[DEFAULT_MAX_FRAME_NUM];
 } SampleTraceback;
@@ -30,6 +32,10 @@ typedef struct {
 
 SampleTraceback *SampleTraceback_Create(PyFrameObject *frame, HashMap *filenames);
 
+SampleTraceback *SampleTraceback_Copy(SampleTraceback *traceback);
+
+SampleTraceback *SampleTraceback_Truncate(SampleTraceback *traceback, int nframe);
+
 void SampleTraceback_Free(SampleTraceback *traceback);
 
 size_t SampleTraceback_Hash(SampleTraceback *traceback);
@@ -1,13 +1,27 @@
 cdef extern from "sample.h":
     ctypedef struct SampleCounter
 
+    ctypedef struct SampleTraceback
+
     SampleCounter *SampleCounter_Create(int delta, object sys_path);
 
     void SampleCounter_Free(SampleCounter *counter);
 
+    void SampleCounter_Reset(SampleCounter *counter, int delta);
+
     int SampleCounter_AddFrame(SampleCounter *counter, object frame);
 
-    object SampleCounter_FlameOutput(SampleCounter *counter);
+    object SampleCounter_FlameOutput(SampleCounter *counter, object root_label);
+
+    SampleTraceback *SampleCounter_CaptureTraceback(object frame);
+
+    int SampleCounter_AddSharedTraceback(SampleCounter *counter, SampleTraceback *traceback, int root_depth);
+
+    void SampleTraceback_Free(SampleTraceback *traceback);
+
+
+cdef class PySampleTraceback:
+    cdef SampleTraceback *_traceback
 
 
 cdef class PySampleCounter:
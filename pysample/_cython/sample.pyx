@@ -2,6 +2,37 @@ import sys
 from types import FrameType
 
 
+def frame_depth(frame) -> int:
+    """
+    Return the number of frames of the stack, including the given frame.
+    """
+    cdef int depth = 0
+
+    while frame is not None:
+        depth += 1
+        frame = frame.f_back
+    return depth
+
+
+cdef class PySampleTraceback:
+    """
+    The traceback of a frame captured once, which can be added to many counters.
+    """
+
+    def __cinit__(self, frame: FrameType):
+        if not isinstance(frame, FrameType):
+            raise TypeError
+
+        self._traceback = SampleCounter_CaptureTraceback(frame)
+        if self._traceback == NULL:
+            raise RuntimeError
+
+    def __dealloc__(self):
+        if self._traceback:
+            SampleTraceback_Free(self._traceback)
+            self._traceback = NULL
+
+
 cdef class PySampleCounter:
     def __cinit__(self, int delta):
 
@@ -16,6 +47,12 @@ cdef class PySampleCounter:
             SampleCounter_Free(self._counter)
             self._counter = NULL
 
+    def reset(self, int delta):
+        """
+        Discard the collected stacks, so the counter can be reused.
+        """
+        SampleCounter_Reset(self._counter, delta)
+
     def add_frame(self, frame: FrameType):
         cdef int res
 
@@ -26,5 +63,12 @@ cdef class PySampleCounter:
         if res == -1:
             raise RuntimeError
 
-    def flame_output(self) -> str:
-        return SampleCounter_FlameOutput(self._counter)
\ No newline at end of file
+    def add_traceback(self, PySampleTraceback traceback, int root_depth = 0):
+        cdef int res
+
+        res = SampleCounter_AddSharedTraceback(self._counter, traceback._traceback, root_depth)
+        if res == -1:
+            raise RuntimeError
+
+    def flame_output(self, root_label: str = None) -> str:
+        return SampleCounter_FlameOutput(self._counter, root_label)
\ No newline at end of file
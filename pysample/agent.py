@@ -0,0 +1,273 @@
+import sys
+import json
+import zlib
+import time
+import signal
+import logging
+import optparse
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.request import HTTPError
+
+from pysample.aggregator import AggregatorServer
+from pysample.transport import DiskSpool, ThreadTransport, Transport
+
+
+logger = logging.getLogger(__name__)
+
+ADD_PATH = "/sample/add/"
+ADD_BATCH_PATH = "/sample/add_batch/"
+
+
+class _UnsentRecords(Exception):
+    """
+    Some records of a batch failed to send to the "add" api, "data" is the batch of
+    the records which are not sent yet.
+    """
+
+    def __init__(self, data: bytes, error: Exception):
+        super().__init__(str(error))
+        self.data = data
+        self.error = error
+
+
+class BatchTransport(ThreadTransport):
+    """
+    Send batches to the "add_batch" api of the server.
+
+    If the server does not support the batch api, the records of the batch are
+    sent to the "add" api one by one. If one of them fails, only the records which
+    are not sent yet are spooled and retried, the records rejected by the server
+    (a 4xx status) are skipped.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._batch_supported = True
+
+    def _send_request(self, url: str, headers: Dict[str, str], data: bytes):
+        if self._batch_supported or ADD_BATCH_PATH not in url:
+            try:
+                return super()._send_request(url, headers, data)
+            except HTTPError as e:
+                if e.code != 404 or ADD_BATCH_PATH not in url:
+                    raise
+                logger.warning("The server does not support batch api, fall back to single api")
+                self._batch_supported = False
+
+        add_url = url.replace(ADD_BATCH_PATH, ADD_PATH)
+        records = json.loads(zlib.decompress(data))["records"]
+        for index, record in enumerate(records):
+            message = zlib.compress(json.dumps(record).encode("utf8"))
+            try:
+                super()._send_request(add_url, headers, message)
+            except HTTPError as e:
+                if e.code >= 500:
+                    raise self._unsent(records[index:], e)
+                logger.error(f"The record {record.get('sample_id')} is rejected by the server")
+            except Exception as e:
+                raise self._unsent(records[index:], e)
+
+    @classmethod
+    def _unsent(cls, records: List[Dict[str, Any]], error: Exception) -> _UnsentRecords:
+        data = zlib.compress(json.dumps({"records": records}).encode("utf8"))
+        return _UnsentRecords(data, error)
+
+    def _handle_failure(self, url: str, headers: Dict[str, str], data: bytes, err: Exception):
+        if isinstance(err, _UnsentRecords):
+            data, err = err.data, err.error
+        super()._handle_failure(url, headers, data, err)
+
+
+class CollectorAgent(AggregatorServer):
+    """
+    A local collector agent which receives records from the processes on the host
+    over a unix domain socket (see "UnixSocketTransport").
+
+    The records from all processes are deduplicated by project and sample_id, merged
+    into batches per project, and forwarded to the server in compressed batches.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        transport: Transport,
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        dedup_size: int = 100000,
+    ):
+        """
+        :param path:
+            The unix domain socket path to listen on.
+        :param transport:
+            Forward the batches with the transport.
+        :param batch_size:
+            The maximum number of records in a batch.
+        :param flush_interval:
+            Send the pending records at least every "flush_interval" seconds.
+        :param dedup_size:
+            The number of the recently received sample ids remembered for deduplication.
+        """
+        super().__init__(path, transport)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._dedup_size = dedup_size
+        self._lock = threading.Lock()
+        self._seen: "OrderedDict[Tuple[str, str], None]" = OrderedDict()
+        self._batches: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        self._flush_thread: Optional[threading.Thread] = None
+        self._flush_event = threading.Event()
+
+    @classmethod
+    def split_url(cls, url: str) -> Optional[Tuple[str, str]]:
+        """
+        Split the "add" api url into the server url and project name.
+        """
+        if ADD_PATH not in url:
+            return None
+        base_url, project = url.rsplit(ADD_PATH, 1)
+        if not project or "/" in project:
+            return None
+        return base_url, project
+
+    def _is_duplicate(self, key: Tuple[str, str]) -> bool:
+        if key in self._seen:
+            self._seen.move_to_end(key)
+            return True
+
+        self._seen[key] = None
+        if len(self._seen) > self._dedup_size:
+            self._seen.popitem(last=False)
+        return False
+
+    def handle_record(self, url: str, headers: Dict[str, str], data: bytes):
+        target = self.split_url(url)
+        try:
+            record = json.loads(zlib.decompress(data))
+        except (zlib.error, ValueError):
+            record = None
+        if target is None or not isinstance(record, dict) or "sample_id" not in record:
+            super().handle_record(url, headers, data)
+            return
+
+        batch = None
+        with self._lock:
+            if self._is_duplicate((target[1], record["sample_id"])):
+                return
+
+            records = self._batches.setdefault(target, [])
+            records.append(record)
+            if len(records) >= self._batch_size:
+                batch = self._batches.pop(target)
+
+        if batch:
+            self._send_batch(target, batch)
+
+    def _send_batch(self, target: Tuple[str, str], records: List[Dict[str, Any]]):
+        base_url, project = target
+        message = zlib.compress(json.dumps({"records": records}).encode("utf8"))
+        headers = {
+            "Content-Encoding": "deflate",
+            "Content-Type": "application/octet-stream",
+        }
+        url = f"{base_url}{ADD_BATCH_PATH}{project}"
+        if not self._send_priority:
+            self._transport.send(url, headers, message)
+            return
+        priority = max(record.get("execution_time", 0) for record in records)
+        self._transport.send(url, headers, message, priority=priority)
+
+    def flush(self):
+        with self._lock:
+            batches, self._batches = self._batches, {}
+        for target, records in batches.items():
+            self._send_batch(target, records)
+
+    def _run_flush(self):
+        while not self._flush_event.wait(self._flush_interval):
+            self.flush()
+
+    def start(self):
+        super().start()
+        self._flush_event.clear()
+        self._flush_thread = threading.Thread(
+            target=self._run_flush, name="PySample.CollectorAgent"
+        )
+        self._flush_thread.setDaemon(True)
+        self._flush_thread.start()
+
+    def stop(self):
+        super().stop()
+        if self._flush_thread:
+            self._flush_event.set()
+            self._flush_thread.join()
+            self._flush_thread = None
+        self.flush()
+
+
+def main():
+    usage = "%prog -s socket_path [-b batch_size] [-f flush_interval] [-d spool_directory]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option(
+        "-s",
+        "--socket",
+        default="/tmp/pysample-agent.sock",
+        help="The unix domain socket path to listen on.",
+    )
+    parser.add_option(
+        "-b",
+        "--batch_size",
+        default=100,
+        type="int",
+        help="The maximum number of records in a batch.",
+    )
+    parser.add_option(
+        "-f",
+        "--flush_interval",
+        default=1.0,
+        type="float",
+        help="Send the pending records at least every 'flush_interval' seconds.",
+    )
+    parser.add_option(
+        "-q",
+        "--max_queue_size",
+        default=1000,
+        type="int",
+        help="The maximum number of batches queued in memory.",
+    )
+    parser.add_option(
+        "-d",
+        "--spool_directory",
+        default=None,
+        help="Spool the batches to the directory when the server is unavailable.",
+    )
+
+    options, args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    spool = DiskSpool(options.spool_directory) if options.spool_directory else None
+    transport = BatchTransport(max_queue_size=options.max_queue_size, spool=spool)
+    transport.start()
+
+    agent = CollectorAgent(
+        options.socket,
+        transport,
+        batch_size=options.batch_size,
+        flush_interval=options.flush_interval,
+    )
+    agent.start()
+    print(f"PySample agent is listening on {options.socket}")
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    signal.signal(signal.SIGINT, lambda *_: stopped.set())
+    while not stopped.wait(1):
+        pass
+
+    agent.stop()
+    # Give the transport a chance to send the last batches.
+    deadline = time.monotonic() + 5
+    while transport.stats()["queue_size"] and time.monotonic() < deadline:
+        time.sleep(0.1)
+    sys.exit(0)
@@ -0,0 +1,220 @@
+import os
+import json
+import zlib
+import socket
+import logging
+import threading
+import socketserver
+from typing import Dict, Optional
+
+from pysample.transport import (
+    Transport,
+    ThreadTransport,
+    RECORD_HEADER_SIZE,
+    accepts_priority,
+    encode_record,
+    decode_record,
+    record_payload_size,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+def record_priority(data: bytes) -> int:
+    """
+    The priority of a forwarded record, the execution time of the sampling (the
+    same as "Client.send"), or 0 if the record is not a compressed sampling record.
+    """
+    try:
+        record = json.loads(zlib.decompress(data))
+    except (zlib.error, ValueError):
+        return 0
+    if not isinstance(record, dict):
+        return 0
+    priority = record.get("execution_time", 0)
+    return priority if isinstance(priority, int) else 0
+
+
+class UnixSocketTransport(ThreadTransport):
+    """
+    Send the requests to the local aggregator over a unix domain socket.
+
+    Usually used by the worker processes of a pre-fork server (e.g. gunicorn),
+    so all the workers on the host ship their data through one aggregator.
+    """
+
+    def __init__(self, path: str, **kwargs):
+        """
+        :param path:
+            The unix domain socket path of the aggregator.
+        :param kwargs:
+            See "ThreadTransport".
+        """
+        super().__init__(**kwargs)
+        self._path = path
+        self._sock: Optional[socket.socket] = None
+
+    def _connect(self) -> socket.socket:
+        if self._sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self._send_timeout)
+            try:
+                sock.connect(self._path)
+            except OSError:
+                sock.close()
+                raise
+            self._sock = sock
+        return self._sock
+
+    def _close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+    def _send_request(self, url: str, headers: Dict[str, str], data: bytes):
+        record = encode_record(url, headers, data)
+        sock = self._connect()
+        try:
+            sock.sendall(record)
+        except OSError:
+            self._close()
+            raise
+
+    def _after_fork(self):
+        # The connection is shared with the parent process, close the copy
+        # in the child process and connect again.
+        self._close()
+        super()._after_fork()
+
+
+class _RecordHandler(socketserver.StreamRequestHandler):
+    server: "_AggregatorSocketServer"
+
+    def handle(self):
+        while True:
+            header = self.rfile.read(RECORD_HEADER_SIZE)
+            if len(header) < RECORD_HEADER_SIZE:
+                return
+
+            payload_size = record_payload_size(header)
+            payload = self.rfile.read(payload_size)
+            record = None
+            if len(payload) == payload_size:
+                record = decode_record(header, payload)
+            if record is None:
+                logger.error("Received a corrupted record, close the connection")
+                return
+
+            self.server.aggregator.handle_record(*record)
+
+
+class _AggregatorSocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, aggregator: "AggregatorServer"):
+        self.aggregator = aggregator
+        super().__init__(path, _RecordHandler)
+
+
+class AggregatorServer(object):
+    """
+    Receive the records from the local processes over a unix domain socket,
+    and forward them to the collector with one transport.
+
+    Usage with a pre-fork server, start the aggregator in the master process:
+        aggregator = AggregatorServer("/tmp/pysample.sock", ThreadTransport())
+        aggregator.start()
+
+    And send the data to the aggregator in the worker processes:
+        FlaskSample(url, transport=UnixSocketTransport("/tmp/pysample.sock"))
+    """
+
+    def __init__(self, path: str, transport: Transport):
+        """
+        :param path:
+            The unix domain socket path to listen on.
+        :param transport:
+            Forward the received records with the transport.
+        """
+        self._path = path
+        self._transport = transport
+        self._send_priority = accepts_priority(transport)
+        self._server: Optional[_AggregatorSocketServer] = None
+        self._thread: Optional[threading.Thread] = None
+        self._pid = None
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def handle_record(self, url: str, headers: Dict[str, str], data: bytes):
+        # The priority is not sent over the socket, take it from the record again.
+        if self._send_priority:
+            self._transport.send(url, headers, data, priority=record_priority(data))
+        else:
+            self._transport.send(url, headers, data)
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self._path):
+            return
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._path)
+        except OSError:
+            os.remove(self._path)
+        else:
+            raise RuntimeError(f"The aggregator is already listening on {self._path}")
+        finally:
+            sock.close()
+
+    def start(self):
+        if self._server is not None:
+            return
+
+        self._remove_stale_socket()
+        self._server = _AggregatorSocketServer(self._path, self)
+        self._pid = os.getpid()
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="PySample.AggregatorServer"
+        )
+        self._thread.setDaemon(True)
+        self._thread.start()
+        _aggregators.append(self)
+
+    def stop(self):
+        if self._server is None:
+            return
+
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        self._thread = None
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        _aggregators.remove(self)
+
+    def _after_fork(self):
+        # Only the process which started the aggregator serves the socket.
+        if self._server is not None and self._pid != os.getpid():
+            self._server.socket.close()
+            self._server = None
+            self._thread = None
+
+
+_aggregators = []
+
+
+def _after_fork_in_child():
+    for aggregator in list(_aggregators):
+        aggregator._after_fork()
+    _aggregators.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -7,13 +7,14 @@ import threading
 from typing import Dict, Any, Tuple
 from urllib.parse import urlparse
 
-from pysample.transport import Transport
+from pysample.transport import Transport, accepts_priority
 
 
 class Client(object):
     def __init__(self, url: str, transport: Transport):
         self._url, self._project = self.parse_url(url)
         self._transport = transport
+        self._send_priority = accepts_priority(transport)
         self._add_url = f"{self._url}/sample/add/{self._project}"
 
     @property
@@ -68,7 +69,12 @@ class Client(object):
             "Content-Encoding": "deflate",
             "Content-Type": "application/octet-stream",
         }
-        self._transport.send(self._add_url, headers, message)
+        if self._send_priority:
+            self._transport.send(
+                self._add_url, headers, message, priority=data.get("execution_time", 0)
+            )
+        else:
+            self._transport.send(self._add_url, headers, message)
 
     def build_data(
         self, name: str, sample_id: str, stack_info: str, execution_time: int, **kwargs
@@ -1,14 +1,18 @@
 import os
+import re
 import sys
+import types
+import shutil
 import optparse
 import tempfile
 import subprocess
 
 from builtins import exec
-from typing import Any
+from typing import Any, Callable, List, Optional
 
+from pysample import process
 from pysample.sampler import sample
-from pysample.timer import stop_timer, timer_started
+from pysample.timer import AllThreadsContextFactory, stop_timer, timer_started
 
 
 def find_script(script_name: str) -> str:
@@ -29,8 +33,30 @@ def find_script(script_name: str) -> str:
     raise SystemExit(1)
 
 
+def make_thread_filter(patterns: Optional[List[str]]) -> Optional[Callable[[str], bool]]:
+    """
+    Accept the thread names which match any of the regular expressions.
+    """
+    if not patterns:
+        return None
+    regexes = [re.compile(pattern) for pattern in patterns]
+    return lambda name: any(regex.search(name) for regex in regexes)
+
+
 def execute_script(script_name: str, options: Any, output_path: str):
-    sampler = sample(options.interval, 0, output_path)
+    all_threads = getattr(options, "all_threads", False)
+    thread_filter = getattr(options, "thread_filter", None)
+    context_factory = None
+    if all_threads:
+        context_factory = AllThreadsContextFactory(make_thread_filter(thread_filter))
+    sampler = sample(options.interval, 0, output_path, context_factory=context_factory)
+
+    # The child processes write their profiles to the directory, which are merged
+    # into the output when the script is finished.
+    profile_dir = None
+    if getattr(options, "multiprocessing", False):
+        profile_dir = tempfile.mkdtemp(prefix="pysample-")
+        process.install(profile_dir, options.interval, all_threads, thread_filter)
 
     ctx = None
     try:
@@ -39,18 +65,38 @@ def execute_script(script_name: str, options: Any, output_path: str):
             code_object = compile(f.read(), script_name, "exec")
             # Start to sampling
             ctx = sampler.begin(script_name)
-            globals_ctx = locals_ctx = {"__name__": "__main__"}
-            exec(code_object, globals_ctx, locals_ctx)
+            if profile_dir:
+                # Run the script as the "__main__" module, so the functions defined in
+                # the script can be pickled for the child processes (e.g. a process pool).
+                main_module = types.ModuleType("__main__")
+                main_module.__file__ = script_name
+                saved_main_module = sys.modules["__main__"]
+                sys.modules["__main__"] = main_module
+                try:
+                    exec(code_object, main_module.__dict__)
+                finally:
+                    sys.modules["__main__"] = saved_main_module
+            else:
+                globals_ctx = locals_ctx = {"__name__": "__main__"}
+                exec(code_object, globals_ctx, locals_ctx)
     finally:
         if ctx:
             sampler.end(ctx)
         if timer_started():
             stop_timer()
+        if profile_dir:
+            process.uninstall()
+            label = process.process_label("MainProcess", os.getpid())
+            process.merge_profiles(output_path, profile_dir, label)
+            shutil.rmtree(profile_dir, ignore_errors=True)
         print(f"Wrote sampling result to {output_path}")
 
 
 def main():
-    usage = "%prog -p flame_graph_script_path [-o output_file_path] [-i sampling_interval] python_script [arg] ..."
+    usage = (
+        "%prog -p flame_graph_script_path [-o output_file_path] [-i sampling_interval] "
+        "[-a [-t thread_name_pattern] ...] [-m] python_script [arg] ..."
+    )
     parser = optparse.OptionParser(usage=usage)
     parser.add_option(
         "-i",
@@ -67,6 +113,29 @@ def main():
     parser.add_option(
         "-o", "--outfile", default=None, help="Save flame graph to 'outfile'."
     )
+    parser.add_option(
+        "-a",
+        "--all_threads",
+        action="store_true",
+        default=False,
+        help="Sample all the threads of the script, the stacks are rooted at the thread names.",
+    )
+    parser.add_option(
+        "-t",
+        "--thread_filter",
+        action="append",
+        default=None,
+        help="With '--all_threads', only sample the threads whose name matches the "
+             "regular expression. Can be given multiple times.",
+    )
+    parser.add_option(
+        "-m",
+        "--multiprocessing",
+        action="store_true",
+        default=False,
+        help="Also sample the child processes started by multiprocessing (including "
+             "the process pools), the stacks are rooted at the process names.",
+    )
 
     if len(sys.argv) < 2:
         parser.print_usage()
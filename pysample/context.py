@@ -1,41 +1,133 @@
+import os
 import time
 import uuid
 import logging
 import threading
 
-from typing import Iterator, Generic, TypeVar
+from typing import Callable, Iterator, Generic, List, Optional, TypeVar
 
 from types import FrameType
 from collections import deque
 
-from pysample._cython.sample import PySampleCounter
+from pysample._cython.sample import PySampleCounter, PySampleTraceback, frame_depth
 
 
 logger = logging.getLogger(__name__)
 
 
+class CounterPool:
+    """
+    A pool of the reusable "PySampleCounter" objects.
+
+    Creating a counter sorts a copy of sys.path and allocates the hash maps of the
+    counter, so the counters of the discarded sampling results are reset and reused.
+    """
+
+    def __init__(self, size: int = 64):
+        """
+        :param size:
+            The maximum number of idle counters kept in the pool.
+        """
+        self._size = size
+        # list.append/list.pop are atomic, no lock is required.
+        self._counters: List[PySampleCounter] = []
+
+    def acquire(self, delta: int) -> PySampleCounter:
+        try:
+            counter = self._counters.pop()
+        except IndexError:
+            return PySampleCounter(delta)
+        counter.reset(delta)
+        return counter
+
+    def release(self, counter: PySampleCounter):
+        if len(self._counters) < self._size:
+            self._counters.append(counter)
+
+    def __len__(self):
+        return len(self._counters)
+
+
+_counter_pool = CounterPool()
+
+
 class SampleContext:
     def __init__(self, name: str, delta: int):
         self._name = name
-        self._uuid = uuid.uuid4().hex
+        self._uuid: Optional[str] = None
         self._delta = 0
         self._total_count = 0
         self._start_time = time.time()
-        self._counter = PySampleCounter(delta)
+        self._counter: Optional[PySampleCounter] = _counter_pool.acquire(delta)
+        self._root_depth = 0
+
+    def set_root(self, frame: FrameType):
+        """
+        Only record the frames above the root frame, the frames below it (e.g. the
+        web server and threading frames) are replaced with one root label, the name
+        of the context. The root frame must stay on the stack while sampling.
+        """
+        self._root_depth = frame_depth(frame)
 
     def collect(self, frame: FrameType):
-        self._counter.add_frame(frame)
+        counter = self._counter
+        if counter is None:
+            return
+        counter.add_frame(frame)
+        self._total_count += self._delta
+
+    @property
+    def root_depth(self) -> int:
+        return self._root_depth
+
+    def collect_traceback(self, traceback: PySampleTraceback, root_depth: Optional[int] = None):
+        """
+        Collect a traceback captured once and shared by the contexts on the same thread.
+
+        :param root_depth:
+            The depth of the root frame on the thread of the traceback, by default
+            the root frame of the context is used.
+        """
+        counter = self._counter
+        if counter is None:
+            return
+        if root_depth is None:
+            root_depth = self._root_depth
+        counter.add_traceback(traceback, root_depth)
         self._total_count += self._delta
 
     def flame_output(self) -> str:
+        if self._counter is None:
+            return ""
+        if self._root_depth:
+            return self._counter.flame_output(self._name.replace(";", ":"))
         return self._counter.flame_output()
 
+    def close(self):
+        """
+        Discard the collected stacks and return the counter to the pool.
+        The context must not be used after it is closed, and it must be popped from
+        the "SampleContextManager" first, so the timer no longer collects to the counter.
+        """
+        counter, self._counter = self._counter, None
+        if counter is not None:
+            _counter_pool.release(counter)
+
     @property
     def name(self) -> str:
         return self._name
 
+    @name.setter
+    def name(self, name: str):
+        # The web integrations rename the context to the route template, which is
+        # usually only known after the request is routed.
+        self._name = name
+
     @property
     def ident(self) -> str:
+        # Generated on demand, most contexts are discarded without an ident.
+        if self._uuid is None:
+            self._uuid = uuid.uuid4().hex
         return self._uuid
 
     @property
@@ -47,6 +139,40 @@ class SampleContext:
         return self._total_count
 
 
+class SampleResult:
+    """
+    A frozen sampling result.
+
+    It has the same read-only interface as "SampleContext", so it can be stored to
+    an "OutputRepository" after the sample context is finished.
+    """
+
+    def __init__(self, name: str, ident: str, stack_info: str, lifecycle: int):
+        self._name = name
+        self._ident = ident
+        self._stack_info = stack_info
+        self._lifecycle = lifecycle
+
+    @classmethod
+    def from_context(cls, ctx: SampleContext) -> "SampleResult":
+        return cls(ctx.name, ctx.ident, ctx.flame_output(), ctx.lifecycle)
+
+    def flame_output(self) -> str:
+        return self._stack_info
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def ident(self) -> str:
+        return self._ident
+
+    @property
+    def lifecycle(self) -> int:
+        return self._lifecycle
+
+
 class SampleContextFactory:
     def create(self, name: str, delta: int) -> SampleContext:
         return SampleContext(name, delta)
@@ -71,14 +197,31 @@ class SampleContextManager(Generic[CtxType]):
             self._active_context.append(ctx)
 
     def pop(self, ctx: CtxType):
-        try:
-            self._active_context.remove(ctx)
-        except IndexError:
-            pass
+        # Wait for the timer to finish the current tick, see "for_each".
+        with self._lock:
+            try:
+                self._active_context.remove(ctx)
+            except ValueError:
+                # Not pushed, the capacity is exceeded.
+                pass
+
+    def for_each(self, fn: Callable[[CtxType], None]):
+        """
+        Call "fn" with each active context. The contexts are not popped (and so their
+        counters are not returned to the pool) until it returns.
+        """
+        with self._lock:
+            for ctx in self._active_context:
+                fn(ctx)
 
     def iterator(self) -> Iterator[CtxType]:
         return iter(self._active_context)
 
+    def _after_fork_in_child(self):
+        # The active contexts belong to the threads of the parent process.
+        self._lock = threading.Lock()
+        self._active_context = deque()
+
     _instance = None
     _get_instance_lock = threading.Lock()
 
@@ -91,3 +234,13 @@ class SampleContextManager(Generic[CtxType]):
             if cls._instance is None:
                 cls._instance = SampleContextManager()
         return cls._instance
+
+
+def _after_fork_in_child():
+    SampleContextManager._get_instance_lock = threading.Lock()
+    if SampleContextManager._instance is not None:
+        SampleContextManager._instance._after_fork_in_child()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,105 @@
+import sys
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from pysample.contrib.common import SampleIntegration, SAMPLE_ID_HEADER, normalize_path
+
+# The application (or a framework hook) may store the route template of the
+# request in the scope with this key.
+ROUTE_SCOPE_KEY = "pysample.route"
+
+_SAMPLE_ID_HEADER = SAMPLE_ID_HEADER.lower().encode("latin-1")
+
+Scope = Dict[str, Any]
+ASGIApp = Callable[[Scope, Callable, Callable], Awaitable[None]]
+
+
+def default_route(scope: Scope) -> Optional[str]:
+    """
+    Get the route template of the request, such as "/users/{user_id}".
+
+    The "pysample.route" scope key is used if set, otherwise the path of the matched
+    route (Starlette and FastAPI store it in scope["route"]) is used. Return None if
+    the route is unknown, and the normalized request path is used as the sampling name.
+    """
+    route = scope.get(ROUTE_SCOPE_KEY)
+    if route:
+        return route
+    route = scope.get("route")
+    if route is not None:
+        return getattr(route, "path", None)
+    return None
+
+
+class _Send(object):
+    # One object per request, the slots avoid an instance dict on the hot path.
+    __slots__ = ("middleware", "scope", "send", "ctx")
+
+    def __init__(self, middleware: "ASGISampleMiddleware", scope: Scope, send: Callable, ctx):
+        self.middleware = middleware
+        self.scope = scope
+        self.send = send
+        self.ctx = ctx
+
+    def finish(self) -> Optional[str]:
+        ctx, self.ctx = self.ctx, None
+        if ctx is None:
+            return None
+        return self.middleware._finish(ctx, self.middleware._route(self.scope))
+
+    async def __call__(self, message: Dict[str, Any]):
+        if self.ctx is not None and message["type"] == "http.response.start":
+            sample_id = self.finish()
+            if sample_id:
+                headers = list(message.get("headers", ()))
+                headers.append((_SAMPLE_ID_HEADER, sample_id.encode("latin-1")))
+                message["headers"] = headers
+        await self.send(message)
+
+
+class ASGISampleMiddleware(SampleIntegration):
+    """
+    Integrate PySample with any ASGI application (Starlette, FastAPI, Django, ...).
+
+    Usage:
+        app = ASGISampleMiddleware(app, url="http://127.0.0.1:10002/project")
+
+    Only the "http" requests are sampled, until the application sends the
+    "http.response.start" message, which is when the "X-PySample-ID" header is added.
+
+    Note that the sampler collects the stacks of the thread which handles the request,
+    for an asyncio application it is the event loop thread, so the stacks of the other
+    coroutines running on the loop at the same time are collected too, and the code
+    which runs in a thread pool (e.g. the sync endpoints of Starlette) is not.
+
+    See "WSGISampleMiddleware" for the sampling name, and "SampleIntegration" for the
+    other arguments.
+    """
+
+    def __init__(self, app: ASGIApp, route: Callable[[Scope], Optional[str]] = default_route, **kwargs):
+        """
+        :param app:
+            The wrapped ASGI application.
+        :param route:
+            Get the route template from the scope after the request is handled,
+            return None if it is unknown.
+        """
+        super().__init__(**kwargs)
+        self._app = app
+        self._route = route
+        self._sampler = self._make_sampler()
+
+    async def __call__(self, scope: Scope, receive: Callable, send: Callable):
+        if scope["type"] != "http":
+            await self._app(scope, receive, send)
+            return
+
+        ctx = self._begin(normalize_path(scope.get("path") or "/"), root=sys._getframe())
+        if ctx is None:
+            await self._app(scope, receive, send)
+            return
+
+        wrapper = _Send(self, scope, send, ctx)
+        try:
+            await self._app(scope, receive, wrapper)
+        finally:
+            wrapper.finish()
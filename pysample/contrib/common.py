@@ -0,0 +1,193 @@
+import re
+import functools
+from types import FrameType
+from typing import Dict, Optional
+
+from pysample.client import Client
+from pysample.context import SampleContext
+from pysample.repository import OutputRepository, RemoteRepository, TailSamplingRepository
+from pysample.sampler import sample, Sampler
+from pysample.sampling import SamplingPolicy
+from pysample.transport import Transport, ThreadTransport
+
+SAMPLE_ID_HEADER = "X-PySample-ID"
+
+_UUID_PATTERN = re.compile(
+    r"^[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}$"
+)
+_HEX_PATTERN = re.compile(r"^(?=[^/]*\d)[0-9a-fA-F]{16,}$")
+
+
+def _normalize_segment(segment: str) -> str:
+    if segment.isdigit():
+        return "{int}"
+    if _UUID_PATTERN.match(segment):
+        return "{uuid}"
+    if _HEX_PATTERN.match(segment):
+        return "{hex}"
+    return segment
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_path(path: str) -> str:
+    """
+    Replace the variable segments of the request path with placeholders, so the
+    requests of one route share a sampling name, for example:
+        /users/42/orders/6f1c...e2 -> /users/{int}/orders/{uuid}
+
+    Only used when the route template of the framework is unknown.
+    """
+    return "/".join([_normalize_segment(segment) for segment in path.split("/")])
+
+
+class SampleIntegration(object):
+    """
+    The common part of the web framework integrations.
+
+    It creates the client and the sampler. Both the sampling timer thread and the
+    transport thread are started when the sampler is created.
+    """
+
+    def __init__(
+        self,
+        url: Optional[str] = None,
+        client: Optional[Client] = None,
+        interval: int = 10,
+        output_threshold: int = 100,
+        *,
+        transport: Optional[Transport] = None,
+        tail_sampling_size: Optional[int] = None,
+        tail_sampling_window: int = 60,
+        tail_sampling_strategy: str = TailSamplingRepository.SLOWEST,
+        sampling_rate: float = 1.0,
+        sampling_rates: Optional[Dict[str, float]] = None,
+        max_concurrency: Optional[int] = None,
+        max_per_second: Optional[float] = None,
+        truncate_root: bool = False,
+    ):
+        """
+        :param url:
+            Remote server url and project name.
+            for example:
+                 http://127.0.0.1:10002/{project_name}
+
+            The project name is required.
+        :param client:
+            Commonly the client object is automatically created with the given url.
+            If the client object is specified, the "url" argument will be ignored.
+        :param interval:
+            Sampling interval (in milliseconds)
+        :param output_threshold:
+            Output threshold (in milliseconds)
+            If the response time is less than "output_threshold", the sampling
+            result will be discarded.
+        :param transport:
+            The transport used by the automatically created client, it will be started
+            automatically. By default a "ThreadTransport" is used.
+        :param tail_sampling_size:
+            If specified, only the "tail_sampling_size" slowest results (or a reservoir
+            sample) per request name are sent in each window, the others are merged
+            into one aggregate result per name. Note that the "X-PySample-ID" response
+            header may refer to a result which is merged and never stored alone.
+        :param tail_sampling_window:
+            The length of the tail sampling window (in seconds).
+        :param tail_sampling_strategy:
+            "slowest" or "reservoir", see "TailSamplingRepository".
+        :param sampling_rate:
+            The probability (0.0 ~ 1.0) to profile a request, the requests which
+            are not selected skip the profiler completely.
+        :param sampling_rates:
+            The probability per route, for example {"/health": 0}.
+        :param max_concurrency:
+            The maximum number of requests profiled at the same time.
+        :param max_per_second:
+            The maximum number of requests profiled per second.
+        :param truncate_root:
+            Only record the frames of the request handling, the frames of the web
+            server (e.g. werkzeug serving, socketserver, threading) are replaced
+            with one root label, the request name.
+        """
+        if client is None:
+            if url is None:
+                raise ValueError("Either url or client is required")
+            client = self._make_client(url, transport)
+        self._client = client
+        self._interval = interval
+        self._output_threshold = output_threshold
+        self._tail_sampling_size = tail_sampling_size
+        self._tail_sampling_window = tail_sampling_window
+        self._tail_sampling_strategy = tail_sampling_strategy
+        self._truncate_root = truncate_root
+        self._sampler: Optional[Sampler] = None
+        self._policy: Optional[SamplingPolicy] = None
+        if sampling_rate < 1 or sampling_rates or max_concurrency or max_per_second:
+            self._policy = SamplingPolicy(
+                rate=sampling_rate,
+                rates=sampling_rates,
+                max_concurrency=max_concurrency,
+                max_per_second=max_per_second,
+            )
+
+    def _default_transport(self):
+        return ThreadTransport()
+
+    def _make_client(self, url: str, transport: Optional[Transport] = None) -> Client:
+        if transport is None:
+            transport = self._default_transport()
+        transport.start()
+        return Client(url, transport)
+
+    def _make_repository(self) -> OutputRepository:
+        repo = RemoteRepository(self._client)
+        if self._tail_sampling_size:
+            repo = TailSamplingRepository(
+                repo,
+                size=self._tail_sampling_size,
+                window=self._tail_sampling_window,
+                strategy=self._tail_sampling_strategy,
+            )
+        return repo
+
+    def _make_sampler(self) -> Sampler:
+        return sample(
+            self._interval,
+            self._output_threshold,
+            output_repo=self._make_repository(),
+            truncate_root=self._truncate_root,
+        )
+
+    def _sample_id(self, ident: str) -> str:
+        return f"{self._client.project}/{ident}"
+
+    def _begin(
+        self, name: str, route: Optional[str] = None, root: Optional[FrameType] = None
+    ) -> Optional[SampleContext]:
+        """
+        Begin a sample context for a request, return None if the request is not profiled.
+
+        :param route:
+            The key of the per-route sampling rate, "name" is used by default.
+        :param root:
+            The outermost frame of the request handling, see "truncate_root".
+        """
+        if self._policy is not None and not self._policy.acquire(route or name):
+            return None
+        return self._sampler.begin(name, root)
+
+    def _finish(self, ctx: SampleContext, route: Optional[str]) -> Optional[str]:
+        """
+        End the sample context of a request, return the sample id if the result is stored.
+
+        :param route:
+            The route template of the request, it replaces the name of the context.
+        """
+        if route:
+            ctx.name = route
+        try:
+            output = self._sampler.end(ctx)
+        finally:
+            if self._policy is not None:
+                self._policy.release()
+        if output:
+            return self._sample_id(ctx.ident)
+        return None
@@ -1,36 +1,34 @@
+import sys
 import logging
+from types import FrameType
 from typing import Optional
 
-from pysample.client import Client
-from pysample.context import SampleContext
-from pysample.repository import OutputRepository
-from pysample.sampler import sample, Sampler
-from pysample.transport import ThreadTransport
+from pysample.contrib.common import SampleIntegration, SAMPLE_ID_HEADER
+from pysample.repository import RemoteRepository
 from flask import Flask, g, request, Response
 
 CONTEXT_FIELD_NAME = "__pysample_context"
 logger = logging.getLogger("pysample.flask")
 
+__all__ = ["FlaskSample", "RemoteRepository", "CONTEXT_FIELD_NAME"]
 
-class RemoteRepository(OutputRepository):
+
+def _find_root_frame(frame: FrameType) -> FrameType:
     """
-    Store the sampling results to the remote server.
+    Find the frame of "Flask.full_dispatch_request", which calls both the
+    "before_request" hooks and the view function, so it is the root frame of the
+    request. The caller of "preprocess_request" is used if it is not on the stack.
     """
+    fallback = frame.f_back or frame
+    current: Optional[FrameType] = frame
+    while current is not None:
+        if current.f_code.co_name == "full_dispatch_request":
+            return current
+        current = current.f_back
+    return fallback
 
-    def __init__(self, client: Client):
-        self._client = client
-
-    def store(self, sample_context: SampleContext):
-        data = self._client.build_data(
-            name=sample_context.name,
-            sample_id=sample_context.ident,
-            stack_info=sample_context.flame_output(),
-            execution_time=sample_context.lifecycle,
-        )
-        self._client.capture(data)
 
-
-class FlaskSample(object):
+class FlaskSample(SampleIntegration):
     """
     Integrate PySample with Flask.
 
@@ -38,71 +36,35 @@ class FlaskSample(object):
     before_request/after_request/teardown_request to the Flask application,
     and it starts two thread to handle sampling timer and remote data transmission
     separately. Once the "init_app" function is called, the two threads will start
-    automatically.
-    """
+    automatically. Both threads are restarted in the child processes after fork,
+    so it is safe to initialize FlaskSample before a pre-fork server forks workers.
 
-    def __init__(
-        self,
-        url: Optional[str] = None,
-        client: Optional[Client] = None,
-        interval: int = 10,
-        output_threshold: int = 100,
-    ):
-        """
-        :param url:
-            Remote server url and project name.
-            for example:
-                 http://127.0.0.1:10002/{project_name}
-
-            The project name is required.
-        :param client:
-            Commonly the client object is automatically created with the given url.
-            If the client object is specified, the "url" argument will be ignored.
-        :param interval:
-            Sampling interval (in milliseconds)
-        :param output_threshold:
-            Output threshold (in milliseconds)
-            If the response time is less than "output_threshold", the sampling
-            result will be discarded.
-        """
-        if client is None:
-            if url is None:
-                raise ValueError("Either url or client is required")
-            client = self._make_client(url)
-        self._client = client
-        self._interval = interval
-        self._output_threshold = output_threshold
-        self._sampler: Optional[Sampler] = None
-
-    def _default_transport(self):
-        return ThreadTransport()
-
-    def _make_client(self, url: str) -> Client:
-        transport = self._default_transport()
-        transport.start()
-        return Client(url, transport)
+    See "SampleIntegration" for the arguments.
+    """
 
     def init_app(self, app: Flask):
-        repo = RemoteRepository(self._client)
-        self._sampler = sample(self._interval, self._output_threshold, output_repo=repo)
+        self._sampler = self._make_sampler()
 
         app.before_request(self.before_request)
         app.after_request(self.after_request)
         app.teardown_request(self.teardown_request)
 
     def before_request(self):
-        name = request.path
-        ctx = self._sampler.begin(name)
+        # The per-route sampling rates are looked up by the url rule, e.g. "/users/<int:id>".
+        rule = request.url_rule
+        root = _find_root_frame(sys._getframe(1)) if self._truncate_root else None
+        ctx = self._begin(request.path, rule.rule if rule is not None else None, root)
+        # None means the request is not profiled.
         setattr(g, CONTEXT_FIELD_NAME, ctx)
 
     def after_request(self, response: Response) -> Response:
         ctx = getattr(g, CONTEXT_FIELD_NAME, None)
         if ctx:
-            output = self._sampler.end(ctx)
+            sample_id = self._finish(ctx, None)
             delattr(g, CONTEXT_FIELD_NAME)
-            if output:
-                response.headers["X-PySample-ID"] = f"{self._client.project}/{ctx.ident}"
-        else:
+            if sample_id:
+                response.headers[SAMPLE_ID_HEADER] = sample_id
+        elif not hasattr(g, CONTEXT_FIELD_NAME):
             logger.error("Cannot get sample context from flask.g in teardown request")
         return response
 
@@ -110,5 +72,5 @@ class FlaskSample(object):
         del err
         ctx = getattr(g, CONTEXT_FIELD_NAME, None)
         if ctx:
-            self._sampler.end(ctx)
+            self._finish(ctx, None)
             delattr(g, CONTEXT_FIELD_NAME)
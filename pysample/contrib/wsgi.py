@@ -0,0 +1,125 @@
+import sys
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from pysample.contrib.common import SampleIntegration, SAMPLE_ID_HEADER, normalize_path
+
+# The application (or a framework hook) may store the route template of the
+# request in the environ with this key.
+ROUTE_ENVIRON_KEY = "pysample.route"
+
+WSGIApp = Callable[[Dict[str, Any], Callable], Iterable[bytes]]
+
+
+def default_route(environ: Dict[str, Any]) -> Optional[str]:
+    """
+    Get the route template of the request, such as "/users/<int:user_id>".
+
+    The "pysample.route" environ key is used if set, otherwise the url rule of the
+    werkzeug request (Flask) is used. Return None if the route is unknown, and the
+    normalized request path is used as the sampling name.
+    """
+    route = environ.get(ROUTE_ENVIRON_KEY)
+    if route:
+        return route
+    rule = getattr(environ.get("werkzeug.request"), "url_rule", None)
+    if rule is not None:
+        return rule.rule
+    return None
+
+
+class _StartResponse(object):
+    # One object per request, the slots avoid an instance dict on the hot path.
+    __slots__ = ("middleware", "environ", "start_response", "ctx")
+
+    def __init__(self, middleware: "WSGISampleMiddleware", environ, start_response, ctx):
+        self.middleware = middleware
+        self.environ = environ
+        self.start_response = start_response
+        self.ctx = ctx
+
+    def finish(self) -> Optional[str]:
+        ctx, self.ctx = self.ctx, None
+        if ctx is None:
+            return None
+        return self.middleware._finish(ctx, self.middleware._route(self.environ))
+
+    def __call__(self, status, headers, exc_info=None):
+        sample_id = self.finish()
+        if sample_id:
+            headers.append((SAMPLE_ID_HEADER, sample_id))
+        return self.start_response(status, headers, exc_info)
+
+
+class _ClosingIterable(object):
+    __slots__ = ("iterable", "start_response")
+
+    def __init__(self, iterable: Iterable[bytes], start_response: _StartResponse):
+        self.iterable = iterable
+        self.start_response = start_response
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, "close"):
+                self.iterable.close()
+        finally:
+            self.start_response.finish()
+
+
+class WSGISampleMiddleware(SampleIntegration):
+    """
+    Integrate PySample with any WSGI application (Django, Flask, Bottle, ...).
+
+    Usage:
+        application = WSGISampleMiddleware(application, url="http://127.0.0.1:10002/project")
+
+    The request is sampled until the application calls "start_response", which is
+    when the "X-PySample-ID" header is added, so the time spent on streaming the
+    response body is not included (the same as FlaskSample).
+
+    The sampling name is the route template of the request (see "default_route"),
+    or the request path with the numeric, uuid and hex segments replaced with
+    placeholders, so a route does not produce one name per url. The route template is
+    only known after the request is handled, so the "sampling_rates" are looked up
+    by the normalized path (e.g. "/users/{int}").
+
+    See "SampleIntegration" for the other arguments.
+    """
+
+    def __init__(
+        self,
+        app: WSGIApp,
+        route: Callable[[Dict[str, Any]], Optional[str]] = default_route,
+        **kwargs,
+    ):
+        """
+        :param app:
+            The wrapped WSGI application.
+        :param route:
+            Get the route template from the environ after the request is handled,
+            return None if it is unknown.
+        """
+        super().__init__(**kwargs)
+        self._app = app
+        self._route = route
+        self._sampler = self._make_sampler()
+
+    def __call__(self, environ: Dict[str, Any], start_response: Callable) -> Iterable[bytes]:
+        ctx = self._begin(normalize_path(environ.get("PATH_INFO") or "/"), root=sys._getframe())
+        if ctx is None:
+            return self._app(environ, start_response)
+
+        wrapper = _StartResponse(self, environ, start_response, ctx)
+        try:
+            result = self._app(environ, wrapper)
+        except BaseException:
+            wrapper.finish()
+            raise
+
+        if wrapper.ctx is None:
+            return result
+        # The application calls "start_response" lazily when the body is iterated,
+        # make sure the context is ended when the server closes the body.
+        return _ClosingIterable(result, wrapper)
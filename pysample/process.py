@@ -0,0 +1,157 @@
+import os
+import signal
+import logging
+import multiprocessing
+from multiprocessing.process import BaseProcess
+from typing import Callable, List, Optional
+
+from pysample.context import SampleContext
+from pysample.repository import OutputRepository
+from pysample.sampler import sample
+from pysample.timer import AllThreadsContextFactory
+
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SUFFIX = ".profile"
+
+
+def process_label(name: str, pid: int) -> str:
+    """
+    The root frame of the stacks of a process in the merged profile.
+    """
+    return f"{name} [{pid}]".replace(";", ":")
+
+
+def prefix_lines(stack_info: str, label: str) -> str:
+    return "".join(f"{label};{line}\n" for line in stack_info.splitlines() if line)
+
+
+class ChildProfileRepository(OutputRepository):
+    """
+    Store the sampling result of a child process to "<directory>/<pid>.profile",
+    every stack is rooted at the label of the process.
+    """
+
+    def __init__(self, directory: str):
+        self._directory = directory
+
+    def store(self, sample_context: SampleContext):
+        pid = os.getpid()
+        label = process_label(multiprocessing.current_process().name, pid)
+        filename = os.path.join(self._directory, f"{pid}{PROFILE_SUFFIX}")
+        with open(filename, "a") as file:
+            file.write(prefix_lines(sample_context.flame_output(), label))
+
+
+class ProfiledTarget(object):
+    """
+    Run the target of a process with a sampler started in the child process.
+
+    It is picklable as long as the target is, so it works with both the "fork" and
+    the "spawn"/"forkserver" start methods.
+    """
+
+    def __init__(
+        self,
+        target: Callable,
+        directory: str,
+        interval: int,
+        all_threads: bool = False,
+        thread_filter: Optional[List[str]] = None,
+    ):
+        self.target = target
+        self.directory = directory
+        self.interval = interval
+        self.all_threads = all_threads
+        self.thread_filter = thread_filter
+
+    def _on_sigterm(self, signum, frame):
+        # Pool.terminate() stops the workers with SIGTERM, exit normally instead
+        # so the profile of the worker is stored.
+        raise SystemExit(1)
+
+    def __call__(self, *args, **kwargs):
+        # The processes started by the child are profiled too.
+        install(self.directory, self.interval, self.all_threads, self.thread_filter)
+
+        context_factory = None
+        if self.all_threads:
+            from pysample.command_line import make_thread_filter
+
+            context_factory = AllThreadsContextFactory(make_thread_filter(self.thread_filter))
+        sampler = sample(
+            self.interval,
+            0,
+            output_repo=ChildProfileRepository(self.directory),
+            context_factory=context_factory,
+        )
+        if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, self._on_sigterm)
+
+        ctx = sampler.begin(multiprocessing.current_process().name)
+        try:
+            return self.target(*args, **kwargs)
+        finally:
+            sampler.end(ctx)
+
+
+_original_start = None
+
+
+def install(
+    directory: str,
+    interval: int,
+    all_threads: bool = False,
+    thread_filter: Optional[List[str]] = None,
+):
+    """
+    Profile the child processes started by "multiprocessing" (including the workers
+    of "multiprocessing.Pool" and "ProcessPoolExecutor"), the profiles are written
+    to the directory, see "merge_profiles".
+
+    Only the processes with a "target" are profiled, the subclasses of "Process"
+    which override "run" are not.
+    """
+    global _original_start
+
+    if _original_start is not None:
+        return
+    _original_start = original_start = BaseProcess.start
+
+    def start(self):
+        target = getattr(self, "_target", None)
+        if target is not None and not isinstance(target, ProfiledTarget):
+            self._target = ProfiledTarget(target, directory, interval, all_threads, thread_filter)
+        return original_start(self)
+
+    BaseProcess.start = start
+
+
+def uninstall():
+    global _original_start
+
+    if _original_start is not None:
+        BaseProcess.start = _original_start
+        _original_start = None
+
+
+def merge_profiles(output_path: str, directory: str, label: str):
+    """
+    Merge the profiles of the child processes into the output file. The stacks of
+    the output file (the main process) are rooted at "label".
+    """
+    with open(output_path, "r") as file:
+        stack_info = prefix_lines(file.read(), label)
+
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(PROFILE_SUFFIX):
+            continue
+        try:
+            with open(os.path.join(directory, filename), "r") as file:
+                stack_info += file.read()
+        except OSError as e:
+            logger.warning(f"Failed to read the profile {filename}: {e}")
+
+    with open(output_path, "w") as file:
+        file.write(stack_info)
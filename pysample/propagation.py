@@ -0,0 +1,105 @@
+import sys
+import functools
+import threading
+from concurrent.futures import Executor, Future
+from typing import Callable, Optional, TypeVar
+
+from pysample._cython.sample import frame_depth
+from pysample.context import SampleContextManager
+from pysample.timer import ThreadSampleContext
+
+T = TypeVar("T")
+
+
+def current_context(
+    context_manager: Optional[SampleContextManager] = None,
+) -> Optional[ThreadSampleContext]:
+    """
+    Return the innermost active context sampling the current thread, either begun
+    on the thread or propagated to it.
+    """
+    if context_manager is None:
+        context_manager = SampleContextManager.get_default_instance()
+
+    ident = threading.get_ident()
+    # list() copies the deque atomically, other threads push and pop concurrently.
+    for ctx in reversed(list(context_manager.iterator())):
+        if not isinstance(ctx, ThreadSampleContext):
+            continue
+        if ctx.thread_id == ident:
+            return ctx
+        for thread_id, _ in ctx.attached_threads():
+            if thread_id == ident:
+                return ctx
+    return None
+
+
+def wrap(fn: Callable[..., T], ctx: Optional[ThreadSampleContext] = None) -> Callable[..., T]:
+    """
+    Attribute the thread calling the returned function to the context while the
+    function runs.
+
+    :param fn:
+        The function to run in another thread.
+    :param ctx:
+        By default the current context of the calling thread (see "current_context").
+        If there is no context, "fn" is returned unchanged.
+    """
+    if ctx is None:
+        ctx = current_context()
+        if ctx is None:
+            return fn
+
+    @functools.wraps(fn)
+    def inner(*args, **kwargs):
+        ident = threading.get_ident()
+        root_depth = 0
+        if ctx.root_depth:
+            root_depth = frame_depth(sys._getframe())
+        attached = ctx.attach(ident, root_depth)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if attached:
+                ctx.detach(ident)
+
+    return inner
+
+
+class ContextExecutor(Executor):
+    """
+    Wrap an executor (e.g. ThreadPoolExecutor), the tasks submitted in a sampled
+    thread are attributed to the context of the submitting thread.
+
+    Usage:
+        executor = ContextExecutor(ThreadPoolExecutor(max_workers=8))
+        executor.map(fetch, urls)
+    """
+
+    def __init__(self, executor: Executor):
+        self._executor = executor
+
+    def submit(self, fn: Callable[..., T], *args, **kwargs) -> "Future[T]":
+        return self._executor.submit(wrap(fn), *args, **kwargs)
+
+    def shutdown(self, wait: bool = True, **kwargs):
+        self._executor.shutdown(wait, **kwargs)
+
+
+class SampleThread(threading.Thread):
+    """
+    A thread attributed to the context of the thread which starts it.
+    """
+
+    _pysample_context: Optional[ThreadSampleContext] = None
+
+    def start(self):
+        self._pysample_context = current_context()
+        super().start()
+
+    def run(self):
+        ctx, self._pysample_context = self._pysample_context, None
+        if ctx is None:
+            super().run()
+            return
+        wrap(super().run, ctx)()
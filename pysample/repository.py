@@ -1,8 +1,18 @@
 import os
+import time
+import uuid
+import heapq
+import atexit
+import random
+import weakref
 import datetime
 import logging
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
 
-from pysample.context import SampleContext
+from pysample.client import Client
+from pysample.context import SampleContext, SampleResult
 
 logger = logging.getLogger(__name__)
 
@@ -10,6 +20,9 @@ logger = logging.getLogger(__name__)
 class OutputRepository:
     """
     Store the sampling result with given OutputRepository.
+
+    The sampler stores a frozen "SampleResult", the counter of the finished context
+    is reused, so the result may be kept after "store" returns.
     """
 
     def store(self, sample_context: SampleContext):
@@ -47,6 +60,24 @@ class FileRepository(OutputRepository):
             file.write(sample_context.flame_output())
 
 
+class RemoteRepository(OutputRepository):
+    """
+    Store the sampling results to the remote server.
+    """
+
+    def __init__(self, client: Client):
+        self._client = client
+
+    def store(self, sample_context: SampleContext):
+        data = self._client.build_data(
+            name=sample_context.name,
+            sample_id=sample_context.ident,
+            stack_info=sample_context.flame_output(),
+            execution_time=sample_context.lifecycle,
+        )
+        self._client.capture(data)
+
+
 class DirectoryRepository(OutputRepository):
     """
     Store the sampling result to the given directory.
@@ -81,3 +112,208 @@ class DirectoryRepository(OutputRepository):
         with open(filename, 'w') as file:
             file.write(sample_context.flame_output())
 
+
+class _EndpointWindow:
+    def __init__(self):
+        # min-heap of (lifecycle, seq, result) for "slowest", plain list for "reservoir"
+        self.kept: List[Tuple[int, int, SampleResult]] = []
+        self.seen = 0
+        self.merged_count = 0
+        self.merged_max_lifecycle = 0
+        self.merged_stacks: Dict[str, int] = defaultdict(int)
+
+    def merge(self, result: SampleResult):
+        self.merged_count += 1
+        self.merged_max_lifecycle = max(self.merged_max_lifecycle, result.lifecycle)
+        for line in result.flame_output().splitlines():
+            stack, _, count = line.rpartition(" ")
+            if stack:
+                self.merged_stacks[stack] += int(count)
+
+
+class TailSamplingRepository(OutputRepository):
+    """
+    Keep only a few sampling results per name in each time window.
+
+    The results are buffered per name, and when the time window is closed only the
+    "size" slowest results (or a reservoir sample of "size" results) of each name are
+    stored to the underlying repository. The other results are merged into one
+    aggregate result per name if "aggregate" is enabled, otherwise they are discarded.
+
+    The window is closed by a background thread when it expires, by the first
+    "store" call after it expires, or by calling "flush" explicitly. The pending
+    results are flushed when the interpreter exits.
+    """
+
+    SLOWEST = "slowest"
+    RESERVOIR = "reservoir"
+
+    # The maximum length of the sampling name accepted by the server.
+    MAX_NAME_LENGTH = 255
+
+    def __init__(
+        self,
+        repo: OutputRepository,
+        size: int = 5,
+        window: float = 60,
+        strategy: str = SLOWEST,
+        aggregate: bool = True,
+    ):
+        """
+        :param repo:
+            Store the selected results to the underlying repository.
+        :param size:
+            The maximum number of results kept per name in each window.
+        :param window:
+            The length of the time window (in seconds).
+        :param strategy:
+            "slowest": keep the slowest results.
+            "reservoir": keep a uniform random sample of the results.
+        :param aggregate:
+            Merge the results which are not kept into one aggregate result per name.
+        """
+        if size < 1:
+            raise ValueError("'size' must be greater than 0")
+        if strategy not in (self.SLOWEST, self.RESERVOIR):
+            raise ValueError(f"invalid strategy '{strategy}'")
+
+        self._repo = repo
+        self._size = size
+        self._window = window
+        self._strategy = strategy
+        self._aggregate = aggregate
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._window_end = time.monotonic() + window
+        self._endpoints: Dict[str, _EndpointWindow] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._closed = threading.Event()
+        _tail_sampling_repositories.add(self)
+
+    def store(self, sample_context: SampleContext):
+        self._ensure_thread()
+        # Freeze the result out of the lock, "flame_output" walks all the stacks.
+        result = sample_context
+        if not isinstance(result, SampleResult):
+            result = SampleResult.from_context(sample_context)
+        expired = None
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._window_end:
+                expired = self._rotate(now)
+            self._offer(result)
+
+        if expired:
+            self._store_window(expired)
+
+    def flush(self):
+        """
+        Close the current window and store the selected results immediately.
+        """
+        with self._lock:
+            expired = self._rotate(time.monotonic())
+        self._store_window(expired)
+
+    def close(self):
+        """
+        Stop the background thread and flush the pending results.
+        """
+        self._closed.set()
+        thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.flush()
+
+    def _ensure_thread(self):
+        # Started lazily, so the thread is restarted in a forked child process.
+        # Every "store" call closes the window if its length is 0.
+        thread = self._thread
+        if thread is not None and thread.is_alive() or self._closed.is_set() or self._window <= 0:
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run_flush, name="PySample.TailSamplingRepository"
+                )
+                self._thread.setDaemon(True)
+                self._thread.start()
+
+    def _run_flush(self):
+        while not self._closed.wait(max(self._window_end - time.monotonic(), 0)):
+            expired = None
+            now = time.monotonic()
+            with self._lock:
+                if now >= self._window_end:
+                    expired = self._rotate(now)
+            if expired:
+                try:
+                    self._store_window(expired)
+                except Exception:
+                    logger.exception("Failed to store the tail sampling results")
+
+    def _rotate(self, now: float) -> Dict[str, _EndpointWindow]:
+        expired, self._endpoints = self._endpoints, {}
+        self._window_end = now + self._window
+        return expired
+
+    def _offer(self, result: SampleResult):
+        endpoint = self._endpoints.get(result.name)
+        if endpoint is None:
+            endpoint = self._endpoints[result.name] = _EndpointWindow()
+        endpoint.seen += 1
+        self._seq += 1
+        item = (result.lifecycle, self._seq, result)
+
+        if len(endpoint.kept) < self._size:
+            if self._strategy == self.SLOWEST:
+                heapq.heappush(endpoint.kept, item)
+            else:
+                endpoint.kept.append(item)
+            return
+
+        if self._strategy == self.SLOWEST:
+            if result.lifecycle > endpoint.kept[0][0]:
+                evicted = heapq.heapreplace(endpoint.kept, item)[2]
+            else:
+                evicted = result
+        else:
+            index = random.randrange(endpoint.seen)
+            if index < self._size:
+                evicted, endpoint.kept[index] = endpoint.kept[index][2], item
+            else:
+                evicted = result
+
+        if self._aggregate:
+            endpoint.merge(evicted)
+
+    def _store_window(self, endpoints: Dict[str, _EndpointWindow]):
+        for name, endpoint in endpoints.items():
+            for _, _, result in sorted(endpoint.kept, reverse=True):
+                self._repo.store(result)
+
+            if endpoint.merged_count:
+                stack_info = "".join(
+                    f"{stack} {count}\n" for stack, count in endpoint.merged_stacks.items()
+                )
+                # Keep the name stable across the windows so that the aggregate results
+                # of a name are grouped together by the server.
+                suffix = " (aggregate)"
+                result = SampleResult(
+                    name=name[: self.MAX_NAME_LENGTH - len(suffix)] + suffix,
+                    ident=uuid.uuid4().hex,
+                    stack_info=stack_info,
+                    lifecycle=endpoint.merged_max_lifecycle,
+                )
+                self._repo.store(result)
+
+
+_tail_sampling_repositories: "weakref.WeakSet[TailSamplingRepository]" = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_at_exit():
+    for repo in list(_tail_sampling_repositories):
+        try:
+            repo.flush()
+        except Exception:
+            logger.exception("Failed to flush the tail sampling results")
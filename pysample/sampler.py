@@ -1,9 +1,16 @@
+import sys
 import logging
 import functools
-from types import FunctionType
+from types import FrameType, FunctionType
+from typing import Optional
 
 from pysample.repository import OutputRepository, FileRepository, DirectoryRepository
-from pysample.context import SampleContext, SampleContextFactory, SampleContextManager
+from pysample.context import (
+    SampleContext,
+    SampleContextFactory,
+    SampleContextManager,
+    SampleResult,
+)
 from pysample.timer import (
     ThreadSampleTimer,
     ThreadContextFactory,
@@ -32,6 +39,7 @@ class Sampler:
         context_manager: SampleContextManager,
         context_factory: SampleContextFactory,
         output_repo: OutputRepository,
+        truncate_root: bool = False,
     ):
         """
         :param interval:
@@ -46,24 +54,44 @@ class Sampler:
             Create a sample context using the context factory.
         :param output_repo:
             Store the stack information to the output repository.
+        :param truncate_root:
+            Only record the frames above the root frame of the context (by default
+            the frame calling "begin"), the outer frames are replaced with the name
+            of the context.
         """
         self._interval = interval
         self._output_threshold = output_threshold
         self._context_manager = context_manager
         self._context_factory = context_factory
         self._output_repo = output_repo
+        self._truncate_root = truncate_root
 
-    def begin(self, name: str) -> SampleContext:
+    def begin(self, name: str, root: Optional[FrameType] = None) -> SampleContext:
+        """
+        :param root:
+            The root frame of the context if "truncate_root" is enabled, by default
+            it is the frame calling "begin".
+        """
         ctx = self._context_factory.create(name, self._interval)
+        if self._truncate_root:
+            ctx.set_root(root or sys._getframe(1))
         self._context_manager.push(ctx)
         return ctx
 
     def end(self, ctx: SampleContext) -> bool:
+        # The timer no longer collects to the context once it is popped.
         self._context_manager.pop(ctx)
-        if ctx.lifecycle >= self._output_threshold:
-            self._output_repo.store(ctx)
-            return True
-        return False
+        if ctx.lifecycle < self._output_threshold:
+            ctx.close()
+            return False
+
+        # The repository may keep the result, store a frozen copy and reuse the counter.
+        try:
+            result = SampleResult.from_context(ctx)
+        finally:
+            ctx.close()
+        self._output_repo.store(result)
+        return True
 
     def __call__(self, func: FunctionType):
         @functools.wraps(func)
@@ -85,6 +113,8 @@ def sample(
     output_path: str = None,
     output_repo: OutputRepository = None,
     auto_start_timer: bool = True,
+    truncate_root: bool = False,
+    context_factory: SampleContextFactory = None,
 ):
     """
     A decorator function which simplify the use of "sampler" class.
@@ -111,13 +141,20 @@ def sample(
         Start timer before sampling
     :param output_repo:
         If the "output_repo" argument is specified, the "output_path" argument will be discarded.
+    :param truncate_root:
+        Only record the frames of the sampled function, the outer frames of the stack
+        are replaced with one root label (the sampling name).
+    :param context_factory:
+        Create the sample contexts, by default the contexts sample the thread
+        calling "begin" (see "ThreadContextFactory").
     :return:
     """
     if interval < 5:
         interval = 5
 
     context_manager = SampleContextManager.get_default_instance()
-    context_factory = ThreadContextFactory()
+    if context_factory is None:
+        context_factory = ThreadContextFactory()
     if not output_repo:
         if output_path:
             output_repo = FileRepository(output_path)
@@ -133,5 +170,6 @@ def sample(
         context_manager=context_manager,
         context_factory=context_factory,
         output_repo=output_repo,
+        truncate_root=truncate_root,
     )
     return sampler
@@ -0,0 +1,105 @@
+import os
+import time
+import weakref
+import random
+import threading
+from typing import Dict, Optional
+
+
+class SamplingPolicy(object):
+    """
+    Decide which requests are profiled, so that most requests skip the profiler
+    (no sample context is created for them at all).
+
+    A request is profiled if it is selected by the sampling rate of its name, and
+    both the concurrency limit and the per-second budget are not exhausted.
+    The profiled requests must call "release" when they are finished.
+    """
+
+    def __init__(
+        self,
+        rate: float = 1.0,
+        rates: Optional[Dict[str, float]] = None,
+        max_concurrency: Optional[int] = None,
+        max_per_second: Optional[float] = None,
+    ):
+        """
+        :param rate:
+            The default probability (0.0 ~ 1.0) to profile a request.
+        :param rates:
+            The probability per name, for example {"/health": 0, "/orders/<int:id>": 0.1}.
+        :param max_concurrency:
+            The maximum number of requests profiled at the same time.
+        :param max_per_second:
+            The maximum number of requests profiled per second (token bucket, bursts
+            up to one second of budget are allowed).
+        """
+        if max_concurrency is not None and max_concurrency < 1:
+            raise ValueError("'max_concurrency' must be greater than 0")
+        if max_per_second is not None and max_per_second <= 0:
+            raise ValueError("'max_per_second' must be greater than 0")
+
+        self._rate = rate
+        self._rates = dict(rates or {})
+        self._max_concurrency = max_concurrency
+        self._max_per_second = max_per_second
+        self._limited = max_concurrency is not None or max_per_second is not None
+        self._lock = threading.Lock()
+        self._active = 0
+        self._tokens = max(max_per_second or 0, 1)
+        self._updated_at = time.monotonic()
+        _policies.add(self)
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def _take_token(self) -> bool:
+        now = time.monotonic()
+        capacity = max(self._max_per_second, 1)
+        self._tokens = min(capacity, self._tokens + (now - self._updated_at) * self._max_per_second)
+        self._updated_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def acquire(self, name: str) -> bool:
+        """
+        Return True if the request should be profiled.
+        """
+        rate = self._rates.get(name, self._rate)
+        if rate < 1 and (rate <= 0 or random.random() >= rate):
+            return False
+        if not self._limited:
+            return True
+
+        with self._lock:
+            if self._max_concurrency is not None and self._active >= self._max_concurrency:
+                return False
+            if self._max_per_second is not None and not self._take_token():
+                return False
+            self._active += 1
+        return True
+
+    def release(self):
+        if self._limited:
+            with self._lock:
+                self._active -= 1
+
+    def _after_fork_in_child(self):
+        # The profiled requests of the parent process are never released in the child.
+        self._lock = threading.Lock()
+        self._active = 0
+
+
+_policies: "weakref.WeakSet[SamplingPolicy]" = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for policy in list(_policies):
+        policy._after_fork_in_child()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
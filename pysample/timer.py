@@ -1,9 +1,12 @@
+import os
 import sys
 import time
 import math
 import threading
+from typing import Callable, Dict, List, Optional, Tuple
 
 from pysample.context import SampleContext, SampleContextFactory, SampleContextManager
+from pysample._cython.sample import PySampleTraceback
 
 
 class SampleTimer:
@@ -20,17 +23,124 @@ class SampleTimer:
     def stop(self):
         raise NotImplementedError
 
+    def after_fork(self):
+        """
+        Called in the child process after fork. The threads started by the parent
+        process do not exist in the child process, so the timer must be restarted.
+        """
+        raise NotImplementedError
+
 
 class ThreadSampleContext(SampleContext):
     def __init__(self, name: str, delta: int, thread_id: int):
         super().__init__(name, delta)
 
         self._thread_id = thread_id
+        # The other threads working for the context, map thread id to the root depth.
+        self._attached_threads: Dict[int, int] = {}
 
     @property
     def thread_id(self):
         return self._thread_id
 
+    def attach(self, thread_id: int, root_depth: int = 0) -> bool:
+        """
+        Sample another thread for the context, until it is detached.
+        Return False if the thread is already sampled for the context.
+
+        :param root_depth:
+            The depth of the root frame on the thread, see "SampleContext.set_root".
+        """
+        if thread_id == self._thread_id or thread_id in self._attached_threads:
+            return False
+        self._attached_threads[thread_id] = root_depth
+        return True
+
+    def detach(self, thread_id: int):
+        self._attached_threads.pop(thread_id, None)
+
+    def attached_threads(self) -> List[Tuple[int, int]]:
+        if not self._attached_threads:
+            return []
+        # Copy the items, the threads are attached and detached concurrently.
+        return list(self._attached_threads.items())
+
+    def collect_threads(self, capture: Callable[[int], Optional[PySampleTraceback]]):
+        """
+        Collect the stacks of the threads sampled for the context.
+
+        :param capture:
+            Return the traceback of the thread captured in the current tick,
+            or None if the thread does not exist.
+        """
+        traceback = capture(self._thread_id)
+        if traceback is not None:
+            self.collect_traceback(traceback)
+
+        for ident, root_depth in self.attached_threads():
+            traceback = capture(ident)
+            if traceback is not None:
+                self.collect_traceback(traceback, root_depth)
+
+
+class AllThreadsSampleContext(ThreadSampleContext):
+    """
+    Sample all the live threads of the process (except the threads of PySample).
+
+    The stacks are counted per thread name, and each stack is rooted at a frame
+    named after its thread in the flame output.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        delta: int,
+        thread_id: int,
+        thread_filter: Optional[Callable[[str], bool]] = None,
+    ):
+        """
+        :param thread_filter:
+            Only sample the threads whose name is accepted by the filter.
+        """
+        super().__init__(name, delta, thread_id)
+        self._interval = delta
+        self._thread_filter = thread_filter
+        self._threads: Dict[str, SampleContext] = {}
+
+    def attach(self, thread_id: int, root_depth: int = 0) -> bool:
+        # All the threads are sampled already.
+        return False
+
+    def collect_threads(self, capture: Callable[[int], Optional[PySampleTraceback]]):
+        for thread in threading.enumerate():
+            name = thread.name
+            if name.startswith("PySample."):
+                continue
+            if self._thread_filter is not None and not self._thread_filter(name):
+                continue
+
+            traceback = capture(thread.ident)
+            if traceback is None:
+                continue
+            ctx = self._threads.get(name)
+            if ctx is None:
+                ctx = self._threads[name] = SampleContext(name, self._interval)
+            ctx.collect_traceback(traceback)
+
+    def flame_output(self) -> str:
+        lines = []
+        for name, ctx in list(self._threads.items()):
+            root = name.replace(";", ":")
+            for line in ctx.flame_output().splitlines():
+                lines.append(f"{root};{line}\n")
+        return "".join(lines)
+
+    def close(self):
+        for ctx in self._threads.values():
+            ctx.close()
+        self._threads.clear()
+        super().close()
+
 
 class ThreadContextFactory(SampleContextFactory):
     def create(self, name: str, delta: int) -> SampleContext:
@@ -38,6 +148,15 @@ class ThreadContextFactory(SampleContextFactory):
         return ThreadSampleContext(name, delta, t_ident)
 
 
+class AllThreadsContextFactory(SampleContextFactory):
+    def __init__(self, thread_filter: Optional[Callable[[str], bool]] = None):
+        self._thread_filter = thread_filter
+
+    def create(self, name: str, delta: int) -> SampleContext:
+        t_ident = threading.current_thread().ident
+        return AllThreadsSampleContext(name, delta, t_ident, self._thread_filter)
+
+
 class ThreadSampleTimer(SampleTimer):
     """
     Start a new thread, which is used to periodically trigger sampling event.
@@ -71,14 +190,33 @@ class ThreadSampleTimer(SampleTimer):
         self._thread.join(timeout)
         self._thread = None
 
+    def after_fork(self):
+        self._active = False
+        self._thread = None
+        self._current_thread = threading.current_thread()
+        self.start()
+
+    def _sample_once(self):
+        # The stack of each thread is captured once per tick, and the same traceback
+        # is shared by all the contexts on the thread (e.g. nested "sample" functions).
+        frames = sys._current_frames()
+        tracebacks = {}
+
+        def capture(ident):
+            traceback = tracebacks.get(ident)
+            if traceback is None:
+                frame = frames.get(ident)
+                if frame is not None:
+                    traceback = tracebacks[ident] = PySampleTraceback(frame)
+            return traceback
+
+        self._context_manager.for_each(lambda context: context.collect_threads(capture))
+
     def _do_sample(self):
         while self._active:
             start = time.time()
 
-            for context in self._context_manager.iterator():
-                ident = context.thread_id
-                frame = sys._current_frames().get(ident)
-                context.collect(frame)
+            self._sample_once()
 
             end = time.time()
             elapsed_time = math.ceil((end - start) * 1000) / 1000
@@ -119,3 +257,18 @@ def stop_timer():
     _timer.stop()
     _timer = None
 
+
+def _after_fork_in_child():
+    """
+    Restart the timer in the child process, the timer thread of the parent
+    process is not running in the child process.
+    """
+    global _lock
+
+    _lock = threading.Lock()
+    if _timer is not None:
+        _timer.after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -1,33 +1,537 @@
+import os
+import ssl
+import json
+import zlib
+import time
+import random
+import struct
+import asyncio
+import inspect
 import logging
+import weakref
 import threading
-from queue import Queue, Full
+from collections import deque
+from urllib.parse import urlparse
 from urllib.request import Request, urlopen, HTTPError
 
 from time import sleep
-from typing import Dict
+from typing import Any, Deque, Dict, List, Optional, Tuple
 
 
 logger = logging.getLogger(__name__)
 
+SpoolRecord = Tuple[str, Dict[str, str], bytes]
+
 
 class Transport(object):
-    def send(self, url: str, headers: Dict[str, str], data: bytes):
+    def send(self, url: str, headers: Dict[str, str], data: bytes, priority: int = 0):
+        """
+        :param priority:
+            The priority of the request, the client uses the execution time of the
+            sampling. It is used by the overflow policy to decide which request is
+            discarded when the transport is overloaded.
+        """
+        raise NotImplementedError
+
+    def start(self):
+        pass
+
+
+def accepts_priority(transport: Transport) -> bool:
+    """
+    Whether "transport.send" accepts the "priority" argument, the transports written
+    before it was added implement "send(url, headers, data)".
+    """
+    try:
+        parameters = inspect.signature(transport.send).parameters.values()
+    except (TypeError, ValueError):
+        return False
+
+    for parameter in parameters:
+        if parameter.kind == inspect.Parameter.VAR_KEYWORD:
+            return True
+        if parameter.name == "priority" and parameter.kind != inspect.Parameter.POSITIONAL_ONLY:
+            return True
+    return False
+
+
+class QueueItem(object):
+    __slots__ = ("url", "headers", "data", "priority", "enqueued_at")
+
+    def __init__(self, url: str, headers: Dict[str, str], data: bytes, priority: int = 0):
+        self.url = url
+        self.headers = headers
+        self.data = data
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+
+
+class OverflowPolicy(object):
+    """
+    Decide which request is discarded when the transport queue is overloaded.
+    """
+
+    def offer(
+        self, items: Deque[QueueItem], item: QueueItem, max_size: int
+    ) -> Optional[QueueItem]:
+        """
+        Put the item to the queue.
+
+        :param items:
+            The queued items.
+        :param item:
+            The new item.
+        :param max_size:
+            The maximum size of the queue, the value less than or equal to 0 means unlimited.
+        :return:
+            Returns the discarded item (maybe the new item itself), or None if nothing is discarded.
+        """
         raise NotImplementedError
 
 
+class DropNewestPolicy(OverflowPolicy):
+    """
+    Discard the new item if the queue is full.
+    """
+
+    def offer(self, items, item, max_size):
+        if 0 < max_size <= len(items):
+            return item
+        items.append(item)
+        return None
+
+
+class DropOldestPolicy(OverflowPolicy):
+    """
+    Discard the oldest item if the queue is full.
+    """
+
+    def offer(self, items, item, max_size):
+        discarded = None
+        if 0 < max_size <= len(items):
+            discarded = items.popleft()
+        items.append(item)
+        return discarded
+
+
+class KeepSlowestPolicy(OverflowPolicy):
+    """
+    Keep the N slowest items in the queue, N is the maximum size of the queue.
+    """
+
+    def offer(self, items, item, max_size):
+        if max_size <= 0 or len(items) < max_size:
+            items.append(item)
+            return None
+
+        fastest = min(items, key=lambda x: x.priority)
+        if fastest.priority >= item.priority:
+            return item
+        items.remove(fastest)
+        items.append(item)
+        return fastest
+
+
+class ExecutionTimeSamplingPolicy(DropNewestPolicy):
+    """
+    Sample the items by execution time once the queue is filled above the high watermark.
+
+    The item whose execution time is greater than or equal to "reference_time" is
+    always accepted, the faster item is accepted with the probability of
+    "execution_time / reference_time". The new item is discarded if the queue is full.
+    """
+
+    def __init__(self, reference_time: int = 1000, high_watermark: float = 0.5):
+        """
+        :param reference_time:
+            Reference execution time (in milliseconds).
+        :param high_watermark:
+            Start to sample once the queue size exceeds "max_size * high_watermark".
+        """
+        if reference_time <= 0:
+            raise ValueError("'reference_time' must be greater than 0")
+        self._reference_time = reference_time
+        self._high_watermark = high_watermark
+
+    def offer(self, items, item, max_size):
+        if 0 < max_size * self._high_watermark <= len(items):
+            if item.priority < random.random() * self._reference_time:
+                return item
+        return super().offer(items, item, max_size)
+
+
+class TransportStats(object):
+    """
+    Counters of the transport.
+
+        queued: the number of requests put to the queue
+        sent: the number of requests sent successfully
+        dropped: the number of requests discarded
+        failed: the number of requests failed to send
+        spooled: the number of requests stored to the disk spool
+    """
+
+    COUNTERS = ("queued", "sent", "dropped", "failed", "spooled")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(self.COUNTERS, 0)
+        self._latency_count = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def incr(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def observe_latency(self, latency: float):
+        with self._lock:
+            self._latency_count += 1
+            self._latency_total += latency
+            if latency > self._latency_max:
+                self._latency_max = latency
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Returns the counters and queue latency (in milliseconds).
+        """
+        with self._lock:
+            data = dict(self._counters)
+            count = self._latency_count
+            data["queue_latency_avg"] = self._latency_total / count * 1000 if count else 0.0
+            data["queue_latency_max"] = self._latency_max * 1000
+        return data
+
+
+def encode_record(url: str, headers: Dict[str, str], data: bytes) -> bytes:
+    """
+    Encode a request as a length-prefixed binary record.
+
+    Record format:
+        crc32(4) | url length(4) | headers length(4) | data length(4) | url | headers | data
+    """
+    url_bytes = url.encode("utf8")
+    headers_bytes = json.dumps(headers).encode("utf8")
+    payload = url_bytes + headers_bytes + data
+    header = struct.pack(
+        ">IIII", zlib.crc32(payload), len(url_bytes), len(headers_bytes), len(data)
+    )
+    return header + payload
+
+
+RECORD_HEADER_SIZE = struct.calcsize(">IIII")
+
+
+def decode_record(header: bytes, payload: bytes) -> Optional[SpoolRecord]:
+    """
+    Decode a record produced by "encode_record", returns None if the record is corrupted.
+    """
+    crc, url_len, headers_len, _ = struct.unpack(">IIII", header)
+    if zlib.crc32(payload) != crc:
+        return None
+
+    url = payload[:url_len].decode("utf8")
+    headers = json.loads(payload[url_len:url_len + headers_len].decode("utf8"))
+    data = payload[url_len + headers_len:]
+    return url, headers, data
+
+
+def record_payload_size(header: bytes) -> int:
+    _, url_len, headers_len, data_len = struct.unpack(">IIII", header)
+    return url_len + headers_len + data_len
+
+
+class DiskSpool(object):
+    """
+    A bounded, append-only spool on the local disk.
+
+    The records which cannot be delivered (the queue is full or the collector is down)
+    are appended to the segment files in the spool directory, and replayed in batches
+    once the collector is reachable again. The records survive a process restart,
+    the spool picks up the existing segment files in the directory.
+
+    The child processes use sub-directories named by their pids (see
+    "for_child_process"), the segment files left by the exited child processes are
+    adopted and replayed by the spool of the parent directory.
+    """
+
+    SEGMENT_SUFFIX = ".seg"
+
+    # The interval (in seconds) for looking for the segments of the exited children.
+    ADOPT_INTERVAL = 30
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int = 64 * 1024 * 1024,
+        segment_size: int = 4 * 1024 * 1024,
+    ):
+        """
+        :param directory:
+            The directory for storing segment files.
+        :param max_bytes:
+            The maximum size of all segment files, the new record will be rejected
+            once the spool is full.
+        :param segment_size:
+            Start a new segment file once the active segment exceeds this size.
+        """
+        if segment_size > max_bytes:
+            raise ValueError("'segment_size' must not be greater than 'max_bytes'")
+
+        self._directory = self._prepare_dir(directory)
+        self._root_directory = self._directory
+        self._max_bytes = max_bytes
+        self._segment_size = segment_size
+        self._lock = threading.Lock()
+        self._segments: List[str] = self._load_segments()
+        self._read_offset = 0
+        self._size = sum(os.path.getsize(path) for path in self._segments)
+        self._next_seq = self._segment_seq(self._segments[-1]) + 1 if self._segments else 0
+        self._next_adopt = 0.0
+        self._adopt_orphans()
+
+    def _prepare_dir(self, directory: str) -> str:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        elif not os.path.isdir(directory):
+            raise ValueError(f"'{directory}' is not a directory.")
+        return directory
+
+    def _load_segments(self, directory: Optional[str] = None) -> List[str]:
+        directory = directory or self._directory
+        names = [
+            name
+            for name in os.listdir(directory)
+            if name.endswith(self.SEGMENT_SUFFIX)
+        ]
+        names.sort(key=self._segment_seq)
+        return [os.path.join(directory, name) for name in names]
+
+    @classmethod
+    def _pid_exists(cls, pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            return True
+        return True
+
+    def _adopt_orphans(self):
+        """
+        Move the segment files of the exited child processes into the spool.
+        """
+        self._next_adopt = time.monotonic() + self.ADOPT_INTERVAL
+        # "os.kill" terminates the process on Windows, and there is no fork there.
+        if os.name != "posix":
+            return
+
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            if not name.isdigit() or not os.path.isdir(path) or self._pid_exists(int(name)):
+                continue
+
+            with self._lock:
+                for segment in self._load_segments(path):
+                    target = os.path.join(
+                        self._directory, f"{self._next_seq:020d}{self.SEGMENT_SUFFIX}"
+                    )
+                    try:
+                        os.rename(segment, target)
+                    except OSError as e:
+                        logger.error(f"Failed to adopt spool segment {segment}: {e}")
+                        continue
+                    self._next_seq += 1
+                    self._segments.append(target)
+                    self._size += os.path.getsize(target)
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+
+    @classmethod
+    def _segment_seq(cls, path: str) -> int:
+        return int(os.path.basename(path)[: -len(cls.SEGMENT_SUFFIX)])
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def for_child_process(self) -> "DiskSpool":
+        """
+        The spool must not be shared by multiple processes, the child process
+        uses a sub-directory of the root spool directory named by its pid.
+        """
+        directory = os.path.join(self._root_directory, str(os.getpid()))
+        spool = DiskSpool(directory, self._max_bytes, self._segment_size)
+        spool._root_directory = self._root_directory
+        return spool
+
+    def pending(self) -> bool:
+        if time.monotonic() >= self._next_adopt:
+            self._adopt_orphans()
+        with self._lock:
+            if not self._segments:
+                return False
+            if len(self._segments) > 1:
+                return True
+            return self._read_offset < os.path.getsize(self._segments[0])
+
+    def _active_segment(self, record_size: int) -> str:
+        if self._segments:
+            path = self._segments[-1]
+            if os.path.getsize(path) + record_size <= self._segment_size:
+                return path
+
+        path = os.path.join(self._directory, f"{self._next_seq:020d}{self.SEGMENT_SUFFIX}")
+        self._next_seq += 1
+        self._segments.append(path)
+        return path
+
+    def append(self, url: str, headers: Dict[str, str], data: bytes) -> bool:
+        """
+        Append a record to the spool.
+
+        :return:
+            Returns False if the spool is full or the record cannot be written.
+        """
+        record = encode_record(url, headers, data)
+        with self._lock:
+            if self._size + len(record) > self._max_bytes:
+                logger.warning("Disk spool is full, drop the record")
+                return False
+
+            try:
+                path = self._active_segment(len(record))
+                with open(path, "ab") as file:
+                    file.write(record)
+            except OSError as e:
+                logger.error(f"Failed to write record to disk spool: {e}")
+                return False
+
+            self._size += len(record)
+        return True
+
+    def _remove_oldest_segment(self):
+        path = self._segments.pop(0)
+        try:
+            self._size -= os.path.getsize(path)
+            os.remove(path)
+        except OSError as e:
+            logger.error(f"Failed to remove spool segment {path}: {e}")
+        self._read_offset = 0
+
+    def read_batch(self, max_records: int) -> List[SpoolRecord]:
+        """
+        Read at most "max_records" records from the oldest segments, the consumed
+        segments are removed from the disk.
+        """
+        records = []
+        with self._lock:
+            while self._segments and len(records) < max_records:
+                path = self._segments[0]
+                with open(path, "rb") as file:
+                    file.seek(self._read_offset)
+                    while len(records) < max_records:
+                        header = file.read(RECORD_HEADER_SIZE)
+                        if len(header) < RECORD_HEADER_SIZE:
+                            break
+
+                        payload_size = record_payload_size(header)
+                        payload = file.read(payload_size)
+                        record = None
+                        if len(payload) == payload_size:
+                            record = decode_record(header, payload)
+                        if record is None:
+                            logger.error(f"Discard the corrupted spool segment {path}")
+                            file.seek(0, os.SEEK_END)
+                            break
+                        records.append(record)
+
+                    self._read_offset = file.tell()
+                    exhausted = self._read_offset >= os.path.getsize(path)
+
+                if not exhausted:
+                    break
+                self._remove_oldest_segment()
+        return records
+
+
 class ThreadTransport(Transport):
-    def __init__(self, max_queue_size: int = -1, send_timeout: int = 5):
+    def __init__(
+        self,
+        max_queue_size: int = 1000,
+        send_timeout: int = 5,
+        spool: Optional[DiskSpool] = None,
+        replay_interval: int = 5,
+        replay_batch_size: int = 100,
+        overflow_policy: Optional[OverflowPolicy] = None,
+    ):
+        """
+        :param max_queue_size:
+            The maximum size of the in-memory queue, "-1" means unlimited.
+        :param send_timeout:
+            Timeout (in seconds) for sending a request.
+        :param spool:
+            If the spool is specified, the records that overflow the queue or
+            failed to send are stored to the spool, and replayed later.
+        :param replay_interval:
+            Interval (in seconds) for replaying the spooled records when idle,
+            and the minimum delay of replaying after a failed request.
+        :param replay_batch_size:
+            The maximum number of records replayed at once.
+        :param overflow_policy:
+            Decide which request is discarded when the queue is full,
+            the default policy is "DropNewestPolicy".
+        """
         self._thread = None
         self._active = False
         self._lock = threading.Lock()
         self._send_timeout = send_timeout
-        self._queue = Queue(max_queue_size)
+        self._max_queue_size = max_queue_size
+        self._queue: Deque[QueueItem] = deque()
+        self._not_empty = threading.Condition(threading.Lock())
+        self._policy = overflow_policy or DropNewestPolicy()
+        self._stats = TransportStats()
+        self._spool = spool
+        self._replay_interval = replay_interval
+        self._replay_batch_size = replay_batch_size
+        self._last_failure = 0.0
 
-    def send(self, url: str, headers: Dict[str, str], data: bytes):
-        try:
-            self._queue.put((url, headers, data), block=False)
-        except Full:
-            logger.warning("Thread transport queue is full")
+    def send(self, url: str, headers: Dict[str, str], data: bytes, priority: int = 0):
+        item = QueueItem(url, headers, data, priority)
+        with self._not_empty:
+            discarded = self._policy.offer(self._queue, item, self._max_queue_size)
+            if discarded is not item:
+                self._not_empty.notify()
+
+        if discarded is not item:
+            self._stats.incr("queued")
+        if discarded is not None:
+            self._discard(discarded)
+
+    def stats(self) -> Dict[str, Any]:
+        data = self._stats.snapshot()
+        data["queue_size"] = len(self._queue)
+        return data
+
+    def _discard(self, item: QueueItem):
+        if self._spool is not None and self._spool.append(item.url, item.headers, item.data):
+            self._stats.incr("spooled")
+            return
+        self._stats.incr("dropped")
+        logger.warning("Thread transport queue is full")
+
+    def _get(self, timeout: Optional[float]) -> Optional[QueueItem]:
+        with self._not_empty:
+            if not self._queue:
+                self._not_empty.wait(timeout)
+            if not self._queue:
+                return None
+            item = self._queue.popleft()
+
+        self._stats.observe_latency(time.monotonic() - item.enqueued_at)
+        return item
 
     def is_alive(self):
         return self._thread and self._thread.is_alive()
@@ -41,11 +545,30 @@ class ThreadTransport(Transport):
                 self._thread = threading.Thread(target=self._run, name=name)
                 self._thread.setDaemon(True)
                 self._thread.start()
+                _thread_transports.add(self)
         finally:
             self._lock.release()
 
+    def _after_fork(self):
+        """
+        Called in the child process after fork, the sending thread is restarted.
+        The queued requests are discarded, they are sent by the parent process.
+        """
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(threading.Lock())
+        self._queue = deque()
+        self._stats = TransportStats()
+        self._thread = None
+        if self._spool is not None:
+            self._spool = self._spool.for_child_process()
+        if self._active:
+            self.start()
+
     def stop(self, timeout: int = None):
         with self._lock:
+            self._active = False
+            with self._not_empty:
+                self._not_empty.notify_all()
             if self._thread:
                 self._thread.join(timeout=timeout)
                 self._thread = None
@@ -60,14 +583,374 @@ class ThreadTransport(Transport):
             raise
         return response
 
+    def _handle_failure(self, url: str, headers: Dict[str, str], data: bytes, err: Exception):
+        self._last_failure = time.monotonic()
+        self._stats.incr("failed")
+        # The request is rejected by the server, it will never succeed.
+        if isinstance(err, HTTPError) and err.code < 500:
+            return
+        if self._spool is not None and self._spool.append(url, headers, data):
+            self._stats.incr("spooled")
+
+    def _replay(self):
+        if self._spool is None:
+            return
+        if time.monotonic() - self._last_failure < self._replay_interval:
+            return
+        if not self._spool.pending():
+            return
+
+        records = self._spool.read_batch(self._replay_batch_size)
+        for index, (url, headers, data) in enumerate(records):
+            try:
+                self._send_request(url, headers, data)
+            except Exception as e:
+                logger.error(f"Failed to replay spooled request to {url}")
+                self._handle_failure(url, headers, data, e)
+                for record in records[index + 1:]:
+                    self._spool.append(*record)
+                return
+            self._stats.incr("sent")
+
     def _run(self):
+        timeout = self._replay_interval if self._spool is not None else None
         while self._active:
-            url, headers, data = self._queue.get()
+            item = self._get(timeout)
+            if item is None:
+                self._replay()
+                continue
+
             try:
-                self._send_request(url, headers, data)
+                self._send_request(item.url, item.headers, item.data)
+            except Exception as e:
+                logger.error(f"Failed to send request to {item.url}")
+                self._handle_failure(item.url, item.headers, item.data, e)
+            else:
+                self._stats.incr("sent")
+                self._replay()
+
+            sleep(0)
+
+
+_thread_transports: "weakref.WeakSet[ThreadTransport]" = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for transport in list(_thread_transports):
+        transport._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class AsyncTransport(Transport):
+    """
+    Send requests on the asyncio event loop of the application.
+
+    No extra thread is started, the requests are sent by a fixed number of worker
+    tasks using non-blocking sockets. Each worker takes a batch of queued requests
+    and sends them over one keep-alive connection.
+
+    The same as "ThreadTransport", the requests which overflow the queue or fail to
+    send are stored to the spool (if specified), and replayed by the idle workers.
+
+    Usage:
+        transport = AsyncTransport()
+        transport.start()  # in a coroutine, or pass the loop explicitly
+        client = Client("http://127.0.0.1:10002/project", transport)
+    """
+
+    def __init__(
+        self,
+        max_queue_size: int = 1000,
+        send_timeout: int = 5,
+        max_concurrency: int = 4,
+        batch_size: int = 32,
+        overflow_policy: Optional[OverflowPolicy] = None,
+        spool: Optional[DiskSpool] = None,
+        replay_interval: int = 5,
+    ):
+        """
+        :param max_queue_size:
+            The maximum number of queued requests, "-1" means unlimited.
+        :param send_timeout:
+            Timeout (in seconds) for sending a request.
+        :param max_concurrency:
+            The maximum number of concurrent connections.
+        :param batch_size:
+            The maximum number of requests sent over one connection at once.
+        :param overflow_policy:
+            Decide which request is discarded when the queue is full,
+            the default policy is "DropNewestPolicy".
+        :param spool:
+            If the spool is specified, the requests that overflow the queue or
+            failed to send are stored to the spool, and replayed later.
+        :param replay_interval:
+            Interval (in seconds) for replaying the spooled requests when idle,
+            and the minimum delay of replaying after a failed request.
+        """
+        if max_concurrency < 1:
+            raise ValueError("'max_concurrency' must be greater than 0")
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id = None
+        self._max_queue_size = max_queue_size
+        self._send_timeout = send_timeout
+        self._max_concurrency = max_concurrency
+        self._batch_size = batch_size
+        self._buffer: Deque[QueueItem] = deque()
+        self._policy = overflow_policy or DropNewestPolicy()
+        self._stats = TransportStats()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        self._ssl_context = None
+        self._spool = spool
+        self._replay_interval = replay_interval
+        self._last_failure = 0.0
+
+    def send(self, url: str, headers: Dict[str, str], data: bytes, priority: int = 0):
+        if self._loop is None:
+            logger.warning("Async transport is not started")
+            return
+
+        item = QueueItem(url, headers, data, priority)
+        if threading.get_ident() == self._loop_thread_id:
+            self._enqueue(item)
+        else:
+            self._loop.call_soon_threadsafe(self._enqueue, item)
+
+    def stats(self) -> Dict[str, Any]:
+        data = self._stats.snapshot()
+        data["queue_size"] = len(self._buffer)
+        return data
+
+    def is_alive(self):
+        return any(not worker.done() for worker in self._workers)
+
+    def start(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        """
+        Start the worker tasks on the given loop, by default the current event loop is used.
+        """
+        if self._loop is not None:
+            return
+
+        self._loop = loop or asyncio.get_event_loop()
+        if self._loop.is_running() and self._in_loop_thread():
+            self._start_workers()
+        else:
+            self._loop.call_soon_threadsafe(self._start_workers)
+
+    def stop(self):
+        """
+        Cancel the worker tasks, the queued requests will be discarded.
+        """
+        if self._loop is None:
+            return
+
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            self._loop.call_soon_threadsafe(worker.cancel)
+        self._loop = None
+
+    def _in_loop_thread(self) -> bool:
+        try:
+            return asyncio.get_event_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def _start_workers(self):
+        self._loop_thread_id = threading.get_ident()
+        self._wakeup = asyncio.Event()
+        if self._buffer:
+            self._wakeup.set()
+        for _ in range(0, self._max_concurrency):
+            self._workers.append(self._loop.create_task(self._run()))
+
+    def _enqueue(self, item: QueueItem):
+        discarded = self._policy.offer(self._buffer, item, self._max_queue_size)
+        if discarded is not None:
+            self._discard(discarded)
+        if discarded is item:
+            return
+
+        self._stats.incr("queued")
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _discard(self, item: QueueItem):
+        if self._spool is not None and self._spool.append(item.url, item.headers, item.data):
+            self._stats.incr("spooled")
+            return
+        self._stats.incr("dropped")
+        logger.warning("Async transport queue is full")
+
+    def _handle_failure(self, item: QueueItem, err: Exception):
+        self._last_failure = time.monotonic()
+        self._stats.incr("failed")
+        # The request is rejected by the server, it will never succeed.
+        if isinstance(err, HTTPError) and err.code < 500:
+            return
+        if self._spool is not None and self._spool.append(item.url, item.headers, item.data):
+            self._stats.incr("spooled")
+
+    async def _replay(self):
+        if self._spool is None:
+            return
+        if time.monotonic() - self._last_failure < self._replay_interval:
+            return
+        if not self._spool.pending():
+            return
+
+        records = self._spool.read_batch(self._batch_size)
+        await self._send_batch([QueueItem(url, headers, data) for url, headers, data in records])
+
+    async def _wait(self):
+        if self._spool is None:
+            await self._wakeup.wait()
+            return
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=self._replay_interval)
+        except asyncio.TimeoutError:
+            pass
+
+    def _take_batch(self) -> List[QueueItem]:
+        batch = []
+        now = time.monotonic()
+        while self._buffer and len(batch) < self._batch_size:
+            item = self._buffer.popleft()
+            self._stats.observe_latency(now - item.enqueued_at)
+            batch.append(item)
+        return batch
+
+    async def _run(self):
+        while True:
+            await self._wait()
+            batch = self._take_batch()
+            if not batch:
+                self._wakeup.clear()
+
+            try:
+                if batch:
+                    await self._send_batch(batch)
+                await self._replay()
+            except asyncio.CancelledError:
+                raise
             except Exception:
-                logger.error(f"Failed to send request to {url}")
+                logger.error("Failed to send requests", exc_info=True)
+
+    def _get_ssl_context(self) -> ssl.SSLContext:
+        if self._ssl_context is None:
+            self._ssl_context = ssl.create_default_context()
+        return self._ssl_context
+
+    async def _open_connection(self, scheme: str, host: str, port: int):
+        ssl_context = self._get_ssl_context() if scheme == "https" else None
+        return await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl_context),
+            timeout=self._send_timeout,
+        )
+
+    async def _send_batch(self, batch: List[QueueItem]):
+        origins = {}
+        for item in batch:
+            ret = urlparse(item.url)
+            port = ret.port or (443 if ret.scheme == "https" else 80)
+            origins.setdefault((ret.scheme, ret.hostname, port), []).append((ret, item))
+
+        for (scheme, host, port), items in origins.items():
+            writer = None
+            try:
+                for index, (ret, item) in enumerate(items):
+                    try:
+                        if writer is None:
+                            reader, writer = await self._open_connection(scheme, host, port)
+                        keep_alive = await asyncio.wait_for(
+                            self._send_request(reader, writer, ret, item.headers, item.data),
+                            timeout=self._send_timeout,
+                        )
+                    except HTTPError as e:
+                        # The response is read, only this request failed.
+                        self._handle_failure(item, e)
+                        keep_alive = False
+                    except (
+                        OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError
+                    ) as e:
+                        logger.error(f"Failed to send request to {scheme}://{host}:{port}")
+                        for _, rest in items[index:]:
+                            self._handle_failure(rest, e)
+                        break
+                    else:
+                        self._stats.incr("sent")
+
+                    if not keep_alive:
+                        writer.close()
+                        writer = None
             finally:
-                self._queue.task_done()
+                if writer is not None:
+                    writer.close()
 
-            sleep(0)
+    async def _send_request(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        url,
+        headers: Dict[str, str],
+        data: bytes,
+    ) -> bool:
+        """
+        Send a POST request and read the response.
+
+        :return:
+            Returns True if the connection can be reused.
+        :raise HTTPError: The server responds with an error status.
+        """
+        path = url.path or "/"
+        if url.query:
+            path = f"{path}?{url.query}"
+
+        lines = [
+            f"POST {path} HTTP/1.1",
+            f"Host: {url.netloc}",
+            f"Content-Length: {len(data)}",
+            "Connection: keep-alive",
+        ]
+        lines.extend(f"{key}: {value}" for key, value in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + data)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        parts = status_line.decode("latin-1").split(" ", 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise ValueError(f"invalid status line {status_line!r}")
+        version, status = parts[0], int(parts[1])
+
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            response_headers[key.strip().lower()] = value.strip()
+
+        keep_alive = version == "HTTP/1.1"
+        if response_headers.get("connection", "").lower() == "close":
+            keep_alive = False
+
+        if "content-length" in response_headers:
+            await reader.readexactly(int(response_headers["content-length"]))
+        elif response_headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        else:
+            await reader.read()
+            keep_alive = False
+
+        if status >= 400:
+            logger.error(f"HTTP Error {status} from {url.geturl()}")
+            reason = parts[2].strip() if len(parts) > 2 else ""
+            raise HTTPError(url.geturl(), status, reason, response_headers, None)
+        return keep_alive
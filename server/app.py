@@ -2,26 +2,47 @@ import optparse
 import os
 import sys
 import zlib
+import base64
+import binascii
+import gzip
 import json
+import time
+import atexit
+import bisect
+import hashlib
+import functools
+import re
+import struct
 import logging
 import datetime
+import threading
 import subprocess
-from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+from collections import deque, OrderedDict
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
 from tempfile import NamedTemporaryFile
 
 import flask_admin
 from flask_admin import expose
 from flask_admin.babel import gettext
 from flask_admin.contrib.sqla import ModelView
+from flask_admin.contrib.sqla.filters import DateTimeBetweenFilter, IntGreaterFilter
 from flask import Flask, Response, request, jsonify, Blueprint, flash
 from flask_admin.helpers import get_redirect_target
 from flask_admin.model.filters import BaseFilter
 from flask_admin.model.helpers import get_mdict_item_or_list
-from sqlalchemy import UniqueConstraint, BigInteger, Text
-from sqlalchemy.dialects.mysql import LONGTEXT
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import UniqueConstraint, Index, BigInteger, Text, LargeBinary, Table, func, inspect, select, text
+from sqlalchemy import event
+from sqlalchemy.dialects.mysql import LONGTEXT, LONGBLOB, insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import Column, Boolean, Integer, String, DateTime
 from marshmallow import Schema, fields, validate
+from sqlalchemy.orm import defer
 from sqlalchemy.orm.exc import NoResultFound
 from werkzeug.exceptions import BadRequest
 from flask_sqlalchemy import SQLAlchemy
@@ -31,15 +52,65 @@ app = Flask("PySample")
 errors = Blueprint("errors", __name__)
 logger = logging.getLogger(__name__)
 
+# The storage of the sampling records:
+#   sql: the database configured by "DATABASE_URI".
+#   embedded: the append-only segment files under "STORAGE_PATH", no database
+#             is required, see "EmbeddedStorage".
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sql").lower()
+if STORAGE_BACKEND not in ("sql", "embedded"):
+    raise ValueError(f"Unknown 'STORAGE_BACKEND': {STORAGE_BACKEND}")
+STORAGE_PATH = os.environ.get("STORAGE_PATH")
+if STORAGE_BACKEND == "embedded" and not STORAGE_PATH:
+    raise ValueError("'STORAGE_PATH' is not configured.")
+
 # example: mysql+pymysql://{user}:{password}@{host}/{database}?charset=utf8mb4
-if "DATABASE_URI" not in os.environ:
-    raise ValueError("'DATABASE_URI' is not configured.")
-else:
+if "DATABASE_URI" in os.environ:
     SQLALCHEMY_DATABASE_URI = os.environ["DATABASE_URI"]
+elif STORAGE_BACKEND == "embedded":
+    # The database is not used by the embedded storage.
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+else:
+    raise ValueError("'DATABASE_URI' is not configured.")
 
 # example: /root/FlameGraph/flamegraph.pl
 FLAMEGRAPH_PATH = os.environ.get("FLAMEGRAPH_PATH")
 
+# The maximum size (in bytes) of the rendered flame graphs cached in memory,
+# and the optional directory for caching the rendered flame graphs on the disk.
+FLAMEGRAPH_CACHE_SIZE = int(os.environ.get("FLAMEGRAPH_CACHE_SIZE", 64 * 1024 * 1024))
+FLAMEGRAPH_CACHE_DIR = os.environ.get("FLAMEGRAPH_CACHE_DIR")
+
+# Write-behind ingestion: the sampling records are validated and queued, and
+# written to the database in batches by background writers.
+ASYNC_INGEST = os.environ.get("ASYNC_INGEST", "").lower() in ("1", "true", "yes")
+INGEST_QUEUE_SIZE = int(os.environ.get("INGEST_QUEUE_SIZE", 10000))
+INGEST_WRITERS = int(os.environ.get("INGEST_WRITERS", 2))
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 500))
+
+# How the stack information is stored:
+#   blob: zlib compressed folded text per record.
+#   dedup: the distinct stacks are stored once in the "stacks" table, and each
+#          record refers to them with (stack_id, count) rows.
+STACK_STORAGE = os.environ.get("STACK_STORAGE", "blob").lower()
+if STACK_STORAGE not in ("blob", "dedup"):
+    raise ValueError(f"Unknown 'STACK_STORAGE': {STACK_STORAGE}")
+# The number of stack hashes whose id is cached in memory.
+STACK_CACHE_SIZE = int(os.environ.get("STACK_CACHE_SIZE", 100000))
+
+# Index the functions of the records at ingest time, so the records which contain
+# a function can be found, see "/sample/function". Disabled by default, it parses
+# and interns the stacks of every record and adds a row per function and record.
+FUNCTION_INDEX_ENABLED = os.environ.get("FUNCTION_INDEX_ENABLED", "0").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+# Maintain the hourly rollups of the stacks per (project, name) at ingest time,
+# they are used by the aggregate api. Disabled by default, it parses and interns
+# the stacks of every record.
+ROLLUP_ENABLED = os.environ.get("ROLLUP_ENABLED", "0").lower() in ("1", "true", "yes")
+
 app.config["SECRET_KEY"] = "1234567890"
 app.config["SQLALCHEMY_DATABASE_URI"] = SQLALCHEMY_DATABASE_URI
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -56,17 +127,338 @@ class SampleRecord(db.Model):
     name = Column(String(length=255), nullable=False)
     process_id = Column(Integer, nullable=False)
     thread_id = Column(BigInteger, nullable=False)
-    stack_info = Column(LONGTEXT, nullable=False)
+    # Legacy uncompressed stack information, only the rows stored before the
+    # compressed storage is introduced use this column. See "migrate_stack_info".
+    stack_info = Column(Text().with_variant(LONGTEXT, "mysql"), nullable=True)
+    # zlib compressed stack information
+    stack_data = Column(LargeBinary().with_variant(LONGBLOB, "mysql"), nullable=True)
     created_at = Column(DateTime, nullable=False)
     execution_time = Column(Integer, nullable=False)
+    # Whether the stacks are added to the rollups, see "compact_records".
+    rolled_up = Column(Boolean, nullable=True)
 
     __table_args__ = (
         UniqueConstraint("project", "sample_id", name="uk_project_sample_id"),
+        # for searching the records of an endpoint in a time range
+        Index("idx_project_name_created_at", "project", "name", "created_at"),
+        # for searching the records of a project in a time range
+        Index("idx_project_created_at", "project", "created_at"),
+        # for searching the slowest records of a project
+        Index("idx_project_execution_time", "project", "execution_time"),
     )
 
     def __unicode__(self):
         return self.name
 
+    def get_stack_data(self) -> bytes:
+        """
+        Returns the zlib compressed stack information.
+        """
+        if self.stack_data is not None:
+            return self.stack_data
+        # The legacy rows and the deduplicated rows, see "get_stack_info".
+        return compress_stack_info(self.get_stack_info())
+
+    def get_stack_info(self) -> str:
+        if self.stack_data is not None:
+            return decompress_stack_info(self.stack_data)
+        if self.stack_info is not None:
+            return self.stack_info
+        return load_record_stacks(self.id)
+
+
+class SampleStack(db.Model):
+    """
+    A distinct folded stack, shared by all the records which contain it.
+    """
+
+    __tablename__ = "stacks"
+
+    id = Column(Integer, primary_key=True)
+    # sha1 of the frames
+    hash = Column(String(length=40), nullable=False)
+    frames = Column(Text().with_variant(LONGTEXT, "mysql"), nullable=False)
+
+    __table_args__ = (UniqueConstraint("hash", name="uk_hash"),)
+
+
+class SampleRecordStack(db.Model):
+    """
+    The number of samples of a stack in a record.
+    """
+
+    __tablename__ = "sample_record_stacks"
+
+    record_id = Column(Integer, primary_key=True, autoincrement=False)
+    stack_id = Column(Integer, primary_key=True, autoincrement=False)
+    count = Column(Integer, nullable=False)
+
+    __table_args__ = (Index("idx_stack_id", "stack_id"),)
+
+
+class SampleRollup(db.Model):
+    """
+    The total count of a stack in the records of (project, name) in a period.
+    """
+
+    __tablename__ = "sample_rollups"
+
+    id = Column(Integer, primary_key=True)
+    project = Column(String(length=64), nullable=False)
+    name = Column(String(length=255), nullable=False)
+    # the length of the period in seconds
+    period = Column(Integer, nullable=False)
+    period_start = Column(DateTime, nullable=False)
+    stack_id = Column(Integer, nullable=False)
+    count = Column(BigInteger, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint(
+            "project", "name", "period_start", "period", "stack_id", name="uk_rollup"
+        ),
+        Index("idx_project_period_start", "project", "period_start"),
+    )
+
+
+class SampleFunction(db.Model):
+    """
+    A distinct function (name and filename) in the stacks.
+    """
+
+    __tablename__ = "functions"
+
+    id = Column(Integer, primary_key=True)
+    # sha1 of "{name} ({filename})"
+    hash = Column(String(length=40), nullable=False)
+    name = Column(String(length=255), nullable=False)
+    filename = Column(Text, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint("hash", name="uk_hash"),
+        Index("idx_name", "name"),
+    )
+
+
+class FunctionSample(db.Model):
+    """
+    The weights of a function in a record.
+
+    "self_count" is the number of samples in the function itself, "total_count"
+    is the number of samples in the function and its callees.
+    """
+
+    __tablename__ = "function_samples"
+
+    function_id = Column(Integer, primary_key=True, autoincrement=False)
+    record_id = Column(Integer, primary_key=True, autoincrement=False)
+    self_count = Column(Integer, nullable=False)
+    total_count = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index("idx_function_total_count", "function_id", "total_count"),
+        Index("idx_record_id", "record_id"),
+    )
+
+
+# The period of the rollups maintained at ingest time.
+ROLLUP_PERIOD = 3600
+
+
+def compress_stack_info(stack_info: str) -> bytes:
+    return zlib.compress(stack_info.encode("utf8"), 6)
+
+
+def decompress_stack_info(stack_data: bytes) -> str:
+    return zlib.decompress(stack_data).decode("utf8")
+
+
+def hash_text(value: str) -> str:
+    return hashlib.sha1(value.encode("utf8")).hexdigest()
+
+
+def parse_folded_stacks(stack_info: str) -> Optional[Dict[str, int]]:
+    """
+    Parse the folded stack information ("frame;frame;... count" per line).
+
+    :return:
+        Returns the count of each stack, or None if the stack information
+        is not in the folded format.
+    """
+    stacks = {}
+    for line in stack_info.splitlines():
+        if not line:
+            continue
+        frames, _, count = line.rpartition(" ")
+        if not frames or not count.isdigit():
+            return None
+        stacks[frames] = stacks.get(frames, 0) + int(count)
+    return stacks
+
+
+def format_folded_stacks(stacks: List[Tuple[str, int]]) -> str:
+    return "".join(f"{frames} {count}\n" for frames, count in stacks)
+
+
+# "{name} ({filename}:{lineno})", see "dump_traceback" in sample_counter.c
+FRAME_PATTERN = re.compile(r"^(.*) \((.*):(\d+)\)$")
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_function(frame: str) -> Tuple[str, str]:
+    """
+    Returns the (name, filename) of the frame.
+    """
+    match = FRAME_PATTERN.match(frame)
+    if match is None:
+        return frame, ""
+    return match.group(1), match.group(2)
+
+
+def function_weights(stacks: Dict[str, int]) -> Dict[Tuple[str, str], List[int]]:
+    """
+    Compute the [self_count, total_count] of each function in the stacks.
+    """
+    weights: Dict[Tuple[str, str], List[int]] = {}
+    for frames, count in stacks.items():
+        functions = [parse_function(frame) for frame in frames.split(";") if frame]
+        if not functions:
+            continue
+        # The recursive functions are counted once in a stack.
+        for function in set(functions):
+            weights.setdefault(function, [0, 0])[1] += count
+        weights[functions[-1]][0] += count
+    return weights
+
+
+def load_record_stacks(record_id: int) -> str:
+    """
+    Reconstruct the folded stack information of a deduplicated record.
+    """
+    rows = db.session.execute(
+        select([SampleStack.__table__.c.frames, SampleRecordStack.__table__.c.count])
+        .select_from(
+            SampleRecordStack.__table__.join(
+                SampleStack.__table__,
+                SampleRecordStack.__table__.c.stack_id == SampleStack.__table__.c.id,
+            )
+        )
+        .where(SampleRecordStack.__table__.c.record_id == record_id)
+        .order_by(SampleRecordStack.__table__.c.stack_id)
+    ).fetchall()
+    return format_folded_stacks(rows)
+
+
+class HashInterner:
+    """
+    Map the values to their ids in a content-addressed table (which has the unique
+    "hash" column), the missing values are inserted.
+
+    The values are immutable, so the ids of the recently used hashes are cached
+    in memory, the values seen before are resolved without querying the database.
+    The missing values are inserted in the transaction of the caller, their ids are
+    only cached once the transaction is committed.
+    """
+
+    def __init__(
+        self,
+        table: Table,
+        cache_size: int,
+        key_text: Callable[[Any], str],
+        make_row: Callable[[Any], Dict[str, Any]],
+    ):
+        """
+        :param table:
+            The content-addressed table.
+        :param cache_size:
+            The number of the hashes whose id is cached.
+        :param key_text:
+            Returns the text of the value, the hash is computed from it.
+        :param make_row:
+            Returns the columns (except "hash") of the value.
+        """
+        self._table = table
+        self._cache_size = cache_size
+        self._key_text = key_text
+        self._make_row = make_row
+        self._lock = threading.Lock()
+        self._ids: "OrderedDict[str, int]" = OrderedDict()
+
+    def intern(self, values: List[Any]) -> Dict[Any, int]:
+        """
+        Returns the id of each value. The caller commits the transaction.
+        """
+        hashes = {value: hash_text(self._key_text(value)) for value in values}
+        ids = {}
+        missing = {}
+        with self._lock:
+            for value, digest in hashes.items():
+                row_id = self._ids.get(digest)
+                if row_id is None:
+                    missing[digest] = value
+                else:
+                    self._ids.move_to_end(digest)
+                    ids[digest] = row_id
+
+        if missing:
+            table = self._table
+            # sorted, so the concurrent writers lock the hashes in the same order
+            digests = sorted(missing)
+            rows = [{"hash": digest, **self._make_row(missing[digest])} for digest in digests]
+            insert_ignore(table, rows)
+            found = {}
+            for i in range(0, len(digests), INSERT_CHUNK_SIZE):
+                found.update(
+                    db.session.execute(
+                        select([table.c.hash, table.c.id]).where(
+                            table.c.hash.in_(digests[i:i + INSERT_CHUNK_SIZE])
+                        )
+                    ).fetchall()
+                )
+            ids.update(found)
+            db.session.info.setdefault(INTERNED_SESSION_KEY, []).append((self, found))
+
+        return {value: ids[digest] for value, digest in hashes.items()}
+
+    def _cache(self, found: Dict[str, int]):
+        with self._lock:
+            for digest, row_id in found.items():
+                self._ids[digest] = row_id
+            while len(self._ids) > self._cache_size:
+                self._ids.popitem(last=False)
+
+
+# The ids resolved by "HashInterner.intern" in the current transaction of the session.
+INTERNED_SESSION_KEY = "pysample_interned"
+
+
+def _cache_interned(session):
+    for interner, found in session.info.pop(INTERNED_SESSION_KEY, ()):
+        interner._cache(found)
+
+
+def _discard_interned(session, previous_transaction):
+    # The inserted values are rolled back, their ids must not be cached.
+    session.info.pop(INTERNED_SESSION_KEY, None)
+
+
+event.listen(db.session, "after_commit", _cache_interned)
+event.listen(db.session, "after_soft_rollback", _discard_interned)
+
+
+stack_interner = HashInterner(
+    SampleStack.__table__,
+    STACK_CACHE_SIZE,
+    key_text=lambda frames: frames,
+    make_row=lambda frames: {"frames": frames},
+)
+
+function_interner = HashInterner(
+    SampleFunction.__table__,
+    STACK_CACHE_SIZE,
+    key_text=lambda function: f"{function[0]} ({function[1]})",
+    make_row=lambda function: {"name": function[0][:255], "filename": function[1]},
+)
+
 
 class AddSampleInputSchema(Schema):
     sample_id = fields.Str(
@@ -104,10 +496,891 @@ def handle_error(error):
 add_sample_schema = AddSampleInputSchema()
 
 
+# The maximum number of records accepted by the batch api.
+MAX_BATCH_SIZE = 1000
+# The maximum number of rows inserted by one executemany.
+INSERT_CHUNK_SIZE = 500
+
+
 def timestamp_to_localtime(timestamp: float) -> datetime.datetime:
     return datetime.datetime.fromtimestamp(timestamp)
 
 
+def decode_request_data() -> Any:
+    req_data = request.data
+    try:
+        raw_data = zlib.decompress(req_data)
+        return json.loads(raw_data)
+    except (TypeError, zlib.error, json.JSONDecodeError) as e:
+        raise BadRequest(str(e))
+
+
+def _is_int(value: Any) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def validate_sample_fast(data: Any) -> Optional[str]:
+    """
+    Validate the sampling record without marshmallow, it is equivalent to
+    "AddSampleInputSchema" and used by the batch api.
+
+    :return:
+        Returns the error message, or None if the record is valid.
+    """
+    if not isinstance(data, dict):
+        return "record must be an object"
+
+    sample_id = data.get("sample_id")
+    if not isinstance(sample_id, str) or len(sample_id) != 32:
+        return "'sample_id' must be a string of length 32"
+    name = data.get("name")
+    if not isinstance(name, str) or not 1 <= len(name) <= 255:
+        return "'name' must be a string of length between 1 and 255"
+    if not isinstance(data.get("stack_info"), str):
+        return "'stack_info' must be a string"
+    for field in ("process_id", "thread_id", "execution_time"):
+        if not _is_int(data.get(field)):
+            return f"'{field}' must be an integer"
+    timestamp = data.get("timestamp")
+    if not isinstance(timestamp, (int, float)) or isinstance(timestamp, bool):
+        return "'timestamp' must be a number"
+    return None
+
+
+def insert_ignore(table: Table, rows: List[Dict[str, Any]]) -> int:
+    """
+    Insert the rows, the rows which violate a unique constraint are ignored.
+    The caller commits the transaction.
+
+    The rows are inserted with "executemany" of one compiled statement, compiling a
+    multi-row VALUES clause costs a bind parameter per value. The drivers batch the
+    rows themselves (e.g. pymysql rewrites them into multi-row inserts).
+
+    :return:
+        Returns the number of inserted rows.
+    """
+    if db.engine.dialect.name == "postgresql":
+        stmt = postgresql_insert(table).on_conflict_do_nothing()
+    else:
+        stmt = (
+            table.insert()
+            .prefix_with("IGNORE", dialect="mysql")
+            .prefix_with("OR IGNORE", dialect="sqlite")
+        )
+    inserted = 0
+    for i in range(0, len(rows), INSERT_CHUNK_SIZE):
+        result = db.session.execute(stmt, rows[i:i + INSERT_CHUNK_SIZE])
+        inserted += max(result.rowcount, 0)
+    return inserted
+
+
+# The key of the parsed stacks in the record row, it is not a column.
+ROW_STACKS = "_stacks"
+
+
+def build_record_row(project: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Build the row of "sample_records" from the sampling record.
+
+    With the sql storage, if the "dedup" stack storage, the rollups or the function
+    index is enabled, the parsed stacks are kept in the row under the "ROW_STACKS"
+    key and used by "insert_record_rows".
+    The stack information which is not in the folded format is always stored
+    compressed.
+    """
+    stacks = None
+    if STORAGE_BACKEND == "sql" and (
+        STACK_STORAGE == "dedup" or ROLLUP_ENABLED or FUNCTION_INDEX_ENABLED
+    ):
+        stacks = parse_folded_stacks(data["stack_info"])
+    deduplicated = STACK_STORAGE == "dedup" and stacks is not None
+
+    return {
+        "project": project,
+        "sample_id": data["sample_id"],
+        "name": data["name"],
+        "process_id": data["process_id"],
+        "thread_id": data["thread_id"],
+        "created_at": timestamp_to_localtime(data["timestamp"]),
+        "stack_data": None if deduplicated else compress_stack_info(data["stack_info"]),
+        "execution_time": data["execution_time"],
+        # Set by "_claim_rollup_records" in the transaction which inserts the record.
+        "rolled_up": False,
+        ROW_STACKS: stacks,
+    }
+
+
+def insert_record_stacks(
+    record_stacks: List[Tuple[int, Dict[str, int]]],
+    stack_ids: Optional[Dict[str, int]] = None,
+):
+    """
+    Insert the (record_id, stack_id, count) rows of the records. The caller
+    commits the transaction.
+
+    :param record_stacks:
+        The record ids and the count of each stack in the records.
+    :param stack_ids:
+        The stack ids returned by "stack_interner", the stacks are interned
+        if not specified.
+    """
+    if stack_ids is None:
+        frames_list = dict.fromkeys(frames for _, stacks in record_stacks for frames in stacks)
+        stack_ids = stack_interner.intern(list(frames_list))
+    rows = [
+        {"record_id": record_id, "stack_id": stack_ids[frames], "count": count}
+        for record_id, stacks in record_stacks
+        for frames, count in stacks.items()
+    ]
+    insert_ignore(SampleRecordStack.__table__, rows)
+
+
+def _insert_deduplicated_stacks(rows: List[Dict[str, Any]], stack_ids: Dict[str, int]):
+    table = SampleRecord.__table__
+    by_project: Dict[str, Dict[str, Dict[str, int]]] = {}
+    for row in rows:
+        if row[ROW_STACKS] is not None:
+            by_project.setdefault(row["project"], {})[row["sample_id"]] = row[ROW_STACKS]
+
+    record_stacks = []
+    for project, stacks in by_project.items():
+        sample_ids = list(stacks)
+        for i in range(0, len(sample_ids), INSERT_CHUNK_SIZE):
+            # The duplicated records stored compressed are skipped.
+            result = db.session.execute(
+                select([table.c.id, table.c.sample_id]).where(
+                    table.c.project == project,
+                    table.c.sample_id.in_(sample_ids[i:i + INSERT_CHUNK_SIZE]),
+                    table.c.stack_data.is_(None),
+                    table.c.stack_info.is_(None),
+                )
+            )
+            record_stacks.extend((record_id, stacks[sample_id]) for record_id, sample_id in result)
+    insert_record_stacks(record_stacks, stack_ids)
+
+
+def period_start(created_at: datetime.datetime, period: int) -> datetime.datetime:
+    seconds = created_at.hour * 3600 + created_at.minute * 60 + created_at.second
+    start = created_at.replace(hour=0, minute=0, second=0, microsecond=0)
+    return start + datetime.timedelta(seconds=seconds - seconds % period)
+
+
+def upsert_rollup_rows(rows: List[Dict[str, Any]]):
+    """
+    Add the counts of the rows to the rollups, the missing rollups are inserted.
+    The caller commits the transaction.
+    """
+    table = SampleRollup.__table__
+    keys = ["project", "name", "period_start", "period", "stack_id"]
+    dialect = db.engine.dialect.name
+    if dialect == "mysql":
+        stmt = mysql_insert(table)
+        stmt = stmt.on_duplicate_key_update(count=table.c.count + stmt.inserted.count)
+    elif dialect in ("sqlite", "postgresql"):
+        stmt = (sqlite_insert if dialect == "sqlite" else postgresql_insert)(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=keys, set_={"count": table.c.count + stmt.excluded.count}
+        )
+    else:
+        for row in rows:
+            result = db.session.execute(
+                table.update()
+                .where(*[table.c[key] == row[key] for key in keys])
+                .values(count=table.c.count + row["count"])
+            )
+            if not result.rowcount:
+                db.session.execute(table.insert().values(row))
+        return
+
+    for i in range(0, len(rows), INSERT_CHUNK_SIZE):
+        db.session.execute(stmt, rows[i:i + INSERT_CHUNK_SIZE])
+
+
+def _claim_rollup_records(rows: List[Dict[str, Any]]) -> set:
+    """
+    Mark the records of the rows which are not rolled up yet as rolled up, and return
+    their (project, sample_id). It runs after the records are inserted in the same
+    transaction, so a record inserted by a concurrent writer (committed with the flag
+    set, or not visible yet) is never claimed twice.
+    """
+    table = SampleRecord.__table__
+    sample_ids: Dict[str, List[str]] = {}
+    for row in rows:
+        if row[ROW_STACKS] is not None:
+            sample_ids.setdefault(row["project"], []).append(row["sample_id"])
+
+    claimed = set()
+    for project, ids in sample_ids.items():
+        for i in range(0, len(ids), INSERT_CHUNK_SIZE):
+            result = db.session.execute(
+                select([table.c.id, table.c.sample_id])
+                .where(
+                    table.c.project == project,
+                    table.c.sample_id.in_(ids[i:i + INSERT_CHUNK_SIZE]),
+                    table.c.rolled_up.is_(False),
+                )
+                .with_for_update()
+            ).fetchall()
+            if not result:
+                continue
+            db.session.execute(
+                table.update()
+                .where(table.c.id.in_([row_id for row_id, _ in result]))
+                .values(rolled_up=True)
+            )
+            claimed.update((project, sample_id) for _, sample_id in result)
+    return claimed
+
+
+def _update_rollups(rows: List[Dict[str, Any]], stack_ids: Dict[str, int]):
+    """
+    Add the stacks of the rows to the rollups, the rows of one record are only
+    counted once.
+    """
+    counts: Dict[Tuple[str, str, datetime.datetime, int], int] = {}
+    seen = set()
+    for row in rows:
+        key = (row["project"], row["sample_id"])
+        if row[ROW_STACKS] is None or key in seen:
+            continue
+        seen.add(key)
+        start = period_start(row["created_at"], ROLLUP_PERIOD)
+        for frames, count in row[ROW_STACKS].items():
+            rollup_key = (row["project"], row["name"], start, stack_ids[frames])
+            counts[rollup_key] = counts.get(rollup_key, 0) + count
+
+    upsert_rollup_rows(
+        [
+            {
+                "project": project,
+                "name": name,
+                "period": ROLLUP_PERIOD,
+                "period_start": start,
+                "stack_id": stack_id,
+                "count": count,
+            }
+            # sorted, so the concurrent writers lock the rollups in the same order
+            for (project, name, start, stack_id), count in sorted(counts.items())
+        ]
+    )
+
+
+def _index_functions(
+    weights: Dict[Tuple[str, str], Dict[Tuple[str, str], List[int]]],
+    function_ids: Dict[Tuple[str, str], int],
+):
+    # The rows of the duplicated records already exist and are ignored.
+    table = SampleRecord.__table__
+
+    record_ids = {}
+    by_project: Dict[str, List[str]] = {}
+    for project, sample_id in weights:
+        by_project.setdefault(project, []).append(sample_id)
+    for project, sample_ids in by_project.items():
+        for i in range(0, len(sample_ids), INSERT_CHUNK_SIZE):
+            result = db.session.execute(
+                select([table.c.id, table.c.sample_id]).where(
+                    table.c.project == project,
+                    table.c.sample_id.in_(sample_ids[i:i + INSERT_CHUNK_SIZE]),
+                )
+            )
+            record_ids.update(((project, sample_id), row_id) for row_id, sample_id in result)
+
+    values = [
+        {
+            "function_id": function_ids[function],
+            "record_id": record_ids[key],
+            "self_count": self_count,
+            "total_count": total_count,
+        }
+        for key, record in weights.items()
+        if key in record_ids
+        for function, (self_count, total_count) in record.items()
+    ]
+    insert_ignore(FunctionSample.__table__, values)
+
+
+def insert_record_rows(rows: List[Dict[str, Any]]) -> int:
+    """
+    Insert the rows in batches, the rows whose
+    (project, sample_id) already exists are ignored.
+
+    The stacks and functions are interned, and the stacks of the new records are
+    added to the rollups and the function index, all in the same transaction.
+
+    :return:
+        Returns the number of inserted rows.
+    """
+    frames_list = dict.fromkeys(frames for row in rows for frames in (row[ROW_STACKS] or ()))
+    stack_ids = stack_interner.intern(list(frames_list)) if frames_list else None
+    weights = {}
+    if stack_ids and FUNCTION_INDEX_ENABLED:
+        for row in rows:
+            if row[ROW_STACKS]:
+                weights[(row["project"], row["sample_id"])] = function_weights(row[ROW_STACKS])
+        functions = dict.fromkeys(f for record in weights.values() for f in record)
+        function_ids = function_interner.intern(list(functions))
+
+    values = [{k: v for k, v in row.items() if k != ROW_STACKS} for row in rows]
+    inserted = insert_ignore(SampleRecord.__table__, values)
+    if stack_ids and STACK_STORAGE == "dedup":
+        _insert_deduplicated_stacks(rows, stack_ids)
+    if stack_ids and ROLLUP_ENABLED:
+        # Only the records inserted by this transaction are added to the rollups.
+        claimed = _claim_rollup_records(rows)
+        _update_rollups(
+            [row for row in rows if (row["project"], row["sample_id"]) in claimed], stack_ids
+        )
+    if weights:
+        _index_functions(weights, function_ids)
+    db.session.commit()
+    return inserted
+
+
+# The columns of the records returned by the apis, the stack information is not included.
+RECORD_COLUMNS = (
+    "id",
+    "project",
+    "sample_id",
+    "name",
+    "process_id",
+    "thread_id",
+    "created_at",
+    "execution_time",
+)
+
+
+class SqlStorage:
+    """
+    Store the sampling records in the database.
+    """
+
+    def add_records(self, rows: List[Dict[str, Any]]) -> int:
+        """
+        Store the rows built by "build_record_row", the rows whose (project, sample_id)
+        already exists are ignored.
+
+        :return:
+            Returns the number of stored rows.
+        """
+        return insert_record_rows(rows)
+
+    def get_record(self, project: str, sample_id: str) -> SampleRecord:
+        """
+        :raise NoResultFound:
+            The record does not exist.
+        """
+        return (
+            db.session.query(SampleRecord)
+            .filter(SampleRecord.project == project, SampleRecord.sample_id == sample_id)
+            .one()
+        )
+
+    def search(
+        self,
+        project: str,
+        name: Optional[str] = None,
+        start: Optional[datetime.datetime] = None,
+        end: Optional[datetime.datetime] = None,
+        min_execution_time: Optional[int] = None,
+        sort: str = "created_at",
+        limit: int = 50,
+        after: Optional[Tuple[Any, int]] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Returns the records ordered by the sort column and id descending.
+
+        :param after:
+            Returns the records after the (sort value, id) of the previous page.
+        """
+        table = SampleRecord.__table__
+        conditions = [table.c.project == project]
+        if name:
+            conditions.append(table.c.name == name)
+        if start is not None:
+            conditions.append(table.c.created_at >= start)
+        if end is not None:
+            conditions.append(table.c.created_at < end)
+        if min_execution_time is not None:
+            conditions.append(table.c.execution_time >= min_execution_time)
+
+        sort_column = table.c[sort]
+        if after is not None:
+            value, row_id = after
+            conditions.append(
+                (sort_column < value) | ((sort_column == value) & (table.c.id < row_id))
+            )
+
+        rows = db.session.execute(
+            select([table.c[column] for column in RECORD_COLUMNS])
+            .where(*conditions)
+            .order_by(sort_column.desc(), table.c.id.desc())
+            .limit(limit)
+        ).fetchall()
+        return [dict(zip(RECORD_COLUMNS, row)) for row in rows]
+
+
+class StoredRecord:
+    """
+    A sampling record read from the embedded storage, it has the same interface
+    as "SampleRecord" used by the apis.
+    """
+
+    def __init__(self, record_id: int, meta: Dict[str, Any], stack_data: bytes):
+        self.id = record_id
+        self.project = meta["project"]
+        self.sample_id = meta["sample_id"]
+        self.name = meta["name"]
+        self.process_id = meta["process_id"]
+        self.thread_id = meta["thread_id"]
+        self.created_at = timestamp_to_localtime(meta["created_at"])
+        self.execution_time = meta["execution_time"]
+        self.stack_data = stack_data
+
+    def get_stack_data(self) -> bytes:
+        return self.stack_data
+
+    def get_stack_info(self) -> str:
+        return decompress_stack_info(self.stack_data)
+
+
+class _IndexEntry(NamedTuple):
+    id: int
+    project: str
+    sample_id: str
+    name: str
+    created_at: float
+    execution_time: int
+    segment: int
+    offset: int
+    length: int
+    # None in the index entries written by the older versions.
+    process_id: Optional[int] = None
+    thread_id: Optional[int] = None
+
+
+class EmbeddedStorage:
+    """
+    Store the sampling records in append-only segment files under a directory,
+    without a database.
+
+    Each record is appended to the active segment as:
+        crc32 | meta length | data length | meta (json) | data (zlib compressed stacks)
+    and the segment is rotated when it exceeds "segment_size".
+
+    The index entries (the meta and the location of the records) are appended to
+    "index.log", and loaded into memory when the storage is opened. The records are
+    looked up by (project, sample_id), and by time with the per-project entries
+    sorted by created_at. The records appended after the last index entry (e.g. the
+    process was killed) are recovered by scanning the segments.
+
+    Only one process may open the directory, it is locked by the "LOCK" file, and
+    opening it in another process raises RuntimeError.
+    """
+
+    RECORD_HEADER = struct.Struct(">III")
+    INDEX_FILE = "index.log"
+    LOCK_FILE = "LOCK"
+
+    def __init__(self, directory: str, segment_size: int = 64 * 1024 * 1024):
+        """
+        :param directory:
+            The directory of the segment files and the index.
+        :param segment_size:
+            Rotate the segment when it exceeds the size.
+        """
+        self._directory = directory
+        self._segment_size = segment_size
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, str], _IndexEntry] = {}
+        # project => sorted (created_at, id) keys and the entries in the same order
+        self._timeline: Dict[str, Tuple[List[Tuple[float, int]], List[_IndexEntry]]] = {}
+        self._next_id = 1
+        self._segment = 0
+        self._segment_file = None
+        self._index_file = None
+        self._lock_file = None
+
+        os.makedirs(directory, exist_ok=True)
+        self._acquire_directory()
+        self._load()
+
+    def _acquire_directory(self):
+        self._lock_file = open(os.path.join(self._directory, self.LOCK_FILE), "a")
+        if fcntl is None:
+            return
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            raise RuntimeError(f"'{self._directory}' is opened by another process")
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self._directory, f"segment-{segment:08d}.dat")
+
+    def _add_entry(self, entry: _IndexEntry):
+        self._entries[(entry.project, entry.sample_id)] = entry
+        keys, entries = self._timeline.setdefault(entry.project, ([], []))
+        key = (entry.created_at, entry.id)
+        index = bisect.bisect(keys, key)
+        keys.insert(index, key)
+        entries.insert(index, entry)
+        self._next_id = max(self._next_id, entry.id + 1)
+
+    def _load(self):
+        index_path = os.path.join(self._directory, self.INDEX_FILE)
+        last = None
+        if os.path.exists(index_path):
+            with open(index_path, "r", encoding="utf8") as file:
+                for line in file:
+                    try:
+                        entry = _IndexEntry(*json.loads(line))
+                    except (TypeError, ValueError):
+                        # the last line is partially written
+                        break
+                    self._add_entry(entry)
+                    last = entry
+
+        segment, offset = (last.segment, last.offset + last.length) if last else (0, 0)
+        recovered = self._recover(segment, offset)
+
+        self._index_file = open(index_path, "a", encoding="utf8")
+        for entry in recovered:
+            self._index_file.write(json.dumps(list(entry)) + "\n")
+        self._index_file.flush()
+
+        segments = [
+            int(name[len("segment-"):-len(".dat")])
+            for name in os.listdir(self._directory)
+            if name.startswith("segment-") and name.endswith(".dat")
+        ]
+        self._segment = max(segments, default=0)
+        self._segment_file = open(self._segment_path(self._segment), "ab")
+
+    def _recover(self, segment: int, offset: int) -> List[_IndexEntry]:
+        """
+        Scan the segments from the position, and index the records found.
+        """
+        recovered = []
+        while os.path.exists(self._segment_path(segment)):
+            path = self._segment_path(segment)
+            with open(path, "rb") as file:
+                file.seek(offset)
+                while True:
+                    record = self._read_record(file)
+                    if record is None:
+                        break
+                    meta, _, length = record
+                    key = (meta["project"], meta["sample_id"])
+                    if key not in self._entries:
+                        entry = self._make_entry(self._next_id, meta, segment, offset, length)
+                        self._add_entry(entry)
+                        recovered.append(entry)
+                    offset += length
+            if os.path.getsize(path) > offset:
+                logger.warning(f"Truncate the corrupted tail of {path} at {offset}")
+                with open(path, "r+b") as file:
+                    file.truncate(offset)
+            segment += 1
+            offset = 0
+        return recovered
+
+    def _read_record(self, file) -> Optional[Tuple[Dict[str, Any], bytes, int]]:
+        header = file.read(self.RECORD_HEADER.size)
+        if len(header) < self.RECORD_HEADER.size:
+            return None
+        crc, meta_size, data_size = self.RECORD_HEADER.unpack(header)
+        payload = file.read(meta_size + data_size)
+        if len(payload) < meta_size + data_size or zlib.crc32(payload) != crc:
+            return None
+        meta = json.loads(payload[:meta_size])
+        return meta, payload[meta_size:], self.RECORD_HEADER.size + len(payload)
+
+    @staticmethod
+    def _make_entry(
+        record_id: int, meta: Dict[str, Any], segment: int, offset: int, length: int
+    ) -> _IndexEntry:
+        return _IndexEntry(
+            record_id,
+            meta["project"],
+            meta["sample_id"],
+            meta["name"],
+            meta["created_at"],
+            meta["execution_time"],
+            segment,
+            offset,
+            length,
+            meta["process_id"],
+            meta["thread_id"],
+        )
+
+    def add_records(self, rows: List[Dict[str, Any]]) -> int:
+        """
+        See "SqlStorage.add_records".
+        """
+        entries = []
+        with self._lock:
+            pending = set()
+            for row in rows:
+                key = (row["project"], row["sample_id"])
+                if key in self._entries or key in pending:
+                    continue
+                pending.add(key)
+
+                meta = {
+                    "project": row["project"],
+                    "sample_id": row["sample_id"],
+                    "name": row["name"],
+                    "process_id": row["process_id"],
+                    "thread_id": row["thread_id"],
+                    "created_at": row["created_at"].timestamp(),
+                    "execution_time": row["execution_time"],
+                }
+                payload = json.dumps(meta).encode("utf8")
+                meta_size = len(payload)
+                payload += row["stack_data"]
+                record = (
+                    self.RECORD_HEADER.pack(zlib.crc32(payload), meta_size, len(payload) - meta_size)
+                    + payload
+                )
+
+                offset = self._segment_file.tell()
+                if offset > 0 and offset + len(record) > self._segment_size:
+                    self._segment_file.close()
+                    self._segment += 1
+                    self._segment_file = open(self._segment_path(self._segment), "ab")
+                    offset = 0
+                self._segment_file.write(record)
+
+                record_id = self._next_id + len(entries)
+                entries.append(
+                    self._make_entry(record_id, meta, self._segment, offset, len(record))
+                )
+
+            # The records are readable before the entries are published, "get_record"
+            # does not take the lock.
+            self._segment_file.flush()
+            for entry in entries:
+                self._add_entry(entry)
+                self._index_file.write(json.dumps(list(entry)) + "\n")
+            self._index_file.flush()
+        return len(entries)
+
+    def get_record(self, project: str, sample_id: str) -> StoredRecord:
+        """
+        :raise NoResultFound:
+            The record does not exist.
+        """
+        entry = self._entries.get((project, sample_id))
+        if entry is None:
+            raise NoResultFound("No row was found")
+
+        with open(self._segment_path(entry.segment), "rb") as file:
+            file.seek(entry.offset)
+            record = self._read_record(file)
+        if record is None:
+            raise NoResultFound(f"The record {project}/{sample_id} is corrupted")
+        meta, stack_data, _ = record
+        return StoredRecord(entry.id, meta, stack_data)
+
+    def search(
+        self,
+        project: str,
+        name: Optional[str] = None,
+        start: Optional[datetime.datetime] = None,
+        end: Optional[datetime.datetime] = None,
+        min_execution_time: Optional[int] = None,
+        sort: str = "created_at",
+        limit: int = 50,
+        after: Optional[Tuple[Any, int]] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        See "SqlStorage.search".
+        """
+        with self._lock:
+            keys, entries = self._timeline.get(project, ([], []))
+            # the entries in the time range
+            low = 0 if start is None else bisect.bisect_left(keys, (start.timestamp(),))
+            high = len(keys) if end is None else bisect.bisect_left(keys, (end.timestamp(),))
+            if sort == "created_at" and after is not None:
+                high = min(high, bisect.bisect_left(keys, (after[0].timestamp(), after[1])))
+            candidates = entries[low:high]
+
+        def matches(entry: _IndexEntry) -> bool:
+            if name and entry.name != name:
+                return False
+            if min_execution_time is not None and entry.execution_time < min_execution_time:
+                return False
+            return True
+
+        if sort == "created_at":
+            selected = []
+            for entry in reversed(candidates):
+                if matches(entry):
+                    selected.append(entry)
+                    if len(selected) >= limit:
+                        break
+        else:
+            selected = [
+                entry
+                for entry in candidates
+                if matches(entry)
+                and (after is None or (entry.execution_time, entry.id) < tuple(after))
+            ]
+            selected.sort(key=lambda e: (e.execution_time, e.id), reverse=True)
+            selected = selected[:limit]
+
+        result = []
+        for entry in selected:
+            if entry.process_id is None:
+                # Indexed by an older version, read the meta from the segment.
+                record = self.get_record(entry.project, entry.sample_id)
+                result.append({column: getattr(record, column) for column in RECORD_COLUMNS})
+                continue
+            result.append(
+                {
+                    "id": entry.id,
+                    "project": entry.project,
+                    "sample_id": entry.sample_id,
+                    "name": entry.name,
+                    "process_id": entry.process_id,
+                    "thread_id": entry.thread_id,
+                    "created_at": timestamp_to_localtime(entry.created_at),
+                    "execution_time": entry.execution_time,
+                }
+            )
+        return result
+
+    def close(self):
+        with self._lock:
+            self._segment_file.close()
+            self._index_file.close()
+            self._lock_file.close()
+
+
+if STORAGE_BACKEND == "embedded":
+    storage = EmbeddedStorage(STORAGE_PATH)
+else:
+    storage = SqlStorage()
+
+
+class IngestQueue:
+    """
+    A bounded in-process queue of the record rows waiting to be written.
+
+    The writer threads are started on the first "put", each writer takes at most
+    "batch_size" rows from the queue and inserts them with "insert_record_rows".
+    """
+
+    def __init__(self, capacity: int, writers: int = 2, batch_size: int = 500):
+        self._capacity = capacity
+        self._writers = writers
+        self._batch_size = batch_size
+        self._rows = deque()
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._busy = 0
+        self._stats = dict.fromkeys(
+            ("enqueued", "rejected", "written", "duplicates", "failed", "batches"), 0
+        )
+
+    def put(self, rows: List[Dict[str, Any]]) -> bool:
+        """
+        Put the rows to the queue, all or nothing.
+
+        :return:
+            Returns False if the queue does not have enough capacity.
+        """
+        with self._cond:
+            if len(self._rows) + len(rows) > self._capacity:
+                self._stats["rejected"] += len(rows)
+                return False
+
+            self._rows.extend(rows)
+            self._stats["enqueued"] += len(rows)
+            if not self._threads:
+                self._start_writers()
+            self._cond.notify()
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            data = dict(self._stats)
+            data["depth"] = len(self._rows)
+            data["capacity"] = self._capacity
+        return data
+
+    def flush(self, timeout: float = 10) -> bool:
+        """
+        Wait until all the queued rows are written.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._rows or self._busy:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _start_writers(self):
+        for i in range(0, self._writers):
+            thread = threading.Thread(target=self._run, name=f"PySample.IngestWriter-{i}")
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _take(self) -> List[Dict[str, Any]]:
+        with self._cond:
+            while not self._rows:
+                self._cond.wait()
+            rows = []
+            while self._rows and len(rows) < self._batch_size:
+                rows.append(self._rows.popleft())
+            self._busy += 1
+            return rows
+
+    def _write(self, rows: List[Dict[str, Any]]):
+        inserted, failed = 0, 0
+        with app.app_context():
+            try:
+                inserted = storage.add_records(rows)
+            except Exception:
+                db.session.rollback()
+                failed = len(rows)
+                logger.error(f"Failed to write {len(rows)} sample records", exc_info=True)
+            finally:
+                db.session.remove()
+
+        with self._cond:
+            self._busy -= 1
+            self._stats["batches"] += 1
+            self._stats["written"] += inserted
+            self._stats["failed"] += failed
+            self._stats["duplicates"] += len(rows) - inserted - failed
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            self._write(self._take())
+
+
+ingest_queue: Optional[IngestQueue] = None
+if ASYNC_INGEST:
+    ingest_queue = IngestQueue(INGEST_QUEUE_SIZE, INGEST_WRITERS, INGEST_BATCH_SIZE)
+    atexit.register(ingest_queue.flush)
+
+
+def queue_full_response():
+    response = jsonify(
+        success=False,
+        error={"type": "ServiceUnavailable", "message": "ingest queue is full"},
+    )
+    response.status_code = 503
+    response.headers["Retry-After"] = "1"
+    return response
+
+
 @app.route("/sample/add/<project>", methods=["POST"])
 def add_sample(project: str):
     """
@@ -118,36 +1391,19 @@ def add_sample(project: str):
     :param project:
     :return:
     """
-    req_data = request.data
-    try:
-        raw_data = zlib.decompress(req_data)
-        data = json.loads(raw_data)
-    except (TypeError, zlib.error, json.JSONDecodeError) as e:
-        raise BadRequest(str(e))
+    data = decode_request_data()
 
     err = add_sample_schema.validate(data)
     if err:
         raise BadRequest(str(err))
 
-    sample_id = data["sample_id"]
-    created_at = timestamp_to_localtime(data["timestamp"])
-
-    record = SampleRecord(
-        project=project,
-        sample_id=data["sample_id"],
-        name=data["name"],
-        process_id=data["process_id"],
-        thread_id=data["thread_id"],
-        created_at=created_at,
-        stack_info=data["stack_info"],
-        execution_time=data["execution_time"],
-    )
+    if ingest_queue is not None:
+        if not ingest_queue.put([build_record_row(project, data)]):
+            return queue_full_response()
+        return jsonify(success=True, queued=True), 202
 
-    try:
-        db.session.add(record)
-        db.session.commit()
-    except IntegrityError:
-        db.session.rollback()
+    sample_id = data["sample_id"]
+    if not storage.add_records([build_record_row(project, data)]):
         return jsonify(
             success=False,
             error={
@@ -159,20 +1415,66 @@ def add_sample(project: str):
     return jsonify(success=True)
 
 
+@app.route("/sample/add_batch/<project>", methods=["POST"])
+def add_sample_batch(project: str):
+    """
+    Save a batch of sampling results to database.
+
+    Request body (deflate compressed json):
+        {"records": [record, ...]}
+
+    The record format is the same as the "add_sample" api. The invalid records are
+    skipped and reported in "errors", the records whose sample_id already exists
+    are counted as "duplicates".
+
+    :param project:
+    :return:
+    """
+    data = decode_request_data()
+    records = data.get("records") if isinstance(data, dict) else None
+    if not isinstance(records, list):
+        raise BadRequest("'records' must be a list")
+    if len(records) > MAX_BATCH_SIZE:
+        raise BadRequest(f"too many records, the maximum batch size is {MAX_BATCH_SIZE}")
+
+    errors = {}
+    rows = {}
+    for index, record in enumerate(records):
+        err = validate_sample_fast(record)
+        if err:
+            errors[index] = err
+        elif record["sample_id"] not in rows:
+            rows[record["sample_id"]] = build_record_row(project, record)
+
+    if ingest_queue is not None:
+        if not ingest_queue.put(list(rows.values())):
+            return queue_full_response()
+        return jsonify(success=True, queued=len(rows), errors=errors), 202
+
+    inserted = storage.add_records(list(rows.values())) if rows else 0
+    return jsonify(
+        success=True,
+        inserted=inserted,
+        duplicates=len(records) - len(errors) - inserted,
+        errors=errors,
+    )
+
+
+@app.route("/sample/ingest/stats", methods=["GET"])
+def ingest_stats():
+    if ingest_queue is None:
+        return jsonify(success=True, data={"async": False})
+    return jsonify(success=True, data={"async": True, **ingest_queue.stats()})
+
+
 def row2dict(row: SampleRecord):
-    d = {}
-    for column in row.__table__.columns:
-        d[column.name] = getattr(row, column.name)
+    d = {column: getattr(row, column) for column in RECORD_COLUMNS}
+    d["stack_info"] = row.get_stack_info()
     return d
 
 
 def get_sample_record(project: str, sample_id: str) -> SampleRecord:
-    record = (
-        db.session.query(SampleRecord)
-        .filter(SampleRecord.project == project, SampleRecord.sample_id == sample_id)
-        .one()
-    )
-    return record
+    return storage.get_record(project, sample_id)
 
 
 @app.route("/sample/get/<project>/<sample_id>", methods=["GET"])
@@ -184,12 +1486,395 @@ def sample_get(project: str, sample_id: str):
         return jsonify(success=True, error={"message": "No result found"})
 
 
+# The default and maximum number of records returned by the search api.
+SEARCH_DEFAULT_LIMIT = 50
+SEARCH_MAX_LIMIT = 500
+
+
+def encode_search_cursor(value: Any, row_id: int) -> str:
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    raw = json.dumps([value, row_id]).encode("utf8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_search_cursor(cursor: str, sort: str) -> Tuple[Any, int]:
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if sort == "created_at":
+            value = datetime.datetime.fromisoformat(value)
+        elif not _is_int(value):
+            raise ValueError("invalid sort value")
+        if not _is_int(row_id):
+            raise ValueError("invalid id")
+    except (TypeError, ValueError, binascii.Error) as e:
+        raise BadRequest(f"invalid cursor: {e}")
+    return value, row_id
+
+
+def sql_storage_required_response():
+    return jsonify(
+        success=False, error={"message": "The api requires the sql storage backend."}
+    )
+
+
+def _get_arg(name: str, arg_type: type, default: Any = None) -> Any:
+    value = request.args.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return arg_type(value)
+    except ValueError:
+        raise BadRequest(f"'{name}' must be {arg_type.__name__}")
+
+
+@app.route("/sample/search", methods=["GET"])
+def sample_search():
+    """
+    Search the sampling records, the stack information is not returned.
+
+    Query arguments:
+        project: required
+        name: the sampling name (endpoint)
+        start, end: the time range in unix timestamp, "start" is inclusive
+        min_execution_time: in millisecond
+        sort: "created_at" (default, newest first) or "execution_time" (slowest first)
+        limit: the maximum number of records, default 50, maximum 500
+        cursor: the "next_cursor" returned by the previous page
+
+    The pages are paginated by keyset (the sort column and id) rather than offset,
+    so every page is an index range scan no matter how deep it is.
+    See "SqlStorage.search" and "EmbeddedStorage.search".
+    """
+    project = request.args.get("project")
+    if not project:
+        raise BadRequest("'project' is required")
+    sort = request.args.get("sort", "created_at")
+    if sort not in ("created_at", "execution_time"):
+        raise BadRequest("'sort' must be 'created_at' or 'execution_time'")
+    limit = min(max(_get_arg("limit", int, SEARCH_DEFAULT_LIMIT), 1), SEARCH_MAX_LIMIT)
+
+    start = _get_arg("start", float)
+    end = _get_arg("end", float)
+    cursor = request.args.get("cursor")
+    rows = storage.search(
+        project,
+        name=request.args.get("name"),
+        start=None if start is None else timestamp_to_localtime(start),
+        end=None if end is None else timestamp_to_localtime(end),
+        min_execution_time=_get_arg("min_execution_time", int),
+        sort=sort,
+        limit=limit + 1,
+        after=decode_search_cursor(cursor, sort) if cursor else None,
+    )
+
+    data = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_search_cursor(data[-1][sort], data[-1]["id"])
+    return jsonify(success=True, data=data, next_cursor=next_cursor)
+
+
+@app.route("/sample/aggregate/<project>", methods=["GET"])
+def sample_aggregate(project: str):
+    """
+    Merge the stacks of all the records of a project (or an endpoint) in a time range.
+
+    Query arguments:
+        name: the sampling name (endpoint), all the records of the project if omitted
+        start, end: the time range in unix timestamp, rounded to the rollup period (hour)
+        format: "folded" (default) or "flamegraph"
+
+    The result is read from the rollups maintained at ingest time, so the cost
+    depends on the number of distinct stacks rather than the number of records.
+    """
+    if STORAGE_BACKEND != "sql":
+        return sql_storage_required_response()
+    if not ROLLUP_ENABLED:
+        return jsonify(success=False, error={"message": "'ROLLUP_ENABLED' is disabled."})
+    output_format = request.args.get("format", "folded")
+    if output_format not in ("folded", "flamegraph"):
+        raise BadRequest("'format' must be 'folded' or 'flamegraph'")
+    if output_format == "flamegraph" and not FLAMEGRAPH_PATH:
+        return jsonify(
+            success=False, error={"message": "'FLAMEGRAPH_PATH' is not configured."}
+        )
+
+    rollups = SampleRollup.__table__
+    stacks = SampleStack.__table__
+    conditions = [rollups.c.project == project]
+    name = request.args.get("name")
+    if name:
+        conditions.append(rollups.c.name == name)
+    start = _get_arg("start", float)
+    if start is not None:
+        start = period_start(timestamp_to_localtime(start), ROLLUP_PERIOD)
+        conditions.append(rollups.c.period_start >= start)
+    end = _get_arg("end", float)
+    if end is not None:
+        conditions.append(rollups.c.period_start < timestamp_to_localtime(end))
+
+    totals = (
+        select([rollups.c.stack_id, func.sum(rollups.c.count).label("total")])
+        .where(*conditions)
+        .group_by(rollups.c.stack_id)
+        .subquery()
+    )
+    rows = db.session.execute(
+        select([stacks.c.frames, totals.c.total])
+        .select_from(totals.join(stacks, totals.c.stack_id == stacks.c.id))
+        .order_by(totals.c.stack_id)
+    ).fetchall()
+    stack_info = format_folded_stacks(rows)
+
+    if output_format == "folded":
+        return Response(stack_info, mimetype="text/plain")
+
+    try:
+        svg = render_flame_graph(stack_info)
+    except RuntimeError as e:
+        return jsonify(success=False, error={"message": str(e)})
+    except OSError as e:
+        return jsonify(success=False, error={"type": "OSError", "message": str(e)})
+    return flame_graph_response(gzip.compress(svg, compresslevel=6))
+
+
+@app.route("/sample/function", methods=["GET"])
+def function_search():
+    """
+    Find the heaviest records and endpoints which contain a function.
+
+    Query arguments:
+        name: required, the function name, e.g. "dumps"
+        filename: the (shortened) filename of the function, e.g. "json/__init__.py"
+        project: only search the records of the project
+        limit: the maximum number of records and endpoints, default 50, maximum 500
+
+    The records are ordered by the total count (the samples in the function and
+    its callees) of the function.
+    """
+    if STORAGE_BACKEND != "sql":
+        return sql_storage_required_response()
+    if not FUNCTION_INDEX_ENABLED:
+        return jsonify(
+            success=False, error={"message": "'FUNCTION_INDEX_ENABLED' is disabled."}
+        )
+    name = request.args.get("name")
+    if not name:
+        raise BadRequest("'name' is required")
+    limit = min(max(_get_arg("limit", int, SEARCH_DEFAULT_LIMIT), 1), SEARCH_MAX_LIMIT)
+
+    functions = SampleFunction.__table__
+    conditions = [functions.c.name == name]
+    filename = request.args.get("filename")
+    if filename:
+        conditions.append(functions.c.filename == filename)
+    function_rows = db.session.execute(
+        select([functions.c.id, functions.c.name, functions.c.filename]).where(*conditions)
+    ).fetchall()
+    result = {
+        "functions": [dict(zip(("id", "name", "filename"), row)) for row in function_rows],
+        "samples": [],
+        "endpoints": [],
+    }
+    if not function_rows:
+        return jsonify(success=True, data=result)
+
+    records = SampleRecord.__table__
+    weights = FunctionSample.__table__
+    conditions = [weights.c.function_id.in_([row[0] for row in function_rows])]
+    project = request.args.get("project")
+    if project:
+        conditions.append(records.c.project == project)
+    join = weights.join(records, weights.c.record_id == records.c.id)
+
+    sample_columns = (
+        "project",
+        "sample_id",
+        "name",
+        "created_at",
+        "execution_time",
+        "function_id",
+        "self_count",
+        "total_count",
+    )
+    rows = db.session.execute(
+        select(
+            [records.c[column] for column in sample_columns[:5]]
+            + [weights.c[column] for column in sample_columns[5:]]
+        )
+        .select_from(join)
+        .where(*conditions)
+        .order_by(weights.c.total_count.desc())
+        .limit(limit)
+    ).fetchall()
+    result["samples"] = [dict(zip(sample_columns, row)) for row in rows]
+
+    total = func.sum(weights.c.total_count)
+    rows = db.session.execute(
+        select(
+            [
+                records.c.project,
+                records.c.name,
+                func.count(),
+                func.sum(weights.c.self_count),
+                total,
+            ]
+        )
+        .select_from(join)
+        .where(*conditions)
+        .group_by(records.c.project, records.c.name)
+        .order_by(total.desc())
+        .limit(limit)
+    ).fetchall()
+    result["endpoints"] = [
+        dict(zip(("project", "name", "samples", "self_count", "total_count"), row))
+        for row in rows
+    ]
+    return jsonify(success=True, data=result)
+
+
+@app.route("/sample/stack/<project>/<sample_id>", methods=["GET"])
+def sample_stack(project: str, sample_id: str):
+    """
+    Returns the folded stack information of the sampling record.
+
+    The stored compressed bytes are returned directly with "deflate" content encoding
+    if the client accepts it, so renderers can fetch the stacks without the server
+    decompressing them.
+    """
+    try:
+        record = get_sample_record(project, sample_id)
+    except NoResultFound:
+        return jsonify(success=False, error={"message": "No result found"})
+
+    if "deflate" in request.accept_encodings:
+        response = Response(record.get_stack_data(), mimetype="text/plain")
+        response.headers["Content-Encoding"] = "deflate"
+    else:
+        response = Response(record.get_stack_info(), mimetype="text/plain")
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
+class FlameGraphCache:
+    """
+    Cache the rendered flame graphs by (project, sample_id).
+
+    The sampling records are immutable once stored, so the rendered flame graphs
+    never expire. The gzip compressed bodies are kept in a size-bounded LRU in memory,
+    and optionally written to the cache directory as the second tier.
+    """
+
+    def __init__(self, max_bytes: int, directory: Optional[str] = None):
+        self._max_bytes = max_bytes
+        self._directory = directory
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, str], bytes]" = OrderedDict()
+        self._size = 0
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: Tuple[str, str]) -> str:
+        digest = hashlib.sha1("/".join(key).encode("utf8")).hexdigest()
+        return os.path.join(self._directory, digest[:2], f"{digest}.svg.gz")
+
+    def get(self, key: Tuple[str, str]) -> Optional[bytes]:
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+                return body
+
+        if not self._directory:
+            return None
+        try:
+            with open(self._path(key), "rb") as file:
+                body = file.read()
+        except OSError:
+            return None
+        self._put_memory(key, body)
+        return body
+
+    def put(self, key: Tuple[str, str], body: bytes):
+        self._put_memory(key, body)
+        if not self._directory:
+            return
+
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "wb") as file:
+                file.write(body)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f"Failed to write flame graph cache {path}: {e}")
+
+    def _put_memory(self, key: Tuple[str, str], body: bytes):
+        if len(body) > self._max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = body
+            self._size += len(body)
+            while self._size > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+
+flame_graph_cache: Optional[FlameGraphCache] = None
+if FLAMEGRAPH_CACHE_SIZE > 0 or FLAMEGRAPH_CACHE_DIR:
+    flame_graph_cache = FlameGraphCache(FLAMEGRAPH_CACHE_SIZE, FLAMEGRAPH_CACHE_DIR)
+
+
+def render_flame_graph(stack_info: str) -> bytes:
+    """
+    Render the flame graph with the "FLAMEGRAPH_PATH" script.
+
+    :raise OSError:
+        Failed to execute the script.
+    :raise RuntimeError:
+        The script exits with a non-zero status or is terminated by a signal.
+    """
+    with NamedTemporaryFile() as output_file:
+        with NamedTemporaryFile() as input_file:
+            input_file.write(stack_info.encode("utf8"))
+            input_file.flush()
+
+            cmd = f"{FLAMEGRAPH_PATH} {input_file.name} > {output_file.name}"
+            retcode = subprocess.call(cmd, shell=True)
+            if retcode != 0:
+                raise RuntimeError(f"Command execution failed ({retcode})")
+
+        return output_file.read()
+
+
+def flame_graph_response(body: bytes) -> Response:
+    """
+    Make the response with the gzip compressed flame graph, the body is
+    decompressed if the client does not accept gzip encoding.
+    """
+    if "gzip" in request.accept_encodings:
+        response = Response(body)
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = Response(gzip.decompress(body))
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = "private, max-age=86400"
+    return response
+
+
 @app.route("/sample/flamegraph/<project>/<sample_id>", methods=["GET"])
 def show_flame_graph(project: str, sample_id: str):
     """
     Show flame graph corresponding to project and sample_id.
 
     If the "FLAMEGRAPH_PATH" environment variable is not configured, an error is returned.
+    The rendered flame graphs are cached, see "FlameGraphCache".
 
     :param project:
     :param sample_id:
@@ -200,29 +1885,27 @@ def show_flame_graph(project: str, sample_id: str):
             success=False, error={"message": "'FLAMEGRAPH_PATH' is not configured."}
         )
 
+    key = (project, sample_id)
+    body = flame_graph_cache.get(key) if flame_graph_cache else None
+    if body is not None:
+        return flame_graph_response(body)
+
     try:
         record = get_sample_record(project, sample_id)
     except NoResultFound:
         return jsonify(success=False, error={"message": "No result found"})
 
-    with NamedTemporaryFile() as output_file:
-        with NamedTemporaryFile() as input_file:
-            input_file.write(record.stack_info.encode("utf8"))
-            input_file.flush()
-
-            cmd = f"{FLAMEGRAPH_PATH} {input_file.name} > {output_file.name}"
-            try:
-                retcode = subprocess.call(cmd, shell=True)
-                if retcode < 0:
-                    return jsonify(
-                        success=False, error={"message": "Command execution failed"}
-                    )
-            except OSError as e:
-                return jsonify(
-                    success=False, error={"type": "OSError", "message": str(e)}
-                )
+    try:
+        svg = render_flame_graph(record.get_stack_info())
+    except RuntimeError as e:
+        return jsonify(success=False, error={"message": str(e)})
+    except OSError as e:
+        return jsonify(success=False, error={"type": "OSError", "message": str(e)})
 
-        return Response(output_file.read())
+    body = gzip.compress(svg, compresslevel=6)
+    if flame_graph_cache:
+        flame_graph_cache.put(key, body)
+    return flame_graph_response(body)
 
 
 class SimpleColumnFilter(BaseFilter):
@@ -284,6 +1967,10 @@ class SampleRecordView(ModelView):
 
     column_default_sort = ("id", True)
 
+    # Counting the rows is a full scan on a large table, only show the
+    # previous/next page links.
+    simple_list_pager = True
+
     column_list = (
         SampleRecord.id,
         SampleRecord.project,
@@ -297,7 +1984,21 @@ class SampleRecordView(ModelView):
 
     list_template = "list.html"
 
-    column_filters = [XPySampleIDFilter(), SimpleColumnFilter("project")]
+    column_filters = [
+        XPySampleIDFilter(),
+        SimpleColumnFilter("project"),
+        SimpleColumnFilter("name"),
+        DateTimeBetweenFilter(SampleRecord.created_at, "Created At"),
+        IntGreaterFilter(SampleRecord.execution_time, "Execution Time"),
+    ]
+
+    def get_query(self):
+        # The stack information is not shown in the list.
+        return (
+            super()
+            .get_query()
+            .options(defer(SampleRecord.stack_info), defer(SampleRecord.stack_data))
+        )
 
     @expose("/details/")
     def details_view(self):
@@ -330,11 +2031,15 @@ admin = flask_admin.Admin(
 )
 
 
-admin.add_view(SampleRecordView(SampleRecord, db.session, url="/sample/"))
+# The admin list is only available with the sql storage.
+if STORAGE_BACKEND == "sql":
+    admin.add_view(SampleRecordView(SampleRecord, db.session, url="/sample/"))
 
 
 @app.route("/")
 def index():
+    if STORAGE_BACKEND != "sql":
+        return redirect("/admin/")
     return redirect("/sample/")
 
 
@@ -347,8 +2052,286 @@ def init():
     db.metadata.create_all(db.engine)
 
 
+def create_missing_indexes() -> List[str]:
+    """
+    Create the indexes which do not exist in the database, "init" does not
+    add the indexes to the existing tables.
+
+    :return:
+        Returns the names of the created indexes.
+    """
+    inspector = inspect(db.engine)
+    created = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info(f"Creating index {index.name} on {table.name}")
+                index.create(db.engine)
+                created.append(index.name)
+    return created
+
+
+def add_missing_columns() -> List[str]:
+    """
+    Add the nullable columns which do not exist in the existing tables.
+
+    :return:
+        Returns the names of the added columns.
+    """
+    inspector = inspect(db.engine)
+    added = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            logger.info(f"Adding column {column.name} to {table.name}")
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            db.session.execute(
+                text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+            )
+            added.append(f"{table.name}.{column.name}")
+    db.session.commit()
+    return added
+
+
+def migrate_stack_info(batch_size: int = 1000) -> int:
+    """
+    Migrate the existing rows to the configured stack storage ("STACK_STORAGE").
+
+    The "stack_data" column is added and the legacy "stack_info" column is made
+    nullable if needed, then the stack information is compressed (blob) or split
+    into the shared stacks (dedup) in batches. Each batch is committed separately,
+    so the migration can be interrupted and resumed.
+
+    :return:
+        Returns the number of migrated rows.
+    """
+    table = SampleRecord.__table__
+    dialect = db.engine.dialect.name
+    add_missing_columns()
+    columns = {c["name"]: c for c in inspect(db.engine).get_columns(table.name)}
+    if not columns["stack_info"]["nullable"]:
+        if dialect == "mysql":
+            db.session.execute(text(f"ALTER TABLE {table.name} MODIFY stack_info LONGTEXT NULL"))
+        elif dialect == "postgresql":
+            db.session.execute(
+                text(f"ALTER TABLE {table.name} ALTER COLUMN stack_info DROP NOT NULL")
+            )
+        db.session.commit()
+
+    if STACK_STORAGE == "dedup":
+        condition = (table.c.stack_data.isnot(None)) | (table.c.stack_info.isnot(None))
+    else:
+        condition = table.c.stack_data.is_(None) & table.c.stack_info.isnot(None)
+
+    migrated = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            table.select()
+            .with_only_columns([table.c.id, table.c.stack_info, table.c.stack_data])
+            .where(condition, table.c.id > last_id)
+            .order_by(table.c.id)
+            .limit(batch_size)
+        ).fetchall()
+        if not rows:
+            break
+
+        updates = []
+        record_stacks = []
+        for row_id, stack_info, stack_data in rows:
+            if stack_data is not None:
+                stack_info = decompress_stack_info(stack_data)
+            stacks = parse_folded_stacks(stack_info) if STACK_STORAGE == "dedup" else None
+            if stacks is not None:
+                record_stacks.append((row_id, stacks))
+                updates.append((row_id, {"stack_data": None, "stack_info": None}))
+            elif stack_data is None:
+                updates.append(
+                    (row_id, {"stack_data": compress_stack_info(stack_info), "stack_info": None})
+                )
+
+        frames_list = dict.fromkeys(frames for _, stacks in record_stacks for frames in stacks)
+        stack_ids = stack_interner.intern(list(frames_list))
+        for row_id, values in updates:
+            db.session.execute(table.update().where(table.c.id == row_id).values(**values))
+        insert_record_stacks(record_stacks, stack_ids)
+        db.session.commit()
+        migrated += len(updates)
+        last_id = rows[-1][0]
+        logger.info(f"Migrated {migrated} sample records")
+    return migrated
+
+
+# The period of the rollups downsampled from the hourly rollups.
+DAILY_ROLLUP_PERIOD = 86400
+
+
+def _fold_records(records: List[SampleRecord]):
+    """
+    Add the stacks of the records which are not rolled up yet to the rollups.
+    """
+    rows = []
+    for record in records:
+        if record.rolled_up:
+            continue
+        stacks = parse_folded_stacks(record.get_stack_info())
+        if stacks is None:
+            continue
+        rows.append(
+            {
+                "project": record.project,
+                "sample_id": record.sample_id,
+                "name": record.name,
+                "created_at": record.created_at,
+                ROW_STACKS: stacks,
+            }
+        )
+
+    frames_list = dict.fromkeys(frames for row in rows for frames in row[ROW_STACKS])
+    if frames_list:
+        stack_ids = stack_interner.intern(list(frames_list))
+        _update_rollups(rows, stack_ids)
+
+
+def delete_records(record_ids: List[int]):
+    """
+    Delete the records and the rows referring to them. The caller commits
+    the transaction.
+    """
+    table = SampleRecord.__table__
+    db.session.execute(
+        SampleRecordStack.__table__.delete().where(
+            SampleRecordStack.__table__.c.record_id.in_(record_ids)
+        )
+    )
+    db.session.execute(
+        FunctionSample.__table__.delete().where(
+            FunctionSample.__table__.c.record_id.in_(record_ids)
+        )
+    )
+    db.session.execute(table.delete().where(table.c.id.in_(record_ids)))
+
+
+def compact_records(
+    retention_days: int, keep_slowest: int = 10, batch_size: int = 1000
+) -> int:
+    """
+    Delete the records older than "retention_days" in batches.
+
+    The stacks of the expired records are folded into the rollups before deleting
+    (if they are not rolled up at ingest time), and the "keep_slowest" slowest
+    expired records of each endpoint are kept, so the long-term trend and the
+    worst cases are still available.
+
+    :return:
+        Returns the number of deleted records.
+    """
+    table = SampleRecord.__table__
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=retention_days)
+    endpoints = db.session.execute(
+        select([table.c.project, table.c.name]).where(table.c.created_at < cutoff).distinct()
+    ).fetchall()
+
+    deleted = 0
+    for project, name in endpoints:
+        conditions = [
+            table.c.project == project,
+            table.c.name == name,
+            table.c.created_at < cutoff,
+        ]
+        kept = [
+            row_id
+            for row_id, in db.session.execute(
+                select([table.c.id])
+                .where(*conditions)
+                .order_by(table.c.execution_time.desc(), table.c.id.desc())
+                .limit(keep_slowest)
+            )
+        ]
+        if kept:
+            conditions.append(table.c.id.notin_(kept))
+
+        while True:
+            records = (
+                db.session.query(SampleRecord)
+                .filter(*conditions)
+                .order_by(SampleRecord.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not records:
+                break
+
+            if ROLLUP_ENABLED:
+                _fold_records(records)
+            delete_records([record.id for record in records])
+            db.session.commit()
+            deleted += len(records)
+            logger.info(f"Deleted {deleted} expired sample records")
+    return deleted
+
+
+def downsample_rollups(days: int, batch_size: int = 10000) -> int:
+    """
+    Merge the hourly rollups older than "days" into the daily rollups, only the
+    whole days are merged.
+
+    :return:
+        Returns the number of merged hourly rollups.
+    """
+    table = SampleRollup.__table__
+    cutoff = period_start(
+        datetime.datetime.now() - datetime.timedelta(days=days), DAILY_ROLLUP_PERIOD
+    )
+    merged = 0
+    while True:
+        rows = db.session.execute(
+            select([table.c.id, table.c.project, table.c.name, table.c.period_start,
+                    table.c.stack_id, table.c.count])
+            .where(table.c.period == ROLLUP_PERIOD, table.c.period_start < cutoff)
+            .order_by(table.c.id)
+            .limit(batch_size)
+        ).fetchall()
+        if not rows:
+            break
+
+        counts: Dict[Tuple[str, str, datetime.datetime, int], int] = {}
+        for _, project, name, start, stack_id, count in rows:
+            key = (project, name, period_start(start, DAILY_ROLLUP_PERIOD), stack_id)
+            counts[key] = counts.get(key, 0) + count
+
+        upsert_rollup_rows(
+            [
+                {
+                    "project": project,
+                    "name": name,
+                    "period": DAILY_ROLLUP_PERIOD,
+                    "period_start": start,
+                    "stack_id": stack_id,
+                    "count": count,
+                }
+                for (project, name, start, stack_id), count in sorted(counts.items())
+            ]
+        )
+        db.session.execute(table.delete().where(table.c.id.in_([row[0] for row in rows])))
+        db.session.commit()
+        merged += len(rows)
+        logger.info(f"Merged {merged} hourly rollups")
+    return merged
+
+
 if __name__ == "__main__":
-    usage = "%prog [-i init_db_tables] [-o host] [-p port]"
+    usage = (
+        "%prog [-i init_db_tables] [-m migrate_stack_info] [-c compact] "
+        "[-o host] [-p port]"
+    )
     parser = optparse.OptionParser(usage=usage)
     parser.add_option(
         "-i",
@@ -356,6 +2339,37 @@ if __name__ == "__main__":
         action="store_true",
         help="initialize database tables",
     )
+    parser.add_option(
+        "-m",
+        "--migrate",
+        action="store_true",
+        help="create the missing tables and indexes, and migrate the existing sample records "
+        "to the configured stack storage",
+    )
+    parser.add_option(
+        "-c",
+        "--compact",
+        action="store_true",
+        help="delete the expired sample records and downsample the old rollups",
+    )
+    parser.add_option(
+        "--retention_days",
+        type=int,
+        default=30,
+        help="the sample records older than the days are deleted by compaction",
+    )
+    parser.add_option(
+        "--keep_slowest",
+        type=int,
+        default=10,
+        help="the number of the slowest expired sample records kept for each endpoint",
+    )
+    parser.add_option(
+        "--daily_rollup_days",
+        type=int,
+        default=7,
+        help="the hourly rollups older than the days are merged into daily rollups",
+    )
     parser.add_option(
         "-o",
         "--host",
@@ -374,5 +2388,19 @@ if __name__ == "__main__":
 
     if options.init:
         init()
+    elif options.migrate:
+        if STORAGE_BACKEND != "sql":
+            parser.error("migration requires the sql storage backend")
+        logging.basicConfig(level=logging.INFO)
+        init()
+        add_missing_columns()
+        create_missing_indexes()
+        migrate_stack_info()
+    elif options.compact:
+        if STORAGE_BACKEND != "sql":
+            parser.error("compaction requires the sql storage backend")
+        logging.basicConfig(level=logging.INFO)
+        compact_records(options.retention_days, options.keep_slowest)
+        downsample_rollups(options.daily_rollup_days)
     else:
         app.run(host=options.host, port=options.port)
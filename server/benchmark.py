@@ -0,0 +1,432 @@
+"""
+Load-testing benchmark of the PySample server.
+
+Drive the ingest apis ("/sample/add", "/sample/add_batch") and the query apis
+("/sample/get", "/sample/search", "/sample/flamegraph") with synthetic folded
+profiles, and report the throughput and the latency percentiles.
+
+By default the server is run in-process (flask test client) against a temporary
+SQLite database or embedded storage, so no server or database is required:
+
+    python -m server.benchmark --backend sqlite --requests 2000 --concurrency 4
+    python -m server.benchmark --backend embedded --depth 60 --width 200
+
+Or benchmark a running server:
+
+    python -m server.benchmark --url http://127.0.0.1:10002 --project bench
+
+The server settings (e.g. ASYNC_INGEST, STACK_STORAGE, FLAMEGRAPH_PATH) are read
+from the environment as usual.
+"""
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import zlib
+import random
+import optparse
+import tempfile
+import threading
+import urllib.request
+from urllib.error import HTTPError
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+def make_profile(depth: int, width: int, rng: random.Random) -> str:
+    """
+    Generate a synthetic folded profile.
+
+    The profile has "width" distinct stacks of about "depth" frames. Like the real
+    profiles, the stacks share the prefixes (the framework frames) and branch
+    towards the leaves.
+    """
+    functions = [
+        f"func_{i} (pkg/module_{i % 17}.py:{rng.randint(1, 500)})"
+        for i in range(0, max(depth * 4, 16))
+    ]
+    stacks: Dict[str, int] = {}
+    previous: List[str] = []
+    while len(stacks) < width:
+        prefix = previous[:rng.randint(0, len(previous))]
+        length = max(1, depth + rng.randint(-depth // 4, depth // 4))
+        frames = prefix + [rng.choice(functions) for _ in range(len(prefix), length)]
+        stacks[";".join(frames) + ";"] = rng.randint(1, 100)
+        previous = frames
+    return "".join(f"{frames} {count}\n" for frames, count in stacks.items())
+
+
+def make_record(stack_info: str, name: str, rng: random.Random) -> Dict[str, Any]:
+    return {
+        "name": name,
+        "sample_id": uuid.uuid4().hex,
+        "process_id": os.getpid(),
+        "thread_id": threading.get_ident(),
+        "timestamp": time.time(),
+        "stack_info": stack_info,
+        "execution_time": rng.randint(100, 5000),
+    }
+
+
+def percentile(latencies: List[float], p: float) -> float:
+    """
+    Returns the nearest-rank percentile of the sorted latencies.
+    """
+    if not latencies:
+        return 0.0
+    return latencies[max(0, math.ceil(p / 100 * len(latencies)) - 1)]
+
+
+class LocalClient:
+    """
+    Send the requests to the in-process server with the flask test client.
+    """
+
+    def __init__(self, app):
+        self._client = app.test_client()
+
+    def post(self, path: str, data: bytes) -> Tuple[int, bytes]:
+        rv = self._client.post(path, data=data)
+        return rv.status_code, rv.data
+
+    def get(self, path: str) -> Tuple[int, bytes]:
+        rv = self._client.get(path)
+        return rv.status_code, rv.data
+
+
+class HttpClient:
+    """
+    Send the requests to a running server.
+    """
+
+    def __init__(self, url: str, timeout: float = 30):
+        self._url = url.rstrip("/")
+        self._timeout = timeout
+
+    def _request(self, request: urllib.request.Request) -> Tuple[int, bytes]:
+        try:
+            with urllib.request.urlopen(request, timeout=self._timeout) as response:
+                return response.status, response.read()
+        except HTTPError as e:
+            return e.code, e.read()
+
+    def post(self, path: str, data: bytes) -> Tuple[int, bytes]:
+        headers = {
+            "Content-Encoding": "deflate",
+            "Content-Type": "application/octet-stream",
+        }
+        return self._request(
+            urllib.request.Request(self._url + path, data=data, headers=headers, method="POST")
+        )
+
+    def get(self, path: str) -> Tuple[int, bytes]:
+        return self._request(urllib.request.Request(self._url + path))
+
+
+class Result:
+    def __init__(self, name: str):
+        self.name = name
+        self.requests = 0
+        self.records = 0
+        self.errors = 0
+        self.elapsed = 0.0
+        self.latencies: List[float] = []
+
+    def to_dict(self) -> Dict[str, Any]:
+        latencies = sorted(self.latencies)
+        elapsed = self.elapsed or 1e-9
+        return {
+            "name": self.name,
+            "requests": self.requests,
+            "records": self.records,
+            "errors": self.errors,
+            "elapsed": round(self.elapsed, 3),
+            "requests_per_second": round(self.requests / elapsed, 1),
+            "records_per_second": round(self.records / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "max_ms": round((latencies[-1] if latencies else 0) * 1000, 2),
+        }
+
+
+def _is_success(status: int, body: bytes) -> bool:
+    if status >= 400:
+        return False
+    try:
+        data = json.loads(body)
+    except ValueError:
+        # not a json response, e.g. the flame graph
+        return True
+    return not isinstance(data, dict) or data.get("success", True)
+
+
+def run_requests(
+    name: str,
+    make_client: Callable[[], Any],
+    jobs: List[Tuple[str, str, Optional[bytes], int]],
+    concurrency: int,
+) -> Result:
+    """
+    Run the (method, path, data, records) jobs with "concurrency" threads.
+    """
+    result = Result(name)
+    lock = threading.Lock()
+    iterator = iter(jobs)
+
+    def worker():
+        client = make_client()
+        latencies, errors, requests, records = [], 0, 0, 0
+        while True:
+            with lock:
+                job = next(iterator, None)
+            if job is None:
+                break
+            method, path, data, count = job
+            start = time.perf_counter()
+            if method == "POST":
+                status, body = client.post(path, data)
+            else:
+                status, body = client.get(path)
+            latencies.append(time.perf_counter() - start)
+            requests += 1
+            if _is_success(status, body):
+                records += count
+            else:
+                errors += 1
+
+        with lock:
+            result.latencies.extend(latencies)
+            result.errors += errors
+            result.requests += requests
+            result.records += records
+
+    threads = [threading.Thread(target=worker) for _ in range(0, concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def _compress(data: Any) -> bytes:
+    return zlib.compress(json.dumps(data).encode("utf8"))
+
+
+def run_benchmark(
+    make_client: Callable[[], Any],
+    scenarios: List[str],
+    project: str = "benchmark",
+    requests: int = 1000,
+    batch_size: int = 100,
+    concurrency: int = 1,
+    depth: int = 30,
+    width: int = 50,
+    profiles: int = 20,
+    flamegraph_widths: Tuple[int, ...] = (10, 100, 1000),
+    flamegraph_requests: int = 10,
+    seed: int = 0,
+    on_result: Optional[Callable[[Result], None]] = None,
+) -> List[Result]:
+    """
+    Run the scenarios and returns the results.
+
+    :param make_client:
+        Create a client ("LocalClient" or "HttpClient") for each thread.
+    :param scenarios:
+        The scenarios to run: "add", "add_batch", "get", "search", "flamegraph".
+    :param requests:
+        The number of requests of each ingest and query scenario.
+    :param profiles:
+        The number of distinct profiles sent by the ingest scenarios, each one
+        is a different endpoint.
+    :param flamegraph_widths:
+        The flame graph latency is measured for each profile width.
+    """
+    rng = random.Random(seed)
+    stacks = [make_profile(depth, width, rng) for _ in range(0, profiles)]
+    names = [f"/benchmark/endpoint/{i}" for i in range(0, profiles)]
+    sample_ids: List[str] = []
+    results = []
+
+    def report(result: Result):
+        results.append(result)
+        if on_result:
+            on_result(result)
+
+    def new_record() -> Dict[str, Any]:
+        i = rng.randrange(0, profiles)
+        record = make_record(stacks[i], names[i], rng)
+        sample_ids.append(record["sample_id"])
+        return record
+
+    if "add" in scenarios:
+        jobs = [
+            ("POST", f"/sample/add/{project}", _compress(new_record()), 1)
+            for _ in range(0, requests)
+        ]
+        report(run_requests("add", make_client, jobs, concurrency))
+
+    if "add_batch" in scenarios:
+        jobs = []
+        for _ in range(0, max(1, requests // batch_size)):
+            records = [new_record() for _ in range(0, batch_size)]
+            jobs.append(
+                ("POST", f"/sample/add_batch/{project}", _compress({"records": records}), batch_size)
+            )
+        report(run_requests(f"add_batch({batch_size})", make_client, jobs, concurrency))
+
+    if not sample_ids and {"get", "search", "flamegraph"} & set(scenarios):
+        # the query scenarios need some records
+        records = [new_record() for _ in range(0, min(requests, 1000))]
+        client = make_client()
+        for i in range(0, len(records), batch_size):
+            client.post(
+                f"/sample/add_batch/{project}",
+                _compress({"records": records[i:i + batch_size]}),
+            )
+
+    if "get" in scenarios:
+        jobs = [
+            ("GET", f"/sample/get/{project}/{rng.choice(sample_ids)}", None, 1)
+            for _ in range(0, requests)
+        ]
+        report(run_requests("get", make_client, jobs, concurrency))
+
+    if "search" in scenarios:
+        jobs = [
+            ("GET", f"/sample/search?project={project}&name={rng.choice(names)}&limit=50", None, 1)
+            for _ in range(0, requests)
+        ]
+        report(run_requests("search", make_client, jobs, concurrency))
+
+    if "flamegraph" in scenarios:
+        client = make_client()
+        for flamegraph_width in flamegraph_widths:
+            stack_info = make_profile(depth, flamegraph_width, rng)
+            ids = []
+            records = []
+            for _ in range(0, flamegraph_requests):
+                record = make_record(stack_info, f"/benchmark/flamegraph/{flamegraph_width}", rng)
+                records.append(record)
+                ids.append(record["sample_id"])
+            client.post(f"/sample/add_batch/{project}", _compress({"records": records}))
+
+            # cold: rendered for each record, warm: served from the cache
+            for name in ("cold", "warm"):
+                jobs = [("GET", f"/sample/flamegraph/{project}/{i}", None, 1) for i in ids]
+                report(
+                    run_requests(
+                        f"flamegraph(width={flamegraph_width},{name})", make_client, jobs, 1
+                    )
+                )
+
+    return results
+
+
+def format_result(result: Result) -> str:
+    d = result.to_dict()
+    return (
+        f"{d['name']:<32} requests={d['requests']:<6} records/s={d['records_per_second']:<10} "
+        f"p50={d['p50_ms']}ms p99={d['p99_ms']}ms max={d['max_ms']}ms errors={d['errors']}"
+    )
+
+
+def load_local_app(backend: str, path: str):
+    """
+    Configure the environment and import the server application.
+    """
+    if backend == "embedded":
+        os.environ["STORAGE_BACKEND"] = "embedded"
+        os.environ["STORAGE_PATH"] = path
+    else:
+        os.environ["STORAGE_BACKEND"] = "sql"
+        os.environ["DATABASE_URI"] = f"sqlite:///{os.path.join(path, 'benchmark.db')}"
+
+    try:
+        from server import app as module
+    except ImportError:
+        import app as module
+
+    if backend != "embedded":
+        with module.app.app_context():
+            module.init()
+    return module
+
+
+def main():
+    usage = "%prog [--url url | --backend sqlite|embedded] [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--url", default=None, help="benchmark a running server")
+    parser.add_option(
+        "--backend",
+        default="sqlite",
+        choices=["sqlite", "embedded"],
+        help="the storage of the in-process server: sqlite or embedded",
+    )
+    parser.add_option(
+        "--path",
+        default=None,
+        help="the directory of the database or embedded storage, a temporary directory by default",
+    )
+    parser.add_option("--project", default="benchmark", help="the project of the records")
+    parser.add_option(
+        "--scenarios",
+        default="add,add_batch,get,search,flamegraph",
+        help="comma separated scenarios: add, add_batch, get, search, flamegraph",
+    )
+    parser.add_option("--requests", type=int, default=1000, help="requests per scenario")
+    parser.add_option("--batch_size", type=int, default=100, help="records per batch request")
+    parser.add_option("--concurrency", type=int, default=1, help="number of client threads")
+    parser.add_option("--depth", type=int, default=30, help="frames per stack")
+    parser.add_option("--width", type=int, default=50, help="distinct stacks per profile")
+    parser.add_option("--profiles", type=int, default=20, help="number of distinct profiles")
+    parser.add_option(
+        "--flamegraph_widths",
+        default="10,100,1000",
+        help="comma separated profile widths of the flame graph scenario",
+    )
+    parser.add_option(
+        "--flamegraph_requests", type=int, default=10, help="requests per flame graph width"
+    )
+    parser.add_option("--seed", type=int, default=0, help="the random seed")
+    parser.add_option("--json", action="store_true", help="print the results as json")
+
+    options, args = parser.parse_args()
+
+    if options.url:
+        def make_client():
+            return HttpClient(options.url)
+    else:
+        path = options.path or tempfile.mkdtemp(prefix="pysample_benchmark_")
+        module = load_local_app(options.backend, path)
+        if "flamegraph" in options.scenarios and not module.FLAMEGRAPH_PATH:
+            print("'FLAMEGRAPH_PATH' is not configured, skip the flamegraph scenario", file=sys.stderr)
+            options.scenarios = options.scenarios.replace("flamegraph", "")
+
+        def make_client():
+            return LocalClient(module.app)
+
+    results = run_benchmark(
+        make_client,
+        [scenario for scenario in options.scenarios.split(",") if scenario],
+        project=options.project,
+        requests=options.requests,
+        batch_size=options.batch_size,
+        concurrency=options.concurrency,
+        depth=options.depth,
+        width=options.width,
+        profiles=options.profiles,
+        flamegraph_widths=tuple(int(w) for w in options.flamegraph_widths.split(",") if w),
+        flamegraph_requests=options.flamegraph_requests,
+        seed=options.seed,
+        on_result=None if options.json else lambda result: print(format_result(result)),
+    )
+    if options.json:
+        print(json.dumps([result.to_dict() for result in results], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -88,6 +88,9 @@ setup(
     ext_modules=CYTHON_EXTENSION_MODULES,
     zip_safe=False,
     entry_points={
-        'console_scripts': ['pysample=pysample.command_line:main'],
+        'console_scripts': [
+            'pysample=pysample.command_line:main',
+            'pysample-agent=pysample.agent:main',
+        ],
     }
 )
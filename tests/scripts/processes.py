@@ -0,0 +1,17 @@
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+def child_work(_=None):
+    time.sleep(0.2)
+
+
+if __name__ == '__main__':
+    process = multiprocessing.Process(target=child_work, name="etl-child")
+    process.start()
+    process.join()
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        list(executor.map(child_work, range(1)))
+    with multiprocessing.Pool(1) as pool:
+        pool.map(child_work, range(1))
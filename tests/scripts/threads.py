@@ -0,0 +1,15 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def worker():
+    time.sleep(0.2)
+
+
+if __name__ == '__main__':
+    thread = threading.Thread(target=worker, name="etl-worker")
+    thread.start()
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="etl-pool") as executor:
+        list(executor.map(lambda _: worker(), range(2)))
+    thread.join()
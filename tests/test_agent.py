@@ -0,0 +1,113 @@
+import json
+import zlib
+import shutil
+import tempfile
+import unittest
+from urllib.error import URLError
+from urllib.request import HTTPError
+from mock import MagicMock, patch
+
+from pysample.agent import BatchTransport, CollectorAgent
+from pysample.transport import DiskSpool, ThreadTransport
+
+
+def _encode(data) -> bytes:
+    return zlib.compress(json.dumps(data).encode("utf8"))
+
+
+class TestCollectorAgent(unittest.TestCase):
+    def _make_agent(self, batch_size: int = 100):
+        transport = MagicMock()
+        agent = CollectorAgent("/tmp/pysample-test-agent.sock", transport, batch_size=batch_size)
+        return agent, transport
+
+    def test_split_url(self):
+        self.assertEqual(
+            CollectorAgent.split_url("http://localhost:8000/prefix/sample/add/proj"),
+            ("http://localhost:8000/prefix", "proj"),
+        )
+        self.assertIsNone(CollectorAgent.split_url("http://localhost:8000/other"))
+
+    def test_dedup_and_batch(self):
+        agent, transport = self._make_agent(batch_size=3)
+        url = "http://localhost:8000/sample/add/proj"
+        for sample_id in ["a", "b", "a", "c"]:
+            agent.handle_record(url, {}, _encode({"sample_id": sample_id, "execution_time": 10}))
+
+        url, headers, data = transport.send.call_args[0]
+        self.assertEqual(url, "http://localhost:8000/sample/add_batch/proj")
+        self.assertEqual(headers["Content-Encoding"], "deflate")
+        records = json.loads(zlib.decompress(data))["records"]
+        self.assertEqual([r["sample_id"] for r in records], ["a", "b", "c"])
+
+    def test_flush(self):
+        agent, transport = self._make_agent()
+        agent.handle_record(
+            "http://localhost:8000/sample/add/proj1", {}, _encode({"sample_id": "a"})
+        )
+        agent.handle_record(
+            "http://localhost:8000/sample/add/proj2", {}, _encode({"sample_id": "a"})
+        )
+        self.assertEqual(transport.send.call_count, 0)
+
+        agent.flush()
+        urls = sorted(c[0][0] for c in transport.send.call_args_list)
+        self.assertEqual(
+            urls,
+            [
+                "http://localhost:8000/sample/add_batch/proj1",
+                "http://localhost:8000/sample/add_batch/proj2",
+            ],
+        )
+
+    def test_forward_unknown_record(self):
+        agent, transport = self._make_agent()
+        agent.handle_record("http://localhost:8000/other", {}, b"data")
+        transport.send.assert_called_once_with(
+            "http://localhost:8000/other", {}, b"data", priority=0
+        )
+
+
+class TestBatchTransport(unittest.TestCase):
+    def test_fallback_to_single_api(self):
+        url = "http://localhost:8000/sample/add_batch/proj"
+        data = _encode({"records": [{"sample_id": "a"}, {"sample_id": "b"}]})
+        not_found = HTTPError(url, 404, "NOT FOUND", {}, None)
+        with patch.object(
+            ThreadTransport, "_send_request", side_effect=[not_found, None, None, None]
+        ) as send_request:
+            transport = BatchTransport()
+            transport._send_request(url, {}, data)
+            self.assertEqual(send_request.call_count, 3)
+            self.assertEqual(send_request.call_args[0][0], "http://localhost:8000/sample/add/proj")
+
+            transport._send_request(url, {}, _encode({"records": [{"sample_id": "c"}]}))
+            self.assertEqual(send_request.call_count, 4)
+
+    def test_fallback_spool_unsent_records(self):
+        url = "http://localhost:8000/sample/add_batch/proj"
+        records = [{"sample_id": sample_id} for sample_id in "abcd"]
+        not_found = HTTPError(url, 404, "NOT FOUND", {}, None)
+        bad_request = HTTPError(url, 400, "BAD REQUEST", {}, None)
+        directory = tempfile.mkdtemp(prefix="pysample_spool_")
+        self.addCleanup(shutil.rmtree, directory, True)
+        spool = DiskSpool(directory)
+
+        with patch.object(
+            ThreadTransport,
+            "_send_request",
+            side_effect=[not_found, None, bad_request, URLError("refused")],
+        ):
+            transport = BatchTransport(spool=spool)
+            data = _encode({"records": records})
+            try:
+                transport._send_request(url, {}, data)
+            except Exception as e:
+                transport._handle_failure(url, {}, data, e)
+            else:
+                self.fail("the error is not raised")
+
+        spooled = spool.read_batch(10)
+        self.assertEqual([record[0] for record in spooled], [url])
+        self.assertEqual(json.loads(zlib.decompress(spooled[0][2])), {"records": records[2:]})
+        self.assertEqual(transport.stats()["spooled"], 1)
@@ -0,0 +1,81 @@
+import os
+import json
+import zlib
+import time
+import tempfile
+import unittest
+from mock import MagicMock
+
+from pysample.aggregator import AggregatorServer, UnixSocketTransport
+
+
+class TestAggregator(unittest.TestCase):
+    def setUp(self) -> None:
+        self._path = os.path.join(tempfile.mkdtemp(prefix="pysample_agg_"), "agg.sock")
+        self._transport = MagicMock()
+        self._aggregator = AggregatorServer(self._path, self._transport)
+        self._aggregator.start()
+
+    def tearDown(self) -> None:
+        self._aggregator.stop()
+        os.rmdir(os.path.dirname(self._path))
+
+    def _wait_for_calls(self, count: int):
+        for _ in range(0, 100):
+            if self._transport.send.call_count >= count:
+                break
+            time.sleep(0.01)
+
+    def test_forward(self):
+        transport = UnixSocketTransport(self._path)
+        headers = {"Content-Encoding": "deflate"}
+        transport._send_request("http://localhost/sample/add/proj", headers, b"data1")
+        transport._send_request("http://localhost/sample/add/proj", headers, b"data2")
+        transport._close()
+
+        self._wait_for_calls(2)
+        calls = [c[0] for c in self._transport.send.call_args_list]
+        self.assertEqual(
+            calls,
+            [
+                ("http://localhost/sample/add/proj", headers, b"data1"),
+                ("http://localhost/sample/add/proj", headers, b"data2"),
+            ],
+        )
+
+    def test_forward_from_child_process(self):
+        transport = UnixSocketTransport(self._path)
+        transport.start()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                transport.send("http://localhost/sample/add/proj", {}, b"child")
+                for _ in range(0, 100):
+                    if transport.stats()["sent"]:
+                        code = 0
+                        break
+                    time.sleep(0.01)
+            finally:
+                os._exit(code)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        self._wait_for_calls(1)
+        self._transport.send.assert_called_once_with(
+            "http://localhost/sample/add/proj", {}, b"child", priority=0
+        )
+        transport.stop(timeout=1)
+
+    def test_forward_priority(self):
+        transport = UnixSocketTransport(self._path)
+        data = zlib.compress(json.dumps({"sample_id": "1", "execution_time": 250}).encode("utf8"))
+        transport._send_request("http://localhost/sample/add/proj", {}, data)
+        transport._close()
+
+        self._wait_for_calls(1)
+        self.assertEqual(self._transport.send.call_args[1], {"priority": 250})
+
+    def test_socket_in_use(self):
+        with self.assertRaises(RuntimeError):
+            AggregatorServer(self._path, MagicMock()).start()
@@ -5,6 +5,7 @@ import unittest
 from mock import MagicMock
 
 from pysample.client import Client
+from pysample.transport import Transport
 
 
 class TestClient(unittest.TestCase):
@@ -53,3 +54,21 @@ class TestClient(unittest.TestCase):
         self.assertIn("process_id", actual_data)
         self.assertIn("thread_id", actual_data)
         self.assertIn("timestamp", actual_data)
+
+    def test_legacy_transport(self):
+        class LegacyTransport(Transport):
+            def __init__(self):
+                self.sent = []
+
+            def send(self, url, headers, data):
+                self.sent.append(url)
+
+        transport = LegacyTransport()
+        client = self._make_test_client(transport)
+        client.capture(client.build_data("/legacy", uuid.uuid4().hex, "a;b 1\n", 20))
+        self.assertEqual(transport.sent, ["http://localhost:8000/sample/add/proj"])
+
+        mock_transport = MagicMock()
+        client = self._make_test_client(mock_transport)
+        client.capture(client.build_data("/new", uuid.uuid4().hex, "a;b 1\n", 20))
+        self.assertEqual(mock_transport.send.call_args[1], {"priority": 20})
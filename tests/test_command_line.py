@@ -0,0 +1,53 @@
+import os
+import optparse
+import unittest
+
+from pysample.command_line import execute_script
+
+SCRIPT = os.path.join(os.path.dirname(__file__), "scripts", "threads.py")
+PROCESS_SCRIPT = os.path.join(os.path.dirname(__file__), "scripts", "processes.py")
+
+
+class TestCommandLine(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.path = "/tmp/pysample_test_output/command_line.txt"
+
+    def tearDown(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _execute(self, script=SCRIPT, **kwargs):
+        options = optparse.Values(dict(interval=10, **kwargs))
+        execute_script(script, options, self.path)
+        with open(self.path, "r") as file:
+            return file.read().splitlines()
+
+    def _roots(self, lines):
+        return {line.split(";", 1)[0] for line in lines}
+
+    def test_main_thread_only(self):
+        lines = self._execute()
+        self.assertFalse(any("worker (" in line for line in lines))
+
+    def test_all_threads(self):
+        roots = self._roots(self._execute(all_threads=True))
+        self.assertIn("MainThread", roots)
+        self.assertIn("etl-worker", roots)
+        self.assertIn("etl-pool_0", roots)
+        self.assertFalse(any(root.startswith("PySample.") for root in roots))
+
+    def test_thread_filter(self):
+        roots = self._roots(self._execute(all_threads=True, thread_filter=["^etl-pool"]))
+        self.assertIn("etl-pool_0", roots)
+        self.assertTrue(all(root.startswith("etl-pool_") for root in roots))
+
+    def test_multiprocessing(self):
+        lines = self._execute(PROCESS_SCRIPT, multiprocessing=True)
+        roots = self._roots(lines)
+        self.assertIn(f"MainProcess [{os.getpid()}]", roots)
+        children = [root for root in roots if not root.startswith("MainProcess")]
+        self.assertTrue(any(root.startswith("etl-child [") for root in children), roots)
+        # the worker of ProcessPoolExecutor and the worker of Pool
+        self.assertGreaterEqual(len(children), 3, roots)
+        self.assertTrue(any("child_work (" in line for line in lines if not line.startswith("MainProcess")))
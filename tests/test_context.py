@@ -2,10 +2,13 @@ import os
 import sys
 import inspect
 import unittest
+import threading
 from types import FrameType
 from typing import List
 
-from pysample.context import SampleContext
+from pysample._cython.sample import PySampleTraceback
+from pysample.context import CounterPool, SampleContext, SampleContextManager
+from pysample.timer import ThreadSampleContext, ThreadSampleTimer
 
 
 class TestContext(unittest.TestCase):
@@ -70,6 +73,51 @@ class TestContext(unittest.TestCase):
         output = ctx.flame_output()
         self.assertEqual(output, "")
 
+    def test_counter_pool(self):
+        pool = CounterPool(size=1)
+        counter = pool.acquire(10)
+        counter.add_frame(inspect.currentframe())
+        self.assertNotEqual(counter.flame_output(), "")
+
+        pool.release(counter)
+        pool.release(pool.acquire(10))
+        self.assertEqual(len(pool), 1)
+
+        reused = pool.acquire(20)
+        self.assertIs(reused, counter)
+        self.assertEqual(reused.flame_output(), "")
+        reused.add_frame(inspect.currentframe())
+        self.assertTrue(reused.flame_output().endswith(" 20\n"))
+
+    def test_close_and_lazy_ident(self):
+        ctx = SampleContext("test", 10)
+        self.assertIsNone(ctx._uuid)
+        ident = ctx.ident
+        self.assertEqual(ctx.ident, ident)
+
+        ctx.close()
+        ctx.collect(inspect.currentframe())
+        self.assertEqual(ctx.flame_output(), "")
+
+    def test_shared_traceback(self):
+        outer = ThreadSampleContext("outer", 10, threading.get_ident())
+        inner = ThreadSampleContext("inner", 10, threading.get_ident())
+        manager = SampleContextManager()
+        manager.push(outer)
+        manager.push(inner)
+
+        timer = ThreadSampleTimer(10, manager)
+        for _ in range(2):
+            timer._sample_once()
+        self.assertEqual(outer.flame_output(), inner.flame_output())
+        self.assertTrue(outer.flame_output().endswith(" 20\n"))
+
+        ctx = SampleContext("test", 10)
+        traceback = PySampleTraceback(inspect.currentframe())
+        ctx.collect_traceback(traceback)
+        ctx.collect_traceback(traceback)
+        self.assertTrue(ctx.flame_output().endswith(" 20\n"))
+
 
 if __name__ == "__main__":
     unittest.main(defaultTest="TestContext.test_collect_and_output")
\ No newline at end of file
@@ -0,0 +1,155 @@
+import json
+import zlib
+import time
+import asyncio
+import unittest
+from mock import MagicMock
+
+from pysample.client import Client
+from pysample.contrib.asgi import ASGISampleMiddleware
+from pysample.contrib.common import normalize_path
+from pysample.contrib.wsgi import WSGISampleMiddleware, ROUTE_ENVIRON_KEY
+from pysample.timer import timer_started, stop_timer
+
+
+class TestMiddleware(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.transport = MagicMock()
+        self.client = Client("http://localhost:8000/proj", self.transport)
+
+    def tearDown(self) -> None:
+        if timer_started():
+            stop_timer()
+
+    def _sent_records(self):
+        return [json.loads(zlib.decompress(call[0][2])) for call in self.transport.send.call_args_list]
+
+    def test_normalize_path(self):
+        self.assertEqual(normalize_path("/users/42/orders"), "/users/{int}/orders")
+        self.assertEqual(
+            normalize_path("/files/6f1c2a3b-1d2e-4f5a-8b9c-0d1e2f3a4b5c"), "/files/{uuid}"
+        )
+        self.assertEqual(normalize_path("/commits/0123456789abcdef01"), "/commits/{hex}")
+        self.assertEqual(normalize_path("/static/app.js"), "/static/app.js")
+
+    def test_wsgi(self):
+        def app(environ, start_response):
+            time.sleep(0.05)
+            if environ["PATH_INFO"].startswith("/named"):
+                environ[ROUTE_ENVIRON_KEY] = "/named/<id>"
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return [b"ok"]
+
+        middleware = WSGISampleMiddleware(app, client=self.client, interval=10, output_threshold=20)
+        for path in ["/users/1", "/named/2"]:
+            start_response = MagicMock()
+            body = middleware({"PATH_INFO": path}, start_response)
+            self.assertEqual(list(body), [b"ok"])
+            headers = dict(start_response.call_args[0][1])
+            self.assertTrue(headers["X-PySample-ID"].startswith("proj/"))
+
+        names = [record["name"] for record in self._sent_records()]
+        self.assertEqual(names, ["/users/{int}", "/named/<id>"])
+
+    def test_wsgi_lazy_start_response(self):
+        def app(environ, start_response):
+            start_response("200 OK", [])
+            time.sleep(0.05)
+            yield b"ok"
+
+        middleware = WSGISampleMiddleware(app, client=self.client, interval=10, output_threshold=20)
+        body = middleware({"PATH_INFO": "/stream"}, MagicMock())
+        self.assertEqual(list(body), [b"ok"])
+        body.close()
+        # ended at "start_response", before the body takes its time
+        self.assertEqual(self._sent_records(), [])
+
+    def test_flask_sampling_rates(self):
+        from flask import Flask
+        from pysample.contrib.flask import FlaskSample
+
+        app = Flask(__name__)
+
+        @app.route("/slow/<int:item_id>")
+        def slow(item_id):
+            time.sleep(0.05)
+            return str(item_id)
+
+        @app.route("/skipped")
+        def skipped():
+            time.sleep(0.05)
+            return "ok"
+
+        fsample = FlaskSample(
+            client=self.client,
+            interval=10,
+            output_threshold=20,
+            sampling_rates={"/skipped": 0},
+            max_concurrency=1,
+        )
+        fsample.init_app(app)
+        with app.test_client() as client:
+            self.assertIn("X-PySample-ID", client.get("/slow/1").headers)
+            self.assertNotIn("X-PySample-ID", client.get("/skipped").headers)
+        self.assertEqual([record["name"] for record in self._sent_records()], ["/slow/1"])
+        self.assertEqual(fsample._policy.active, 0)
+
+    def test_flask_positional_arguments(self):
+        from pysample.contrib.flask import FlaskSample
+
+        fsample = FlaskSample(None, self.client, 20, 200)
+        self.assertIs(fsample._client, self.client)
+        self.assertEqual((fsample._interval, fsample._output_threshold), (20, 200))
+
+    def test_flask_truncate_root(self):
+        from flask import Flask
+        from pysample.contrib.flask import FlaskSample
+
+        app = Flask(__name__)
+
+        @app.route("/slow")
+        def slow():
+            time.sleep(0.1)
+            return "ok"
+
+        fsample = FlaskSample(client=self.client, interval=10, output_threshold=20, truncate_root=True)
+        fsample.init_app(app)
+        with app.test_client() as client:
+            client.get("/slow")
+
+        stack_info = self._sent_records()[0]["stack_info"]
+        for line in stack_info.splitlines():
+            self.assertTrue(line.startswith("/slow;dispatch_request ("), line)
+            self.assertIn(";slow (", line)
+            self.assertNotIn("full_dispatch_request", line)
+
+    def test_asgi(self):
+        class Route(object):
+            path = "/items/{item_id}"
+
+        async def app(scope, receive, send):
+            await asyncio.sleep(0.05)
+            scope["route"] = Route()
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b"ok"})
+
+        middleware = ASGISampleMiddleware(app, client=self.client, interval=10, output_threshold=20)
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        async def receive():
+            return {"type": "http.request"}
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(middleware({"type": "http", "path": "/items/3"}, receive, send))
+            loop.run_until_complete(middleware({"type": "lifespan"}, receive, send))
+        finally:
+            loop.close()
+
+        headers = dict(messages[0]["headers"])
+        self.assertTrue(headers[b"x-pysample-id"].startswith(b"proj/"))
+        self.assertEqual([record["name"] for record in self._sent_records()], ["/items/{item_id}"])
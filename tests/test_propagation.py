@@ -0,0 +1,68 @@
+import os
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from pysample.propagation import ContextExecutor, SampleThread, current_context, wrap
+from pysample.sampler import sample
+from pysample.timer import timer_started, stop_timer
+
+
+def worker_task():
+    time.sleep(0.1)
+
+
+class TestPropagation(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.path = "/tmp/pysample_test_output/propagation.txt"
+
+    def tearDown(self) -> None:
+        if timer_started():
+            stop_timer()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _read_output(self) -> str:
+        with open(self.path, "r") as file:
+            return file.read()
+
+    def test_executor(self):
+        executor = ContextExecutor(ThreadPoolExecutor(max_workers=2))
+
+        @sample(10, 0, self.path)
+        def foo():
+            list(executor.map(lambda _: worker_task(), range(2)))
+
+        foo()
+        executor.shutdown()
+        self.assertIn("worker_task (", self._read_output())
+
+    def test_thread(self):
+        contexts = []
+
+        @sample(10, 0, self.path, truncate_root=True)
+        def foo():
+            def target():
+                contexts.append(current_context())
+                worker_task()
+
+            thread = SampleThread(target=target)
+            thread.start()
+            thread.join()
+            contexts.append(current_context())
+
+        foo()
+        self.assertIsNotNone(contexts[0])
+        self.assertIs(contexts[0], contexts[1])
+        self.assertEqual(contexts[0].attached_threads(), [])
+
+        worker_lines = [line for line in self._read_output().splitlines() if "worker_task (" in line]
+        self.assertTrue(worker_lines)
+        for line in worker_lines:
+            # the frames of the thread bootstrap are truncated
+            self.assertNotIn("_bootstrap", line)
+
+    def test_wrap_without_context(self):
+        self.assertIsNone(current_context())
+        self.assertIs(wrap(worker_task), worker_task)
@@ -0,0 +1,81 @@
+import time
+import unittest
+from typing import List
+
+from pysample.context import SampleResult
+from pysample.repository import OutputRepository, TailSamplingRepository
+
+
+class MemoryRepository(OutputRepository):
+    def __init__(self):
+        self.results: List[SampleResult] = []
+
+    def store(self, sample_context):
+        self.results.append(sample_context)
+
+
+class TestTailSamplingRepository(unittest.TestCase):
+    def _result(self, name: str, lifecycle: int, stack_info: str = "a;b 10\n"):
+        return SampleResult(name, f"{name}-{lifecycle}", stack_info, lifecycle)
+
+    def test_keep_slowest(self):
+        inner = MemoryRepository()
+        repo = TailSamplingRepository(inner, size=2, window=3600)
+        for lifecycle in [100, 500, 200, 300]:
+            repo.store(self._result("/foo", lifecycle))
+        repo.store(self._result("/bar", 150))
+        self.assertEqual(inner.results, [])
+
+        repo.flush()
+        names = [(r.name, r.lifecycle) for r in inner.results]
+        self.assertEqual(
+            names,
+            [
+                ("/foo", 500),
+                ("/foo", 300),
+                ("/foo (aggregate)", 200),
+                ("/bar", 150),
+            ],
+        )
+        self.assertEqual(inner.results[2].flame_output(), "a;b 20\n")
+
+    def test_without_aggregate(self):
+        inner = MemoryRepository()
+        repo = TailSamplingRepository(inner, size=1, window=3600, aggregate=False)
+        for lifecycle in [100, 200, 300]:
+            repo.store(self._result("/foo", lifecycle))
+        repo.flush()
+        self.assertEqual([r.lifecycle for r in inner.results], [300])
+
+    def test_reservoir(self):
+        inner = MemoryRepository()
+        repo = TailSamplingRepository(
+            inner, size=3, window=3600, strategy=TailSamplingRepository.RESERVOIR
+        )
+        for lifecycle in range(0, 100):
+            repo.store(self._result("/foo", lifecycle))
+        repo.flush()
+        self.assertEqual(len(inner.results), 4)
+        self.assertEqual(inner.results[-1].name, "/foo (aggregate)")
+
+    def test_window_expired(self):
+        inner = MemoryRepository()
+        repo = TailSamplingRepository(inner, size=1, window=0)
+        repo.store(self._result("/foo", 100))
+        repo.store(self._result("/foo", 200))
+        self.assertEqual([r.lifecycle for r in inner.results], [100])
+
+    def test_window_expired_in_background(self):
+        inner = MemoryRepository()
+        repo = TailSamplingRepository(inner, size=1, window=0.1)
+        repo.store(self._result("/foo", 100))
+        for _ in range(50):
+            if inner.results:
+                break
+            time.sleep(0.02)
+        self.assertEqual([r.lifecycle for r in inner.results], [100])
+
+        repo.store(self._result("/foo", 200))
+        repo.close()
+        self.assertEqual([r.lifecycle for r in inner.results], [100, 200])
+        self.assertIsNone(repo._thread)
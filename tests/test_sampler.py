@@ -1,12 +1,15 @@
 import os
 import time
 import shutil
+import inspect
 import unittest
 import datetime
 from concurrent.futures import ThreadPoolExecutor
+from mock import MagicMock
 
+from pysample.context import SampleContextFactory, SampleContextManager, SampleResult
 from pysample.repository import DirectoryRepository, FileRepository
-from pysample.sampler import sample
+from pysample.sampler import sample, Sampler
 from pysample.timer import timer_started, stop_timer
 
 
@@ -43,6 +46,22 @@ class TestSamplerWithFileRepository(unittest.TestCase):
 
         self._clean_output_path(path)
 
+    def test_sample_truncate_root(self):
+        path = "/tmp/pysample_test_output/truncated.txt"
+
+        @sample(10, 0, path, truncate_root=True)
+        def foo():
+            time.sleep(0.11)
+
+        foo()
+        with open(path, 'r') as file:
+            lines = file.read().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            self.assertTrue(line.startswith(f"{foo.__module__}.{foo.__qualname__};foo ("), line)
+
+        self._clean_output_path(path)
+
     def test_for_multi_function(self):
         def foo():
             time.sleep(0.11)
@@ -195,3 +214,54 @@ class TestSamplerWithDirectoryRepository(unittest.TestCase):
         self.assertTrue(os.path.exists(subdir))
         self.assertEqual(len(os.listdir(subdir)), 0)
 
+
+class TestSamplerAfterFork(unittest.TestCase):
+    def tearDown(self) -> None:
+        if timer_started():
+            stop_timer()
+
+    def test_timer_restarted_in_child(self):
+        path = "/tmp/pysample_test_output/fork.txt"
+
+        @sample(10, 0, path)
+        def foo():
+            time.sleep(0.11)
+
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                foo()
+                with open(path, 'r') as file:
+                    if file.read():
+                        code = 0
+            finally:
+                os._exit(code)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class TestSamplerEnd(unittest.TestCase):
+    def test_store_releases_counter(self):
+        repo = MagicMock()
+        manager = SampleContextManager()
+        sampler = Sampler(
+            interval=10,
+            output_threshold=0,
+            context_manager=manager,
+            context_factory=SampleContextFactory(),
+            output_repo=repo,
+        )
+        ctx = sampler.begin("test")
+        ctx.collect(inspect.currentframe())
+        self.assertTrue(sampler.end(ctx))
+
+        self.assertIsNone(ctx._counter)
+        self.assertEqual(list(manager.iterator()), [])
+        result = repo.store.call_args[0][0]
+        self.assertIsInstance(result, SampleResult)
+        self.assertEqual((result.name, result.ident), ("test", ctx.ident))
+        self.assertIn("test_store_releases_counter", result.flame_output())
@@ -0,0 +1,40 @@
+import time
+import unittest
+from mock import patch
+
+from pysample.sampling import SamplingPolicy
+
+
+class TestSamplingPolicy(unittest.TestCase):
+
+    def test_rates(self):
+        policy = SamplingPolicy(rate=0.5, rates={"/health": 0, "/orders": 1})
+        self.assertFalse(policy.acquire("/health"))
+        self.assertTrue(policy.acquire("/orders"))
+        with patch("random.random", return_value=0.7):
+            self.assertFalse(policy.acquire("/users"))
+        with patch("random.random", return_value=0.3):
+            self.assertTrue(policy.acquire("/users"))
+
+    def test_max_concurrency(self):
+        policy = SamplingPolicy(max_concurrency=2)
+        self.assertTrue(policy.acquire("/a"))
+        self.assertTrue(policy.acquire("/a"))
+        self.assertFalse(policy.acquire("/a"))
+        self.assertEqual(policy.active, 2)
+        policy.release()
+        self.assertTrue(policy.acquire("/a"))
+
+    def test_max_per_second(self):
+        policy = SamplingPolicy(max_per_second=2)
+        results = [policy.acquire("/a") for _ in range(5)]
+        self.assertEqual(results, [True, True, False, False, False])
+        for _ in range(2):
+            policy.release()
+
+        time.sleep(0.6)
+        self.assertTrue(policy.acquire("/a"))
+        self.assertFalse(policy.acquire("/a"))
+
+        with self.assertRaises(ValueError):
+            SamplingPolicy(max_per_second=0)
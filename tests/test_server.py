@@ -1,10 +1,14 @@
 import os
 import zlib
+import shutil
+import tempfile
 import json
 import uuid
 import time
+import datetime
 import threading
 import unittest
+from mock import patch
 
 
 class TestServer(unittest.TestCase):
@@ -60,3 +64,587 @@ class TestServer(unittest.TestCase):
             self.assertIn(b"Flame graph stack visualization", rv.data)
 
 
+
+    def _make_record(self, sample_id: str, **kwargs):
+        record = {
+            "name": "/test/path",
+            "sample_id": sample_id,
+            "process_id": os.getpid(),
+            "thread_id": threading.current_thread().ident,
+            "timestamp": time.time(),
+            "stack_info": "test_server.py 10",
+            "execution_time": 100,
+        }
+        record.update(kwargs)
+        return record
+
+    def test_sample_add_batch(self):
+        with self._app.test_client() as c:
+            project = "proj"
+            sample_ids = [uuid.uuid4().hex for _ in range(0, 3)]
+            records = [self._make_record(sample_id) for sample_id in sample_ids]
+            records.append(self._make_record(sample_ids[0]))
+            records.append(self._make_record("invalid"))
+            data = zlib.compress(json.dumps({"records": records}).encode("utf8"))
+            rv = c.post(f'/sample/add_batch/{project}', data=data)
+            resp_data = json.loads(rv.data)
+            self.assertEqual(resp_data["success"], True)
+            self.assertEqual(resp_data["inserted"], 3)
+            self.assertEqual(resp_data["duplicates"], 1)
+            self.assertEqual(list(resp_data["errors"].keys()), ["4"])
+
+            rv = c.post(f'/sample/add_batch/{project}', data=data)
+            resp_data = json.loads(rv.data)
+            self.assertEqual(resp_data["inserted"], 0)
+            self.assertEqual(resp_data["duplicates"], 4)
+
+            rv = c.get(f'/sample/get/{project}/{sample_ids[1]}')
+            resp_data = json.loads(rv.data)
+            self.assertEqual(resp_data["data"]["stack_info"], "test_server.py 10")
+
+    def test_async_ingest(self):
+        from server.app import IngestQueue
+
+        queue = IngestQueue(capacity=2, writers=1, batch_size=10)
+        with patch("server.app.ingest_queue", queue), self._app.test_client() as c:
+            project = "proj"
+            sample_id = uuid.uuid4().hex
+            data = zlib.compress(json.dumps(self._make_record(sample_id)).encode("utf8"))
+            rv = c.post(f'/sample/add/{project}', data=data)
+            self.assertEqual(rv.status_code, 202)
+            self.assertTrue(queue.flush())
+
+            rv = c.get(f'/sample/get/{project}/{sample_id}')
+            resp_data = json.loads(rv.data)
+            self.assertEqual(resp_data["data"]["sample_id"], sample_id)
+
+            records = [self._make_record(uuid.uuid4().hex) for _ in range(0, 3)]
+            data = zlib.compress(json.dumps({"records": records}).encode("utf8"))
+            rv = c.post(f'/sample/add_batch/{project}', data=data)
+            self.assertEqual(rv.status_code, 503)
+
+            rv = c.get('/sample/ingest/stats')
+            stats = json.loads(rv.data)["data"]
+            self.assertEqual(stats["written"], 1)
+            self.assertEqual(stats["rejected"], 3)
+            self.assertEqual(stats["depth"], 0)
+
+    def test_flame_graph_cache(self):
+        import gzip
+        from server.app import FlameGraphCache
+
+        cache = FlameGraphCache(max_bytes=1024 * 1024)
+        with patch("server.app.flame_graph_cache", cache), self._app.test_client() as c:
+            project = "proj"
+            sample_id = uuid.uuid4().hex
+            data = zlib.compress(json.dumps(self._make_record(sample_id)).encode("utf8"))
+            c.post(f'/sample/add/{project}', data=data)
+
+            rv = c.get(f'/sample/flamegraph/{project}/{sample_id}')
+            self.assertIn(b"Flame graph stack visualization", rv.data)
+            self.assertIsNotNone(cache.get((project, sample_id)))
+
+            with patch("server.app.render_flame_graph") as render:
+                rv = c.get(
+                    f'/sample/flamegraph/{project}/{sample_id}',
+                    headers={"Accept-Encoding": "gzip"},
+                )
+                self.assertEqual(render.call_count, 0)
+            self.assertEqual(rv.headers["Content-Encoding"], "gzip")
+            self.assertIn(b"Flame graph stack visualization", gzip.decompress(rv.data))
+
+    def test_flame_graph_failed(self):
+        from server.app import FlameGraphCache
+
+        directory = tempfile.mkdtemp(prefix="pysample_fg_")
+        self.addCleanup(shutil.rmtree, directory, True)
+        cache = FlameGraphCache(max_bytes=1024 * 1024, directory=directory)
+        with patch("server.app.flame_graph_cache", cache), \
+                patch("server.app.FLAMEGRAPH_PATH", "false"), self._app.test_client() as c:
+            project = "proj"
+            sample_id = uuid.uuid4().hex
+            data = zlib.compress(json.dumps(self._make_record(sample_id)).encode("utf8"))
+            c.post(f'/sample/add/{project}', data=data)
+
+            rv = c.get(f'/sample/flamegraph/{project}/{sample_id}')
+            self.assertFalse(json.loads(rv.data)["success"])
+            self.assertIsNone(cache.get((project, sample_id)))
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_flame_graph_cache_eviction(self):
+        from server.app import FlameGraphCache
+
+        cache = FlameGraphCache(max_bytes=10)
+        cache.put(("proj", "a"), b"12345")
+        cache.put(("proj", "b"), b"12345")
+        cache.get(("proj", "a"))
+        cache.put(("proj", "c"), b"12345")
+        self.assertIsNotNone(cache.get(("proj", "a")))
+        self.assertIsNone(cache.get(("proj", "b")))
+
+    def test_compressed_stack_storage(self):
+        from server.app import SampleRecord, db, migrate_stack_info
+
+        with self._app.test_client() as c:
+            project = "proj"
+            sample_id = uuid.uuid4().hex
+            data = zlib.compress(json.dumps(self._make_record(sample_id)).encode("utf8"))
+            c.post(f'/sample/add/{project}', data=data)
+
+            rv = c.get(f'/sample/stack/{project}/{sample_id}', headers={"Accept-Encoding": "deflate"})
+            self.assertEqual(rv.headers["Content-Encoding"], "deflate")
+            self.assertEqual(zlib.decompress(rv.data), b"test_server.py 10")
+
+            rv = c.get(f'/sample/stack/{project}/{sample_id}')
+            self.assertEqual(rv.data, b"test_server.py 10")
+
+        with self._app.app_context():
+            legacy_id = uuid.uuid4().hex
+            row = self._make_record(legacy_id, stack_info="legacy 10")
+            record = SampleRecord(
+                project="proj",
+                sample_id=legacy_id,
+                name=row["name"],
+                process_id=row["process_id"],
+                thread_id=row["thread_id"],
+                stack_info=row["stack_info"],
+                created_at=datetime.datetime.now(),
+                execution_time=row["execution_time"],
+            )
+            db.session.add(record)
+            db.session.commit()
+
+            self.assertGreaterEqual(migrate_stack_info(batch_size=2), 1)
+            record = SampleRecord.query.filter_by(sample_id=legacy_id).one()
+            self.assertIsNone(record.stack_info)
+            self.assertEqual(record.get_stack_info(), "legacy 10")
+
+    def test_deduplicated_stack_storage(self):
+        from server.app import SampleRecord, SampleRecordStack, SampleStack
+
+        stack_info = "main;handle;query 3\nmain;handle;render 2\n"
+        sample_ids = [uuid.uuid4().hex for _ in range(0, 3)]
+        with patch("server.app.STACK_STORAGE", "dedup"), self._app.test_client() as c:
+            project = "proj"
+            records = [self._make_record(i, stack_info=stack_info) for i in sample_ids]
+            data = zlib.compress(json.dumps({"records": records[:2]}).encode("utf8"))
+            rv = c.post(f'/sample/add_batch/{project}', data=data)
+            self.assertEqual(json.loads(rv.data)["inserted"], 2)
+
+            data = zlib.compress(json.dumps(records[2]).encode("utf8"))
+            self.assertTrue(json.loads(c.post(f'/sample/add/{project}', data=data).data)["success"])
+            rv = c.post(f'/sample/add/{project}', data=data)
+            self.assertFalse(json.loads(rv.data)["success"])
+
+            # Not in the folded format, stored compressed.
+            plain_id = uuid.uuid4().hex
+            data = zlib.compress(json.dumps(self._make_record(plain_id, stack_info="plain")).encode("utf8"))
+            c.post(f'/sample/add/{project}', data=data)
+
+            for sample_id in sample_ids:
+                rv = c.get(f'/sample/get/{project}/{sample_id}')
+                result = json.loads(rv.data)["data"]["stack_info"]
+                self.assertEqual(sorted(result.splitlines()), sorted(stack_info.splitlines()))
+
+                rv = c.get(f'/sample/stack/{project}/{sample_id}', headers={"Accept-Encoding": "deflate"})
+                self.assertEqual(rv.headers["Content-Encoding"], "deflate")
+                result = zlib.decompress(rv.data).decode("utf8")
+                self.assertEqual(sorted(result.splitlines()), sorted(stack_info.splitlines()))
+            rv = c.get(f'/sample/get/{project}/{plain_id}')
+            self.assertEqual(json.loads(rv.data)["data"]["stack_info"], "plain")
+
+        with self._app.app_context():
+            record_ids = [
+                r.id for r in SampleRecord.query.filter(SampleRecord.sample_id.in_(sample_ids))
+            ]
+            self.assertEqual(len(record_ids), 3)
+            rows = SampleRecordStack.query.filter(SampleRecordStack.record_id.in_(record_ids)).all()
+            self.assertEqual(len(rows), 6)
+            stack_ids = {row.stack_id for row in rows}
+            self.assertEqual(len(stack_ids), 2)
+            frames = {s.frames for s in SampleStack.query.filter(SampleStack.id.in_(stack_ids))}
+            self.assertEqual(frames, {"main;handle;query", "main;handle;render"})
+
+    def test_sample_search(self):
+        project = uuid.uuid4().hex[:16]
+        now = time.time()
+        records = [
+            self._make_record(
+                uuid.uuid4().hex,
+                name="/search/a" if i % 2 else "/search/b",
+                timestamp=now - i,
+                execution_time=i * 10,
+            )
+            for i in range(0, 10)
+        ]
+        with self._app.test_client() as c:
+            data = zlib.compress(json.dumps({"records": records}).encode("utf8"))
+            c.post(f'/sample/add_batch/{project}', data=data)
+
+            ids, cursor = [], None
+            while True:
+                url = f'/sample/search?project={project}&limit=3'
+                if cursor:
+                    url += f'&cursor={cursor}'
+                rv = json.loads(c.get(url).data)
+                self.assertLessEqual(len(rv["data"]), 3)
+                ids.extend(r["sample_id"] for r in rv["data"])
+                cursor = rv["next_cursor"]
+                if not cursor:
+                    break
+            self.assertEqual(ids, [r["sample_id"] for r in records])
+
+            rv = json.loads(c.get(
+                f'/sample/search?project={project}&name=/search/a'
+                f'&min_execution_time=30&sort=execution_time&limit=2'
+            ).data)
+            self.assertEqual([r["execution_time"] for r in rv["data"]], [90, 70])
+            self.assertNotIn("stack_info", rv["data"][0])
+            rv = json.loads(c.get(
+                f'/sample/search?project={project}&name=/search/a&min_execution_time=30'
+                f'&sort=execution_time&limit=2&cursor={rv["next_cursor"]}'
+            ).data)
+            self.assertEqual([r["execution_time"] for r in rv["data"]], [50, 30])
+            self.assertIsNone(rv["next_cursor"])
+
+            rv = json.loads(c.get(
+                f'/sample/search?project={project}&start={now - 3.5}&end={now + 1}'
+            ).data)
+            self.assertEqual(len(rv["data"]), 4)
+
+            rv = json.loads(c.get(f'/sample/search?project={project}&cursor=invalid').data)
+            self.assertEqual(rv["error"]["type"], "BadRequest")
+
+    @patch("server.app.ROLLUP_ENABLED", True)
+    def test_sample_aggregate(self):
+        project = uuid.uuid4().hex[:16]
+        hour = (int(time.time()) // 3600 - 1) * 3600
+        records = [
+            self._make_record(uuid.uuid4().hex, name="/api/orders", timestamp=hour + 10,
+                              stack_info="main;orders;query 3\nmain;orders;render 1\n"),
+            self._make_record(uuid.uuid4().hex, name="/api/orders", timestamp=hour + 20,
+                              stack_info="main;orders;query 2\n"),
+            self._make_record(uuid.uuid4().hex, name="/api/orders", timestamp=hour + 3600,
+                              stack_info="main;orders;query 5\n"),
+            self._make_record(uuid.uuid4().hex, name="/api/users", timestamp=hour + 30,
+                              stack_info="main;users 7\n"),
+        ]
+        with self._app.test_client() as c:
+            data = zlib.compress(json.dumps({"records": records[:3]}).encode("utf8"))
+            c.post(f'/sample/add_batch/{project}', data=data)
+            # Duplicates are not counted twice.
+            c.post(f'/sample/add_batch/{project}', data=data)
+            c.post(f'/sample/add/{project}', data=zlib.compress(json.dumps(records[3]).encode("utf8")))
+
+            rv = c.get(f'/sample/aggregate/{project}?name=/api/orders')
+            self.assertEqual(
+                sorted(rv.data.decode("utf8").splitlines()),
+                ["main;orders;query 10", "main;orders;render 1"],
+            )
+
+            rv = c.get(f'/sample/aggregate/{project}?start={hour + 100}&end={hour + 3600}')
+            self.assertEqual(
+                sorted(rv.data.decode("utf8").splitlines()),
+                ["main;orders;query 5", "main;orders;render 1", "main;users 7"],
+            )
+
+            rv = c.get(f'/sample/aggregate/{project}?name=/api/orders&format=flamegraph')
+            self.assertIn(b"Flame graph stack visualization", rv.data)
+
+    @patch("server.app.ROLLUP_ENABLED", True)
+    def test_rollup_overlapping_batches(self):
+        from server.app import (
+            SampleRecord,
+            SampleRollup,
+            build_record_row,
+            insert_ignore,
+            insert_record_rows,
+        )
+
+        project = uuid.uuid4().hex[:16]
+        records = [
+            self._make_record(uuid.uuid4().hex, name="/api/orders", stack_info="main;query 1\n")
+            for _ in range(0, 7)
+        ]
+        with self._app.app_context():
+            # The stack is interned, the writers only insert the records below.
+            insert_record_rows([build_record_row(project, records.pop())])
+
+        batches = [records[:4], records[2:]]
+        barrier = threading.Barrier(len(batches))
+        errors = []
+
+        def overlapped_insert_ignore(table, rows):
+            # Both writers have read the database before either inserts the records.
+            if table is SampleRecord.__table__:
+                barrier.wait(timeout=5)
+            return insert_ignore(table, rows)
+
+        def write(batch):
+            with self._app.app_context():
+                try:
+                    insert_record_rows([build_record_row(project, record) for record in batch])
+                except Exception as e:
+                    errors.append(e)
+
+        with patch("server.app.insert_ignore", overlapped_insert_ignore):
+            threads = [threading.Thread(target=write, args=(batch,)) for batch in batches]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        # The same batches again, e.g. replayed from a spool.
+        for batch in batches:
+            with self._app.app_context():
+                insert_record_rows([build_record_row(project, record) for record in batch])
+
+        with self._app.app_context():
+            counts = [r.count for r in SampleRollup.query.filter_by(project=project)]
+        self.assertEqual(sum(counts), len(records) + 1)
+
+    @patch("server.app.ROLLUP_ENABLED", True)
+    def test_compact_records(self):
+        from server.app import (
+            SampleRecord,
+            SampleRollup,
+            compact_records,
+            db,
+            downsample_rollups,
+        )
+
+        project = uuid.uuid4().hex[:16]
+        timestamp = time.time() - 40 * 86400
+        records = [
+            self._make_record(uuid.uuid4().hex, name="/old", timestamp=timestamp + i,
+                              execution_time=i, stack_info="main;old 1\n")
+            for i in range(0, 5)
+        ]
+        with self._app.test_client() as c:
+            data = zlib.compress(json.dumps({"records": records}).encode("utf8"))
+            c.post(f'/sample/add_batch/{project}', data=data)
+
+        with self._app.app_context():
+            # stored before the rollups
+            legacy = SampleRecord(
+                project=project,
+                sample_id=uuid.uuid4().hex,
+                name="/old",
+                process_id=1,
+                thread_id=1,
+                stack_info="main;legacy 2\n",
+                created_at=datetime.datetime.fromtimestamp(timestamp),
+                execution_time=0,
+            )
+            db.session.add(legacy)
+            db.session.commit()
+
+            self.assertGreaterEqual(compact_records(30, keep_slowest=2, batch_size=2), 4)
+            kept = SampleRecord.query.filter_by(project=project).all()
+            self.assertEqual(sorted(r.execution_time for r in kept), [3, 4])
+
+            self.assertGreaterEqual(downsample_rollups(7), 2)
+            periods = {r.period for r in SampleRollup.query.filter_by(project=project)}
+            self.assertEqual(periods, {86400})
+
+        with self._app.test_client() as c:
+            rv = c.get(f'/sample/aggregate/{project}?name=/old')
+            self.assertEqual(
+                sorted(rv.data.decode("utf8").splitlines()), ["main;legacy 2", "main;old 5"]
+            )
+
+    @patch("server.app.FUNCTION_INDEX_ENABLED", True)
+    def test_function_index(self):
+        project = uuid.uuid4().hex[:16]
+        frames = "main (app.py:1);handle (app.py:5);dumps (json/__init__.py:231);"
+        records = [
+            self._make_record(uuid.uuid4().hex, name="/api/orders", stack_info=(
+                f"{frames}encode (json/encoder.py:199); 4\n"
+                f"{frames} 2\n"
+                "main (app.py:1);handle (app.py:6); 1\n"
+            )),
+            self._make_record(uuid.uuid4().hex, name="/api/users", stack_info=f"{frames} 1\n"),
+        ]
+        with self._app.test_client() as c:
+            data = zlib.compress(json.dumps({"records": records}).encode("utf8"))
+            c.post(f'/sample/add_batch/{project}', data=data)
+            c.post(f'/sample/add_batch/{project}', data=data)
+
+            rv = json.loads(c.get(f'/sample/function?name=dumps&project={project}').data)
+            data = rv["data"]
+            self.assertEqual(data["functions"][0]["filename"], "json/__init__.py")
+            self.assertEqual(
+                [(r["sample_id"], r["self_count"], r["total_count"]) for r in data["samples"]],
+                [(records[0]["sample_id"], 2, 6), (records[1]["sample_id"], 1, 1)],
+            )
+            self.assertEqual(
+                [(e["name"], e["samples"], e["total_count"]) for e in data["endpoints"]],
+                [("/api/orders", 1, 6), ("/api/users", 1, 1)],
+            )
+
+            rv = json.loads(c.get(
+                f'/sample/function?name=handle&filename=app.py&project={project}'
+            ).data)
+            self.assertEqual(len(rv["data"]["functions"]), 1)
+            self.assertEqual(rv["data"]["samples"][0]["total_count"], 7)
+
+    def test_interner_transaction(self):
+        from server.app import SampleStack, db, hash_text, stack_interner
+
+        frames = f"main;{uuid.uuid4().hex}"
+        with self._app.app_context():
+            stack_interner.intern([frames])
+            db.session.rollback()
+            self.assertNotIn(hash_text(frames), stack_interner._ids)
+            self.assertIsNone(SampleStack.query.filter_by(frames=frames).first())
+
+            stack_id = stack_interner.intern([frames])[frames]
+            self.assertNotIn(hash_text(frames), stack_interner._ids)
+            db.session.commit()
+            self.assertEqual(stack_interner._ids[hash_text(frames)], stack_id)
+
+    def test_benchmark(self):
+        from server.benchmark import LocalClient, make_profile, run_benchmark
+        from server.app import parse_folded_stacks
+        import random
+
+        profile = make_profile(10, 20, random.Random(0))
+        self.assertEqual(len(parse_folded_stacks(profile)), 20)
+
+        results = run_benchmark(
+            lambda: LocalClient(self._app),
+            ["add", "add_batch", "get", "search", "flamegraph"],
+            project=uuid.uuid4().hex[:16],
+            requests=4,
+            batch_size=2,
+            concurrency=2,
+            depth=5,
+            width=5,
+            flamegraph_widths=(5,),
+            flamegraph_requests=2,
+        )
+        self.assertEqual(
+            [r.name for r in results],
+            ["add", "add_batch(2)", "get", "search",
+             "flamegraph(width=5,cold)", "flamegraph(width=5,warm)"],
+        )
+        for result in results:
+            self.assertEqual(result.errors, 0, result.name)
+        self.assertEqual(results[1].to_dict()["records"], 4)
+
+
+class TestEmbeddedStorage(unittest.TestCase):
+    def setUp(self) -> None:
+        from server.app import app
+        self._app = app
+        self._directory = tempfile.mkdtemp(prefix="pysample_storage_")
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def _make_rows(self, count: int, timestamp: float):
+        from server.app import build_record_row
+
+        return [
+            build_record_row("proj", {
+                "name": f"/path/{i % 2}",
+                "sample_id": uuid.uuid4().hex,
+                "process_id": 1,
+                "thread_id": 1,
+                "timestamp": timestamp + i,
+                "stack_info": f"main;func{i} {i + 1}\n",
+                "execution_time": i * 10,
+            })
+            for i in range(0, count)
+        ]
+
+    def test_add_and_get(self):
+        from server.app import EmbeddedStorage, NoResultFound
+
+        storage = EmbeddedStorage(self._directory, segment_size=512)
+        rows = self._make_rows(10, time.time())
+        self.assertEqual(storage.add_records(rows), 10)
+        self.assertEqual(storage.add_records(rows[:2]), 0)
+        self.assertGreater(len([n for n in os.listdir(self._directory) if n.startswith("segment")]), 1)
+
+        record = storage.get_record("proj", rows[3]["sample_id"])
+        self.assertEqual(record.get_stack_info(), "main;func3 4\n")
+        self.assertEqual(record.execution_time, 30)
+        with self.assertRaises(NoResultFound):
+            storage.get_record("proj", uuid.uuid4().hex)
+        storage.close()
+
+        # The index is loaded, and the records missing in the index are recovered.
+        index_path = os.path.join(self._directory, EmbeddedStorage.INDEX_FILE)
+        with open(index_path) as file:
+            lines = file.readlines()
+        with open(index_path, "w") as file:
+            file.writelines(lines[:5])
+        storage = EmbeddedStorage(self._directory, segment_size=512)
+        record = storage.get_record("proj", rows[9]["sample_id"])
+        self.assertEqual(record.get_stack_info(), "main;func9 10\n")
+        self.assertEqual(storage.add_records(self._make_rows(1, time.time())), 1)
+        storage.close()
+
+    def test_search(self):
+        from server.app import EmbeddedStorage, RECORD_COLUMNS
+
+        storage = EmbeddedStorage(self._directory)
+        now = time.time()
+        rows = self._make_rows(10, now)
+        storage.add_records(rows)
+
+        result = storage.search("proj", limit=3)
+        self.assertEqual([r["sample_id"] for r in result], [r["sample_id"] for r in rows[::-1][:3]])
+        last = result[-1]
+        result = storage.search("proj", limit=3, after=(last["created_at"], last["id"]))
+        self.assertEqual([r["sample_id"] for r in result], [r["sample_id"] for r in rows[::-1][3:6]])
+
+        result = storage.search(
+            "proj",
+            name="/path/1",
+            start=datetime.datetime.fromtimestamp(now + 2),
+            end=datetime.datetime.fromtimestamp(now + 8),
+            sort="execution_time",
+        )
+        self.assertEqual([r["execution_time"] for r in result], [70, 50, 30])
+
+        # Answered from the index, the segments are not read.
+        with patch.object(storage, "get_record", side_effect=AssertionError):
+            result = storage.search("proj", limit=1)
+        record = storage.get_record("proj", rows[-1]["sample_id"])
+        self.assertEqual(result, [{column: getattr(record, column) for column in RECORD_COLUMNS}])
+        storage.close()
+
+    def test_directory_lock(self):
+        from server.app import EmbeddedStorage
+
+        storage = EmbeddedStorage(self._directory)
+        with self.assertRaises(RuntimeError):
+            EmbeddedStorage(self._directory)
+        storage.close()
+        EmbeddedStorage(self._directory).close()
+
+    def test_routes(self):
+        from server.app import EmbeddedStorage
+
+        storage = EmbeddedStorage(self._directory)
+        sample_id = uuid.uuid4().hex
+        with patch("server.app.storage", storage), self._app.test_client() as c:
+            record = {
+                "name": "/test/path",
+                "sample_id": sample_id,
+                "process_id": os.getpid(),
+                "thread_id": threading.current_thread().ident,
+                "timestamp": time.time(),
+                "stack_info": "test_server.py 10",
+                "execution_time": 100,
+            }
+            rv = c.post('/sample/add/proj', data=zlib.compress(json.dumps(record).encode("utf8")))
+            self.assertTrue(json.loads(rv.data)["success"])
+
+            rv = json.loads(c.get(f'/sample/get/proj/{sample_id}').data)
+            self.assertEqual(rv["data"]["stack_info"], "test_server.py 10")
+            rv = json.loads(c.get('/sample/search?project=proj').data)
+            self.assertEqual(rv["data"][0]["sample_id"], sample_id)
+        storage.close()
@@ -0,0 +1,280 @@
+import os
+import shutil
+import asyncio
+import tempfile
+import unittest
+from collections import deque
+from urllib.error import URLError
+from mock import AsyncMock, MagicMock, patch
+
+from pysample.transport import (
+    AsyncTransport,
+    DiskSpool,
+    DropNewestPolicy,
+    DropOldestPolicy,
+    ExecutionTimeSamplingPolicy,
+    KeepSlowestPolicy,
+    QueueItem,
+    ThreadTransport,
+)
+
+
+class TestDiskSpool(unittest.TestCase):
+    def setUp(self) -> None:
+        self._directory = tempfile.mkdtemp(prefix="pysample_spool_")
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def test_append_and_read_batch(self):
+        spool = DiskSpool(self._directory, max_bytes=1024 * 1024, segment_size=256)
+        headers = {"Content-Encoding": "deflate"}
+        for i in range(0, 10):
+            self.assertTrue(spool.append(f"http://localhost/{i}", headers, b"x" * 100))
+
+        self.assertGreater(len(os.listdir(self._directory)), 1)
+        self.assertTrue(spool.pending())
+
+        records = spool.read_batch(4)
+        self.assertEqual([r[0] for r in records], [f"http://localhost/{i}" for i in range(0, 4)])
+        self.assertDictEqual(records[0][1], headers)
+        self.assertEqual(records[0][2], b"x" * 100)
+
+        records = spool.read_batch(100)
+        self.assertEqual(len(records), 6)
+        self.assertFalse(spool.pending())
+        self.assertEqual(os.listdir(self._directory), [])
+        self.assertEqual(spool.size, 0)
+
+    def test_recover_segments(self):
+        spool = DiskSpool(self._directory)
+        spool.append("http://localhost/1", {}, b"data1")
+        spool.append("http://localhost/2", {}, b"data2")
+
+        spool = DiskSpool(self._directory)
+        records = spool.read_batch(10)
+        self.assertEqual([r[2] for r in records], [b"data1", b"data2"])
+
+    def test_max_bytes(self):
+        spool = DiskSpool(self._directory, max_bytes=200, segment_size=200)
+        self.assertTrue(spool.append("http://localhost/1", {}, b"x" * 100))
+        self.assertFalse(spool.append("http://localhost/2", {}, b"x" * 100))
+
+    @unittest.skipUnless(hasattr(os, "fork"), "requires fork")
+    def test_adopt_child_segments(self):
+        spool = DiskSpool(self._directory)
+        spool.append("http://localhost/1", {}, b"parent")
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                spool.for_child_process().append("http://localhost/2", {}, b"child")
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.listdir(os.path.join(self._directory, str(pid))), ["0" * 20 + ".seg"])
+
+        spool._next_adopt = 0
+        self.assertTrue(spool.pending())
+        records = spool.read_batch(10)
+        self.assertEqual([r[2] for r in records], [b"parent", b"child"])
+        self.assertEqual(os.listdir(self._directory), [])
+
+    def test_corrupted_segment(self):
+        spool = DiskSpool(self._directory)
+        spool.append("http://localhost/1", {}, b"data1")
+        path = os.path.join(self._directory, os.listdir(self._directory)[0])
+        with open(path, "r+b") as file:
+            file.seek(-1, os.SEEK_END)
+            file.write(b"!")
+
+        self.assertEqual(spool.read_batch(10), [])
+        self.assertFalse(spool.pending())
+
+
+class TestThreadTransportSpool(unittest.TestCase):
+    def setUp(self) -> None:
+        self._directory = tempfile.mkdtemp(prefix="pysample_spool_")
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def test_spool_overflow(self):
+        spool = DiskSpool(self._directory)
+        transport = ThreadTransport(max_queue_size=1, spool=spool)
+        transport.send("http://localhost/1", {}, b"data1")
+        transport.send("http://localhost/2", {}, b"data2")
+        self.assertEqual(spool.read_batch(10), [("http://localhost/2", {}, b"data2")])
+
+    def test_spool_failed_and_replay(self):
+        spool = DiskSpool(self._directory)
+        transport = ThreadTransport(spool=spool, replay_interval=0)
+        transport._send_request = MagicMock(side_effect=URLError("connection refused"))
+        transport._handle_failure("http://localhost/1", {}, b"data1", URLError("refused"))
+        self.assertTrue(spool.pending())
+
+        transport._replay()
+        self.assertTrue(spool.pending())
+
+        transport._send_request = MagicMock()
+        transport._replay()
+        self.assertFalse(spool.pending())
+        transport._send_request.assert_called_once_with("http://localhost/1", {}, b"data1")
+
+
+class TestAsyncTransport(unittest.TestCase):
+    def setUp(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+
+    def tearDown(self) -> None:
+        self._loop.close()
+        asyncio.set_event_loop(None)
+
+    async def _handle(self, reader, writer, bodies, statuses=None):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line == b"\r\n":
+                    break
+                key, _, value = line.decode("latin-1").partition(":")
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers["content-length"]))
+            status = statuses.pop(0) if statuses else b"200 OK"
+            if status.startswith(b"200"):
+                bodies.append(body)
+            writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Length: 2\r\n\r\n{}")
+            await writer.drain()
+        writer.close()
+
+    def test_send(self):
+        bodies = []
+
+        async def run():
+            server = await asyncio.start_server(
+                lambda r, w: self._handle(r, w, bodies), "127.0.0.1", 0
+            )
+            port = server.sockets[0].getsockname()[1]
+            transport = AsyncTransport(max_concurrency=2, batch_size=4)
+            transport.start()
+            for i in range(0, 10):
+                transport.send(f"http://127.0.0.1:{port}/sample/add/proj", {}, b"data%d" % i)
+
+            for _ in range(0, 100):
+                if len(bodies) == 10:
+                    break
+                await asyncio.sleep(0.01)
+
+            transport.stop()
+            server.close()
+            await server.wait_closed()
+
+        self._loop.run_until_complete(run())
+        self.assertEqual(sorted(bodies), sorted(b"data%d" % i for i in range(0, 10)))
+
+    def test_spool_failed_and_replay(self):
+        bodies = []
+        statuses = [b"503 Service Unavailable", b"400 Bad Request"]
+        directory = tempfile.mkdtemp(prefix="pysample_spool_")
+        self.addCleanup(shutil.rmtree, directory, True)
+
+        async def run():
+            server = await asyncio.start_server(
+                lambda r, w: self._handle(r, w, bodies, statuses), "127.0.0.1", 0
+            )
+            port = server.sockets[0].getsockname()[1]
+            transport = AsyncTransport(
+                max_concurrency=1, spool=DiskSpool(directory), replay_interval=0.05
+            )
+            transport.start()
+            for i in range(0, 3):
+                transport.send(f"http://127.0.0.1:{port}/sample/add/proj", {}, b"data%d" % i)
+
+            for _ in range(0, 100):
+                if len(bodies) == 2:
+                    break
+                await asyncio.sleep(0.01)
+
+            transport.stop()
+            server.close()
+            await server.wait_closed()
+            await asyncio.sleep(0.01)
+            return transport.stats()
+
+        stats = self._loop.run_until_complete(run())
+        # "data0" is retried, "data1" is rejected by the server.
+        self.assertEqual(sorted(bodies), [b"data0", b"data2"])
+        self.assertEqual(stats["failed"], 2)
+        self.assertEqual(stats["spooled"], 1)
+        self.assertEqual(stats["sent"], 2)
+
+    def test_queue_full(self):
+        async def run():
+            transport = AsyncTransport(max_queue_size=2)
+            transport.start()
+            for i in range(0, 5):
+                transport.send("http://127.0.0.1:1/sample/add/proj", {}, b"data")
+            queued = len(transport._buffer)
+            transport.stop()
+            # Let the cancelled workers finish.
+            await asyncio.sleep(0.01)
+            return queued
+
+        with patch("asyncio.open_connection", AsyncMock(side_effect=ConnectionRefusedError)):
+            self.assertEqual(self._loop.run_until_complete(run()), 2)
+
+
+class TestOverflowPolicy(unittest.TestCase):
+    def _offer_all(self, policy, priorities, max_size):
+        items = deque()
+        discarded = []
+        for priority in priorities:
+            item = QueueItem("http://localhost", {}, b"", priority)
+            res = policy.offer(items, item, max_size)
+            if res is not None:
+                discarded.append(res.priority)
+        return [item.priority for item in items], discarded
+
+    def test_drop_newest(self):
+        items, discarded = self._offer_all(DropNewestPolicy(), [1, 2, 3, 4], 2)
+        self.assertEqual(items, [1, 2])
+        self.assertEqual(discarded, [3, 4])
+
+    def test_drop_oldest(self):
+        items, discarded = self._offer_all(DropOldestPolicy(), [1, 2, 3, 4], 2)
+        self.assertEqual(items, [3, 4])
+        self.assertEqual(discarded, [1, 2])
+
+    def test_keep_slowest(self):
+        items, discarded = self._offer_all(KeepSlowestPolicy(), [5, 1, 3, 2, 8], 3)
+        self.assertEqual(sorted(items), [3, 5, 8])
+        self.assertEqual(sorted(discarded), [1, 2])
+
+    def test_execution_time_sampling(self):
+        policy = ExecutionTimeSamplingPolicy(reference_time=100, high_watermark=0.5)
+        items, discarded = self._offer_all(policy, [0, 0, 0, 100, 100, 0], 10)
+        self.assertEqual(items, [0, 0, 0, 100, 100])
+        self.assertEqual(discarded, [0])
+
+        items, discarded = self._offer_all(policy, [0] * 5 + [0] * 3 + [100] * 10, 10)
+        self.assertEqual(items, [0] * 5 + [100] * 5)
+        self.assertEqual(discarded, [0] * 3 + [100] * 5)
+
+    def test_thread_transport_stats(self):
+        transport = ThreadTransport(max_queue_size=2, overflow_policy=KeepSlowestPolicy())
+        transport._send_request = MagicMock()
+        transport.send("http://localhost", {}, b"", priority=10)
+        transport.send("http://localhost", {}, b"", priority=30)
+        transport.send("http://localhost", {}, b"", priority=20)
+
+        item = transport._get(timeout=0)
+        self.assertEqual(item.priority, 30)
+        stats = transport.stats()
+        self.assertEqual(stats["queued"], 3)
+        self.assertEqual(stats["dropped"], 1)
+        self.assertEqual(stats["queue_size"], 1)
+        self.assertGreaterEqual(stats["queue_latency_max"], 0)